@@ -5,11 +5,14 @@
 # Google advanced search crawler
 # use each trigram as query to search
 # and collect each page of results.
+# Result urls are normalized and deduplicated against the url store of the variety,
+# shared by all the worker processes, and only new ones are appended to the csv,
+# page by page. Queries which stopped producing new urls are not searched again.
 
 import sys
 from time import time, sleep
 from random import sample, randint
-from typing import List
+from typing import Dict, List, Optional
 
 from selenium import webdriver
 from selenium.webdriver.chrome.webdriver import WebDriver
@@ -18,6 +21,7 @@ from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.service import Service
 
 from utils import req_2captcha
+from url_store import UrlStore
 
 
 # This is not needed if chromedriver is already on your path:
@@ -33,22 +37,59 @@ OPTIONS.add_argument("--headless")
 
 CC_MAP = {"cn": "CN", "hk": "HK", "mo": "MO", "tw": "TW", "my": "MY", "sg": "SG"}
 AREA = CC_MAP[sys.argv[1]]
+URL_CSV_PATH = f"./url.{sys.argv[1]}.csv"
+URL_STORE_PATH = f"./url.{sys.argv[1]}.db"
 TEMPLATE = "https://www.google.com/search?hl=zh-CN&as_q=[QUERY]+filetype%3Ahtml&as_epq=&as_oq=&as_eq=&as_nlo=&as_nhi=&lr=lang_en&cr=country[AREA]&as_qdr=all&as_sitesearch=&as_occt=any&safe=images&as_filetype=&tbs="
 
 
+def open_url_store() -> UrlStore:
+    """Url store of the variety, seeded with the urls of a former csv on creation."""
+    store = UrlStore(URL_STORE_PATH)
+    seeded = store.seed(URL_CSV_PATH)
+    if seeded:
+        print(f"url store seeded with {seeded} urls of {URL_CSV_PATH}")
+    return store
+
+
 def read_query_file(fpath: str = "data/query.txt"):
     with open(fpath, "r") as f:
         query_list = f.readlines()
         query_list = [q.strip() for q in query_list]
+    store = open_url_store()
+    exhausted = store.exhausted()
+    store.close()
+    query_list = [q for q in query_list if q not in exhausted]
+    print(f"skip {len(exhausted)} exhausted queries")
     # return query_list
-    return sample(query_list, k=5000)
+    return sample(query_list, k=min(5000, len(query_list)))
+
+
+def append2csv(url_list: List, query: Optional[str] = None, store: Optional[UrlStore] = None, record: bool = True) -> List:
+    """Append the urls not in the store yet to the csv, and record the yield of their query if `record`
+    and the page has results. Without store, all the urls are appended."""
+    if store is not None:
+        new_urls = store.add(url_list)
+        if query is not None and record and url_list:
+            store.record(query, len(url_list), len(new_urls))
+        url_list = new_urls
+    with open(URL_CSV_PATH, "a+") as f:
+        print(f"save url nums: {len(url_list)}")
+        f.write("".join(url + '\n' for url in url_list))  # a single write, lines of workers do not interleave
+    return url_list
 
 
-def append2csv(url_list: List):
-    with open(f"./url.{sys.argv[1]}.csv", "a+") as f:
-        print(f"save url nums: {len(url_list)}")
-        for url in url_list:
-            f.write(url + '\n')
+def search(driver: WebDriver, query: str, window2query: Dict, store: UrlStore):
+    """Search a query in current window, which collects its results from now on."""
+    window2query[driver.current_window_handle] = query
+    store.start_query(query)
+    print("request a url using a query")
+    driver.get(TEMPLATE.replace("[QUERY]", query).replace("[AREA]", AREA))
+
+
+def save_urls(driver: WebDriver, new_urls: List, window2query: Dict, store: UrlStore, record: bool = True) -> List:
+    """Save the urls extracted from current window, return the ones not seen before.
+    The page is left out of the query yield if not `record`, e.g. after a captcha."""
+    return append2csv(new_urls, window2query.get(driver.current_window_handle), store, record)
 
 
 def extract_urls(driver: WebDriver):
@@ -72,7 +113,8 @@ def scroll_and_extract(driver: WebDriver):
     return list()
 
 
-def solve_recaptcha(driver: WebDriver):
+def solve_recaptcha(driver: WebDriver) -> bool:
+    """Bypass the reCaptcha of current window, return whether one appeared."""
     res = driver.find_elements(By.CLASS_NAME, "g-recaptcha")
     if len(res) > 0:
         url = driver.current_url
@@ -93,12 +135,14 @@ def solve_recaptcha(driver: WebDriver):
             token = req_2captcha(url=url, sitekey=sitekey, data_s=data_s, cookies=cookies, proxy=None)
         except:
             sleep(30)
-            return
+            return True
         # print(f"token: {token}")
         print("bypass reCaptcha succ")
         redirect_url = url + "&g-recaptcha-response=" + token
         print("request a url using a query")
         driver.get(redirect_url)
+        return True
+    return False
 
 
 def multitab_scroll_extract(driver: WebDriver, batch=None):
@@ -106,6 +150,8 @@ def multitab_scroll_extract(driver: WebDriver, batch=None):
     total_url_nums = 0
     query_list = batch
     url_list = list()
+    store = open_url_store()
+    window2query = dict()
 
     for i in range(6):
         driver.execute_script(f"window.open('https://www.google.com','tab_{i+1}');")
@@ -113,8 +159,7 @@ def multitab_scroll_extract(driver: WebDriver, batch=None):
 
     for w in driver.window_handles:
         query = query_list.pop()
-        print("request a url using a query")
-        driver.get(TEMPLATE.replace("[QUERY]", query).replace("[AREA]", AREA))
+        search(driver, query, window2query, store)
         solve_recaptcha(driver)
         driver.switch_to.window(w)
 
@@ -127,11 +172,11 @@ def multitab_scroll_extract(driver: WebDriver, batch=None):
                 solve_recaptcha(driver)
                 driver.switch_to.window(w)
             if time_count < 6:
-                solve_recaptcha(driver)
+                captcha = solve_recaptcha(driver)
                 new_urls = extract_urls(driver)
-                url_list += new_urls
                 print('*' * 100)
                 print(f"found new urls: {len(new_urls)}")
+                url_list += save_urls(driver, new_urls, window2query, store, record=not captcha)
                 time_count += 1
                 sleep(sleep_time)
                 continue
@@ -139,37 +184,35 @@ def multitab_scroll_extract(driver: WebDriver, batch=None):
                 new_urls = scroll_and_extract(driver)
             except:
                 if not query_list:
-                    append2csv(url_list)
+                    store.close()
                     # driver.quit()  # unawailable on linux
                     return
                 query = query_list.pop()
                 print(f"update new query: {query}")
-                print("request a url using a query")
-                driver.get(TEMPLATE.replace("[QUERY]", query).replace("[AREA]", AREA))
+                search(driver, query, window2query, store)
                 solve_recaptcha(driver)
                 driver.switch_to.window(w)
                 continue
             print('*' * 100)
             print(f"found new urls: {len(new_urls)}")
-            url_list += new_urls
+            url_list += save_urls(driver, new_urls, window2query, store)
             count += len(new_urls)
             solve_recaptcha(driver)
             driver.switch_to.window(w)
             sleep(sleep_time)
         if count == 0:
             if not query_list:
-                append2csv(url_list)
+                store.close()
                 # driver.quit()  # unawailable on linux
                 return
             query = query_list.pop()
-            print("request a url using a query")
-            driver.get(TEMPLATE.replace("[QUERY]", query).replace("[AREA]", AREA))
+            search(driver, query, window2query, store)
             solve_recaptcha(driver)
             driver.switch_to.window(w)
         end_time = time()
         total_url_nums = len(url_list)
         print(f"total running time: {round(end_time-bgn_time)}s, total crawled urls: {total_url_nums}")
-    append2csv(url_list)
+    store.close()
     # driver.quit()  # unawailable on linux
 
 
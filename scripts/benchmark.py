@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+# @author: YangLiu
+# @email: yangliu.real@gmail.com
+
+# Reproducible benchmarks of the crawl -> extract -> annotate pipeline stages, on a synthetic
+# HTML corpus generated from a fixed seed, so that results are comparable across commits.
+#     text_norm   documents/sec of `preprocess` + `calc_word_nums` on raw pages
+#     extract     pages/sec of `page_parse.extract_chunk` in a single process
+#     annotate    tokens/sec of `data_preprocess.write_wlp_rows` (needs the spaCy model)
+#     lexicon     wlp lines/sec of `data_preprocess.generate_lexicon_and_db_files`
+#     crawl       urls/sec of `bfs_page_crawl.bfs_crawl_concurrent` against a local mock web server
+# Stages whose dependencies are not installed are reported as skipped.
+# Usage:
+#     python benchmark.py [--stages text_norm extract ...] [--output result.json] [--baseline old.json]
+# With `--baseline`, stages slower than the baseline by more than `--tolerance` are flagged,
+# and the exit status is 1.
+
+import io
+import os
+import sys
+import json
+import random
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from time import perf_counter, strftime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+
+SEED = 20230601
+PAGES = 500
+REPEAT = 3
+# relative slowdown from which a stage is flagged as regressed
+TOLERANCE = 0.1
+CC = "hk"
+STAGES = ["text_norm", "extract", "annotate", "lexicon", "crawl"]
+VOCABULARY = ("the of and to in a is that for on with as by at from it was be this are have government "
+              "Hong Kong Macau Taiwan Singapore Malaysia China city people said year new market police "
+              "school public health report week million percent company development council policy").split()
+
+
+def make_sentence(rng: random.Random) -> str:
+    words = rng.choices(VOCABULARY, k=rng.randint(6, 24))
+    return " ".join(words).capitalize() + rng.choice([".", ".", "?", "!"])
+
+
+def make_page(i: int, pages: int, rng: random.Random) -> str:
+    """Synthetic news page, linking to the next page and a few random ones under `/{CC}/page/`."""
+    title = make_sentence(rng)[:-1]
+    paragraphs = "\n".join(f"<p>{' '.join(make_sentence(rng) for _ in range(rng.randint(2, 8)))}</p>" for _ in range(rng.randint(3, 12)))
+    links = [(i + 1) % pages] + rng.sample(range(pages), k=min(5, pages))
+    anchors = "\n".join(f'<li><a href="/{CC}/page/{j}">{make_sentence(rng)[:30]}</a></li>' for j in links)
+    date = f"20{rng.randint(10, 22)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+    return (f"<html><head><title>{title}</title><meta name=\"pubdate\" content=\"{date}\"></head>"
+            f"<body><div class=\"nav\"><ul>{anchors}</ul></div>"
+            f"<div class=\"article\"><h1>{title}</h1><span class=\"time\">{date} 10:00</span>\n{paragraphs}</div>"
+            f"<div class=\"footer\">Copyright {rng.randint(2010, 2022)} News Ltd.</div></body></html>")
+
+
+def make_corpus(pages: int = PAGES, seed: int = SEED) -> List[str]:
+    rng = random.Random(seed)
+    return [make_page(i, pages, rng) for i in range(pages)]
+
+
+class MockSite:
+    """Local web server serving a corpus at `http://127.0.0.1:{port}/{CC}/page/{i}`."""
+
+    def __init__(self, corpus: List[str]):
+        corpus = [page.encode("utf-8") for page in corpus]
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                parts = self.path.strip("/").split("/")
+                if len(parts) == 3 and parts[2].isdigit() and int(parts[2]) < len(corpus):
+                    body = corpus[int(parts[2])]
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/html; charset=utf-8")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                else:
+                    self.send_error(404)
+
+            def log_message(self, *args) -> None:
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def root(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/{CC}/page/0"
+
+    def __enter__(self) -> "MockSite":
+        self.thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def make_wlp(path: str, corpus: List[str]) -> int:
+    """Write a wlp file of the words of the corpus pages, lemma & PoS faked, return its number of rows."""
+    from data_preprocess import WLP_HEADER, get_split_line
+    from text_norm import preprocess
+    rows = 0
+    with open(path, "w") as fw:
+        fw.write(WLP_HEADER)
+        fw.write(get_split_line(WLP_HEADER))
+        for text_id, page in enumerate(corpus):
+            for i, word in enumerate(preprocess(page).split()):
+                tag = "NNP" if word[0].isupper() else "NN"
+                fw.write(f"{str(text_id).zfill(8)}\t{str(i).zfill(9)}\t{word}\t{word.lower()}\tNOUN\t{tag}\tFalse\t{i == 0}\tFalse\n")
+                rows += 1
+    return rows
+
+
+def time_best(func: Callable[[], int], repeat: int) -> Tuple[float, int]:
+    """Best wall time of `repeat` runs of `func`, which returns its number of processed items."""
+    best, items = float("inf"), 0
+    for _ in range(repeat):
+        begin = perf_counter()
+        items = func()
+        best = min(best, perf_counter() - begin)
+    return best, items
+
+
+def bench_text_norm(corpus: List[str], workdir: str) -> Dict:
+    from text_norm import calc_word_nums, preprocess
+
+    def run() -> int:
+        for page in corpus:
+            calc_word_nums(page)
+            preprocess(page)
+        return len(corpus)
+
+    return {"unit": "docs/sec", "runner": run}
+
+
+def bench_extract(corpus: List[str], workdir: str) -> Dict:
+    import page_parse
+    page_parse.EXTRACT_CACHE_PATH = None  # measure extraction, not cache hits
+    page_parse.init_worker(CC)
+    items = [(str(i), f"http://www.example.{CC}/{i}", "NULL", page) for i, page in enumerate(corpus)]
+
+    def run() -> int:
+        results = page_parse.extract_chunk(items)
+        return sum(1 for status, _, _, _ in results if status == "ok")
+
+    return {"unit": "pages/sec", "runner": run}
+
+
+def bench_annotate(corpus: List[str], workdir: str) -> Dict:
+    import data_preprocess
+    from text_norm import preprocess
+    data_preprocess.get_pipeline()
+    docs = [(preprocess(page), str(i).zfill(8)) for i, page in enumerate(corpus)]
+
+    def run() -> int:
+        return data_preprocess.write_wlp_rows(io.StringIO(), docs)[1]
+
+    return {"unit": "tokens/sec", "runner": run}
+
+
+def bench_lexicon(corpus: List[str], workdir: str) -> Dict:
+    import data_preprocess
+    os.makedirs(os.path.join(workdir, f"CCbE/{CC}"), exist_ok=True)
+    wlp_path = os.path.join(workdir, f"CCbE/{CC}/wlp.tsv")
+    rows = make_wlp(wlp_path, corpus)
+
+    def run() -> int:
+        cwd = os.getcwd()
+        os.chdir(workdir)  # outputs go to CCbE/{cc}/
+        try:
+            data_preprocess.generate_lexicon_and_db_files(CC, f"CCbE/{CC}/wlp.tsv", "tsv")
+        finally:
+            os.chdir(cwd)
+        return rows
+
+    return {"unit": "lines/sec", "runner": run}
+
+
+def bench_crawl(corpus: List[str], workdir: str) -> Dict:
+    import bfs_page_crawl
+    from frontier import Frontier, get_host
+    from crawl_scheduler import AdaptiveLimit, HostScheduler
+
+    def run() -> int:
+        db_path = os.path.join(workdir, "frontier.db")
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+        proxy, cache_path = bfs_page_crawl.PROXY, bfs_page_crawl.HTTP_CACHE_PATH
+        bfs_page_crawl.PROXY, bfs_page_crawl.HTTP_CACHE_PATH = None, None
+        try:
+            with MockSite(corpus) as site:
+                frontier = Frontier(db_path, 1)
+                frontier.add([site.root], 1)
+                frontier.close()
+                # a single local host, politeness would only measure the rate limit
+                scheduler = HostScheduler(rate=1e9, burst=1 << 30, max_in_flight=bfs_page_crawl.MAX_CONCURRENCY,
+                                          limit=AdaptiveLimit(maximum=bfs_page_crawl.MAX_CONCURRENCY), get_host=get_host)
+                return asyncio.run(bfs_page_crawl.bfs_crawl_concurrent(0, 1, CC, db_path, len(corpus) + 1, scheduler=scheduler))
+        finally:
+            bfs_page_crawl.PROXY, bfs_page_crawl.HTTP_CACHE_PATH = proxy, cache_path
+
+    return {"unit": "urls/sec", "runner": run}
+
+
+BENCHMARKS = {"text_norm": bench_text_norm, "extract": bench_extract, "annotate": bench_annotate, "lexicon": bench_lexicon, "crawl": bench_crawl}
+
+
+def run_stage(name: str, corpus: List[str], repeat: int) -> Dict:
+    workdir = tempfile.mkdtemp(prefix=f"bench_{name}_")
+    try:
+        try:
+            bench = BENCHMARKS[name](corpus, workdir)
+        except (ImportError, OSError) as e:  # missing package or spaCy model
+            return {"skipped": str(e)}
+        seconds, items = time_best(bench["runner"], repeat)
+        return {"unit": bench["unit"], "value": round(items / seconds, 2), "items": items, "seconds": round(seconds, 4)}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float = TOLERANCE) -> List[str]:
+    """Stages slower than in `baseline` by more than `tolerance`."""
+    regressions = list()
+    for name, result in results["stages"].items():
+        old = baseline.get("stages", {}).get(name, {})
+        if "value" not in result or "value" not in old or old["value"] <= 0:
+            continue
+        change = result["value"] / old["value"] - 1
+        result["change"] = round(change, 4)
+        if change < -tolerance:
+            regressions.append(f"{name}: {old['value']} -> {result['value']} {result['unit']} ({change:+.1%})")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on a synthetic corpus.")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--pages", type=int, default=PAGES)
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--output", default=None, help="JSON result path, default `benchmark.{commit}.json`")
+    parser.add_argument("--baseline", default=None, help="JSON result of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args(argv)
+
+    corpus = make_corpus(args.pages, args.seed)
+    commit = get_commit()
+    results = {
+        "commit": commit,
+        "time": strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": f"{platform.system()} {platform.machine()}, {os.cpu_count()} cpus",
+        "pages": args.pages,
+        "seed": args.seed,
+        "stages": dict(),
+    }
+    for name in args.stages:
+        result = results["stages"][name] = run_stage(name, corpus, args.repeat)
+        if "skipped" in result:
+            print(f"{name}: skipped ({result['skipped']})")
+        else:
+            print(f"{name}: {result['value']} {result['unit']} ({result['items']} in {result['seconds']}s)")
+
+    regressions = list()
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        results["regressions"] = regressions
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+    output = args.output or f"benchmark.{commit}.json"
+    with open(output, "w") as fw:
+        json.dump(results, fw, indent=2)
+    print(f"results written to {output}")
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,33 +5,50 @@
 # Asyncio crawler for Breadth-first-search web page crawling, using asyncio and httpx.
 # Working trilogy:
 # 1. Input a batch of URLs to generate a domain set(De-dup).
-# 2. Iterate each of domain in DFS approach, with specific depth(default 5), collect all the URLs which end with {cc} into a uniform set.
+# 2. Iterate each of domain in BFS approach, with specific depth(default 5), collect all the URLs which end with {cc} into a persistent frontier shared by all the workers.
 # 3. Crawl corresponding web page content according to each URL in the uniform set, dump them as a dict(url2content) object locally.
 
 import os
 import asyncio
-from typing import Set
+from concurrent.futures import FIRST_COMPLETED, TimeoutError, wait
+from typing import Awaitable, Callable, Optional, Set
 from pprint import pprint
 
 import httpx
-from tqdm.asyncio import tqdm
 from httpx import AsyncClient
 from pebble import ProcessPool
 from lxml.html import fromstring
 
+from tsv_index import IndexedTsv
+from extraction_engine import extract_links
+from frontier import DONE, FAILED, Frontier, get_host
+from crawl_scheduler import AdaptiveLimit, HostScheduler, HostThrottled
+from http_cache import HttpCache
+import metrics
+
 
 HEADERS = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.95 Safari/537.36'}
-LIMIT = httpx.Limits(max_connections=30)
+# ceiling of the adaptive global concurrency of a worker
+MAX_CONCURRENCY = 64
+LIMIT = httpx.Limits(max_connections=MAX_CONCURRENCY)
 TRANS = httpx.AsyncHTTPTransport(verify=False, retries=3)
+PROXY = "socks5://127.0.0.1:7890"
+# sqlite file of the persistent url frontier of each variety
+FRONTIER_PATH = "frontier.{cc}.db"
+# number of crawler processes, urls are partitioned among them by host
+PARTITIONS = 8
+# timeout in seconds of a crawler process, after which it is restarted on the rest of its partition
+WORKER_TIMEOUT = 3600
+# number of times the worker of a partition is restarted after crashing
+MAX_RESTARTS = 3
+# sqlite file of the http cache of each variety, set to None to disable conditional recrawls
+HTTP_CACHE_PATH = "http_cache.{cc}.db"
 
 
 def generate_index_set(cc: str) -> Set[str]:
     index_set = set()
-    with open(f"data/metadata.raw.{cc}.tsv", "r") as f:
-        lines = f.readlines()
-        for line in lines:
-            components = line.split('\t')
-            url = components[6]
+    with IndexedTsv(f"data/metadata.raw.{cc}.tsv") as tsv:
+        for url in tsv.column("URL"):
             # if not url.startswith("http") or f".{cc}/" not in url:
             if not url.startswith("http"):
                 continue
@@ -41,122 +58,164 @@ def generate_index_set(cc: str) -> Set[str]:
     return index_set
 
 
-async def bfs_crawl_concurrent(index: int, index_cout: int, index_url: str, cc: str, max_crawl_depth: int = 5) -> Set[str]:
-    """Crawl all the URLs in BFS approach with previously set max crawl depth."""
-    global total_url_set
-    total_url_set = set()
-    url_queue = asyncio.Queue(-1)
-    client = AsyncClient(headers=HEADERS, limits=LIMIT, transport=TRANS, max_redirects=5, timeout=10, proxies="socks5://127.0.0.1:7890")
+async def bfs_crawl_concurrent(part: int, partitions: int, cc: str, db_path: str, max_crawl_depth: int = 5,
+                               sink: Optional[Callable[[str, str], Awaitable[None]]] = None,
+                               scheduler: Optional[HostScheduler] = None) -> int:
+    """Crawl URLs of a frontier partition in BFS approach with previously set max crawl depth,
+    until the whole frontier shared with other workers is drained. Fetches are pipelined
+    continuously under per-host politeness and adaptive global concurrency (see `crawl_scheduler`).
+    If `sink` is given, the html of every fetched page is handed to it (see `fused_pipeline`),
+    except pages found unchanged since the last crawl by the http cache. URLs of the pages
+    handed over are left in flight, to be marked DONE by the sink once processed, so that
+    a killed run requeues them.
+    A custom `scheduler` may be given, e.g. with other politeness settings for a local mock server.
+
+    Returns
+    -------
+    number of URLs crawled by this worker
+    """
+    frontier = Frontier(db_path, partitions)
+    client = AsyncClient(headers=HEADERS, limits=LIMIT, transport=TRANS, max_redirects=5, timeout=10, proxies=PROXY)
+    scheduler = scheduler or HostScheduler(limit=AdaptiveLimit(maximum=MAX_CONCURRENCY), get_host=get_host)
+    cache = HttpCache(HTTP_CACHE_PATH.format(cc=cc)) if HTTP_CACHE_PATH is not None else None
+    crawled = 0
+    handed = set()  # urls whose page was handed to the sink, marked by the sink
 
     async def collect_all_urls_in_page(url: str) -> Set[str]:
-        global total_url_set
-        try:
-            res = await client.get(url)
-        except:
-            if url in total_url_set:
-                total_url_set.remove(url)
-            return set()
+        """Fetch a page and collect its links, raise if the page is not available."""
+        with metrics.timer("crawl.fetch_seconds"):
+            res = await client.get(url, headers=cache.conditional_headers(url) if cache is not None else None)
+        metrics.incr(f"crawl.http_{res.status_code}")
+        if res.status_code in (429, 503):
+            raise HostThrottled(url)
+        if res.status_code == 304 and cache is not None and (content := cache.get_body(url)) is not None:
+            changed = False  # not modified, reuse cached body for links
+        elif res.status_code != 200 or "text/html" not in res.headers.get("content-type", ""):
+            raise ValueError(f"unavailable page: {res.status_code}")
+        else:
+            content = res.content
+            metrics.incr("crawl.bytes_fetched", len(content))
+            changed = cache.store(url, res.headers, content) if cache is not None else True
+        html = content.decode("utf-8")
+        if sink is not None and changed:
+            await sink(url, html)
+            handed.add(url)
+        protocol, suffix = url.split("://")
+        prefix = protocol + "://"
+        domain = suffix.split('/')[0]
+        base_url = prefix + domain
+        with metrics.timer("crawl.parse_links_seconds"):
+            link_set = extract_links(fromstring(html), base_url, cc)
+        metrics.incr("crawl.links_found", len(link_set))
+        return link_set
+
+    def complete(url: str, depth: int, link_set: Optional[Set[str]]) -> None:
+        nonlocal crawled
+        crawled += 1
+        if link_set is None:
+            if url not in handed:
+                frontier.mark([url], FAILED)
+            metrics.incr("crawl.urls_failed")
         else:
-            if url in total_url_set and (res.status_code != 200 or "text/html" not in res.headers["content-type"]):
-                total_url_set.remove(url)
-                return set()
-            try:
-                html = res.content.decode("utf-8")
-            except:
-                if url in total_url_set:
-                    total_url_set.remove(url)
-                return set()
-        try:
-            protocol, suffix = url.split("://")
-            prefix = protocol + "://"
-            domain = suffix.split('/')[0]
-            base_url = prefix + domain
-            parsed_doc = fromstring(html, base_url=base_url)
-            parsed_doc.make_links_absolute()
-        except:
-            if url in total_url_set:
-                total_url_set.remove(url)
-            return set()
-        link_list = [tpl[2] for tpl in list(parsed_doc.iterlinks()) if tpl[2] not in total_url_set and tpl[2].startswith("http") and (f".{cc}" in tpl[2] or f"/{cc}/" in tpl[2])]
-        for new_url in link_list:  # enqueue new urls
-            url_queue.put_nowait(new_url)
-        # total_url_set = total_url_set.union(link_list)  # add new urls to total_url_set
-        return set(link_list)
-
-    def task_done(_future) -> Set[str]:
-        return _future.result()
+            if depth < max_crawl_depth:
+                metrics.incr("crawl.urls_enqueued", frontier.add(link_set, depth + 1))  # enqueue unseen urls only
+            if url not in handed:
+                frontier.mark([url], DONE)
+            metrics.incr("crawl.urls_done")
+        handed.discard(url)
+        metrics.observe("crawl.concurrency", scheduler.limit.value)
+        if crawled % 100 == 0:
+            print(f"[{cc}][pid:{os.getpid()}][part{part}] crawled {crawled} urls, concurrency {scheduler.limit.value}, {scheduler.stats}")
 
     try:
-        total_url_set.add(index_url)
-        await url_queue.put(index_url)
-        for depth in range(1, max_crawl_depth + 1):
-            queue_size = url_queue.qsize()
-            task_list = list()
-            # print(f"\033[92m[{cc}][pid:{os.getpid()}][{index}/{index_cout}] URL size in level {depth}: {queue_size}\033[00m")
-            # print(f"[{cc}][pid:{os.getpid()}][{index}/{index_cout}] URL size in level {depth}: {queue_size}")
-            for _ in range(queue_size):
-                url = url_queue.get_nowait()
-                total_url_set.add(url)
-                task = asyncio.create_task(collect_all_urls_in_page(url))
-                # task.add_done_callback(task_done)
-                task_list.append(task)
-            results = [await f for f in tqdm(asyncio.as_completed(task_list, timeout=600), total=len(task_list), unit=" url", unit_scale=True, desc=f"[{cc}][{os.getpid()}][{index}/{index_cout}][level{depth}]")]
-            # for s in results:
-            # total_url_set = total_url_set.union(s)
-            print(f"Size of total_url_set: {len(total_url_set)}")
-            # pprint(total_url_set)
-    except:
-        return total_url_set
-
-    return total_url_set
-
-
-def worker(index: int, index_cout: int, index_url: str, cc: str, max_crawl_depth: int) -> Set[str]:
-    s = asyncio.run(bfs_crawl_concurrent(index, index_cout, index_url, cc, max_crawl_depth))
-    return s
-
-
-def master(index_set: Set[str], cc: str, max_crawl_depth: int) -> Set[str]:
-
-    global total_set
-    total_set = set()
-
-    def checkpoint() -> None:
-        global total_set
-        with open(f"url.{cc}.tsv", "w") as fp:
-            for url in total_set:
-                fp.write(f"{url}\n")
-
-    def callback(_future) -> None:
-        try:
-            global total_set
-            result_set = _future.result()
-            total_set = total_set.union(result_set)
-            print(f"[{cc}] Totally {len(total_set)} URLs to write.")
-            checkpoint()
-        except TimeoutError as error:
-            # print(f"\033[91mFunction took longer than {error.args[1]} seconds\033[00m")
-            print(f"Function took longer than {error.args[1]} seconds")
-        except Exception as error:
-            # print(f"\033[91mFunction raised {error}\033[00m")
-            print(f"Function raised {error}")
-
-    # for batch in get_chunks(list(index_set), 64):
-    with ProcessPool(max_workers=8, max_tasks=16) as pool:
-        for i, index_url in enumerate(index_set, start=1):
-            print('*' * 100)
-            future = pool.schedule(worker, [i, len(index_set), index_url, cc, max_crawl_depth], timeout=3600)
-            future.add_done_callback(callback)
-    print(f"All task done for {cc}.")
-
-    return total_set
+        await scheduler.run(
+            collect_all_urls_in_page,
+            claim=lambda n: frontier.claim(part, n),
+            complete=complete,
+            is_drained=lambda: frontier.pending() == 0,  # nothing queued or in flight in any partition
+            renew=frontier.renew,  # urls of backed-off hosts may wait in the scheduler beyond the lease
+        )
+    finally:
+        await client.aclose()
+        frontier.close()
+        if cache is not None:
+            print(f"[{cc}][pid:{os.getpid()}][part{part}] http cache: {cache.stats}")
+            cache.close()
+        metrics.flush()
+
+    return crawled
+
+
+def worker(part: int, partitions: int, cc: str, db_path: str, max_crawl_depth: int) -> int:
+    return asyncio.run(bfs_crawl_concurrent(part, partitions, cc, db_path, max_crawl_depth))
+
+
+def dump_urls(frontier: Frontier, cc: str) -> int:
+    """Write all the successfully crawled urls to `url.{cc}.tsv`."""
+    url_nums = 0
+    with open(f"url.{cc}.tsv.tmp", "w") as fp:
+        for url in frontier.iter_urls(DONE):
+            fp.write(f"{url}\n")
+            url_nums += 1
+    os.replace(f"url.{cc}.tsv.tmp", f"url.{cc}.tsv")
+    return url_nums
+
+
+def master(index_set: Set[str], cc: str, max_crawl_depth: int, partitions: int = PARTITIONS, refresh: bool = False) -> int:
+    """Seed the persistent frontier of `cc` with index urls and crawl it with one worker per partition.
+    Rerunning after an interruption resumes from the frontier on disk, while `refresh` starts
+    a new crawl over, which the http cache turns into conditional requests."""
+    db_path = FRONTIER_PATH.format(cc=cc)
+    frontier = Frontier(db_path, partitions)
+    if refresh:
+        frontier.clear()
+    print(f"[{cc}] requeued {frontier.recover()} in-flight urls, added {frontier.add(index_set, 1)} index urls.")
+
+    # workers wait for the whole frontier to drain, so the partition of a dead worker is
+    # rescheduled, otherwise the other workers would poll its queued urls until their timeout
+    restarts = {part: 0 for part in range(partitions)}
+    abandoned = set()
+    with ProcessPool(max_workers=partitions) as pool:
+        def schedule(part: int):
+            return pool.schedule(worker, [part, partitions, cc, db_path, max_crawl_depth], timeout=WORKER_TIMEOUT)
+
+        future2part = {schedule(part): part for part in range(partitions)}
+        while future2part:
+            done, _ = wait(list(future2part), return_when=FIRST_COMPLETED)
+            for future in done:
+                part = future2part.pop(future)
+                try:
+                    crawled = future.result()
+                    print(f"[{cc}] worker of part{part} done, {crawled} URLs crawled")
+                    continue
+                except TimeoutError as error:
+                    # print(f"\033[91mFunction took longer than {error.args[1]} seconds\033[00m")
+                    print(f"Function took longer than {error.args[1]} seconds")
+                    timed_out = True
+                except Exception as error:
+                    # print(f"\033[91mFunction raised {error}\033[00m")
+                    print(f"Function raised {error}")
+                    timed_out = False
+                if not timed_out:
+                    restarts[part] += 1
+                if frontier.pending() == 0:
+                    continue
+                if abandoned or restarts[part] > MAX_RESTARTS:
+                    abandoned.add(part)
+                    print(f"[{cc}] part{part} abandoned with {frontier.pending(part)} pending URLs, rerun to resume.")
+                    continue
+                print(f"[{cc}] restart worker of part{part}, requeued {frontier.recover(part)} in-flight urls")
+                future2part[schedule(part)] = part
+    print(f"[{cc}] frontier: {frontier.stats()}")
+    url_nums = dump_urls(frontier, cc)
+    frontier.close()
+    print(f"All task done for {cc}, {url_nums} URLs written.")
+
+    return url_nums
 
 
 if __name__ == "__main__":
     # bfs crawl urls for each specific domain
     for cc in ["cn", "hk", "mo", "tw", "sg", "my"]:
         index_set = generate_index_set(cc)
-        s = master(index_set, cc, 3)
-        with open(f"url.{cc}.tsv", "w") as fp:
-            for url in s:
-                fp.write(f"{url}\n")
+        master(index_set, cc, 3)
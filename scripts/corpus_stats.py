@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+# @author: YangLiu
+# @email: yangliu.real@gmail.com
+
+# Corpus statistics of each variety, computed in one streaming pass over its annotation:
+#     documents, tokens, sentences (tokens with IsSentenceStart), types (distinct words,
+#     case-sensitive as in the lexicon) and type/token ratio, broken down by domain and year.
+# Input is the binary token table `CCbE/{cc}/table` if present, else `CCbE/{cc}/wlp.tsv`.
+# Either one is split into ranges of whole documents counted in parallel, and the partial
+# `CorpusStats` of all the ranges are merged. Domains and years come from the index of
+# `CCbE/{cc}/sources.tsv`.
+# Paragraphs are not counted: `page_parse.preprocess` collapses all the whitespace of the
+# content, so paragraph boundaries are lost before annotation.
+# Output Format:
+#     CCbE/{cc}/stats.json     all the statistics of a variety
+#     CCbE/statistics.tsv      Variety  Documents  Tokens  Sentences  Types  TTR
+
+import os
+import sys
+import json
+from typing import Dict, Generator, List, Optional, Set, Tuple, Union
+
+import numpy as np
+from pebble import ProcessPool
+
+from tsv_index import IndexedTsv
+from token_table import TokenTable, load_lexicon
+
+CC_LIST = ["cn", "hk", "mo", "tw", "sg", "my"]
+MAX_WORKERS = os.cpu_count()
+# byte size of a wlp range counted by a pool task
+RANGE_BYTES = 1 << 26
+# number of documents of a token table counted by a pool task
+RANGE_DOCUMENTS = 5000
+# bytes read back to find the line before a range
+LOOKBACK_BYTES = 1 << 12
+SUMMARY_HEADER = "Variety\tDocuments\tTokens\tSentences\tTypes\tTTR\n"
+
+
+class CorpusStats:
+    """Mergeable counts of a part of a variety, `+=` another part to combine them.
+    Types are words for wlp input and WordIDs for token tables, see `type_nums`."""
+
+    def __init__(self):
+        self.documents = 0
+        self.tokens = 0
+        self.sentences = 0
+        self.types: Set[Union[bytes, int]] = set()
+        # domain / year -> [documents, tokens, sentences]
+        self.by_domain: Dict[str, List[int]] = dict()
+        self.by_year: Dict[int, List[int]] = dict()
+
+    def add_document(self, domain: str, year: int, tokens: int, sentences: int) -> None:
+        self.documents += 1
+        self.tokens += tokens
+        self.sentences += sentences
+        for counts in (self.by_domain.setdefault(domain, [0, 0, 0]), self.by_year.setdefault(year, [0, 0, 0])):
+            counts[0] += 1
+            counts[1] += tokens
+            counts[2] += sentences
+
+    def __iadd__(self, other: "CorpusStats") -> "CorpusStats":
+        self.documents += other.documents
+        self.tokens += other.tokens
+        self.sentences += other.sentences
+        self.types |= other.types
+        for mine, theirs in ((self.by_domain, other.by_domain), (self.by_year, other.by_year)):
+            for key, counts in theirs.items():
+                merged = mine.setdefault(key, [0, 0, 0])
+                for i, count in enumerate(counts):
+                    merged[i] += count
+        return self
+
+    def type_nums(self, wordid2word: Optional[Dict[int, str]] = None) -> int:
+        """Number of distinct words, WordIDs are mapped to their words if a lexicon is given."""
+        if wordid2word is None:
+            return len(self.types)
+        return len({wordid2word[word_id] for word_id in self.types})
+
+    def to_dict(self, type_nums: int) -> Dict:
+        return {
+            "documents": self.documents,
+            "tokens": self.tokens,
+            "sentences": self.sentences,
+            "types": type_nums,
+            "ttr": type_nums / self.tokens if self.tokens else 0.0,
+            "by_domain": {domain: dict(zip(("documents", "tokens", "sentences"), counts))
+                          for domain, counts in sorted(self.by_domain.items(), key=lambda item: -item[1][1])},
+            "by_year": {str(year) if year else "NULL": dict(zip(("documents", "tokens", "sentences"), counts))
+                        for year, counts in sorted(self.by_year.items())},
+        }
+
+
+def get_domain_and_year(sources: Optional[IndexedTsv], text_id: str) -> Tuple[str, int]:
+    i = sources.locate(text_id) if sources is not None else None
+    if i is None:
+        return "NULL", 0
+    return sources.domain_of(i), sources.year_of(i)
+
+
+def open_sources(sources_path: str) -> Optional[IndexedTsv]:
+    return IndexedTsv(sources_path) if os.path.exists(sources_path) else None
+
+
+def split_wlp_ranges(wlp_path: str, range_bytes: int = RANGE_BYTES) -> List[Tuple[int, int]]:
+    size = os.path.getsize(wlp_path)
+    return [(start, min(start + range_bytes, size)) for start in range(0, size, range_bytes)]
+
+
+def iter_wlp_documents(wlp_path: str, start: int, end: int) -> Generator[Tuple[str, List[List[bytes]]], None, None]:
+    """Documents whose first row starts in the byte range `[start, end)`, as `(TextID, rows)`.
+    Rows of a document are contiguous in wlp, so the rows of a document crossing `end` are read on."""
+    with open(wlp_path, "rb") as f:
+        previous = None
+        if start > 0:
+            f.seek(start - 1)
+            f.readline()  # the line across `start` belongs to the previous range
+            pos = f.tell()
+            lookback = max(0, pos - LOOKBACK_BYTES)
+            f.seek(lookback)
+            lines = f.read(pos - lookback).split(b"\n")
+            previous = lines[-2].split(b'\t', 1)[0] if len(lines) > 1 else None  # TextID of the row before `pos`
+        else:
+            pos = 0
+        text_id, rows = None, list()
+        for line in f:
+            fields = line.rstrip(b"\r\n").split(b'\t')
+            if fields[0] != text_id:
+                if pos >= end:
+                    break
+                if rows:
+                    yield text_id.decode("utf-8"), rows
+                text_id, rows = fields[0], list()
+            pos += len(line)
+            if text_id == previous or not text_id.isdigit():  # rest of the previous range's document, or header
+                continue
+            rows.append(fields)
+        if rows:
+            yield text_id.decode("utf-8"), rows
+
+
+def count_wlp_range(wlp_path: str, sources_path: str, start: int, end: int) -> CorpusStats:
+    """Count the documents of a wlp byte range, run in a pool worker."""
+    stats = CorpusStats()
+    sources = open_sources(sources_path)
+    for text_id, rows in iter_wlp_documents(wlp_path, start, end):
+        # TextID  SequenceWordID  Word  Lemma  PoS  Tag  IsStopWord  IsSentenceStart  IsSentenceEnd
+        sentences = sum(1 for fields in rows if len(fields) > 7 and fields[7] == b"True")
+        stats.types.update(fields[2] for fields in rows if len(fields) > 2)
+        stats.add_document(*get_domain_and_year(sources, text_id), len(rows), sentences)
+    if sources is not None:
+        sources.close()
+    return stats
+
+
+def count_table_range(table_dir: str, sources_path: str, start: int, end: int) -> CorpusStats:
+    """Count the documents `[start, end)` of a token table, run in a pool worker."""
+    stats = CorpusStats()
+    sources = open_sources(sources_path)
+    with TokenTable(table_dir) as table:
+        first, last = table.offsets[start], table.offsets[end]
+        if last > first:
+            stats.types.update(np.unique(TokenTable.as_numpy(table.word_ids[first:last])).tolist())
+            # unpack the sentence start bits of the whole range, then sum them per document
+            bits = np.unpackbits(TokenTable.as_numpy(table.flags["is_sent_start"][first >> 3:(last + 7) >> 3]), bitorder="little")
+            shift = first & 7
+            bits = bits[shift:shift + last - first]
+        else:
+            bits = np.zeros(0, dtype=np.uint8)
+        for index in range(start, end):
+            doc_start, doc_end = table.offsets[index] - first, table.offsets[index + 1] - first
+            sentences = int(bits[doc_start:doc_end].sum(dtype=np.int64))
+            stats.add_document(*get_domain_and_year(sources, table.text_ids[index]), doc_end - doc_start, sentences)
+    if sources is not None:
+        sources.close()
+    return stats
+
+
+def schedule_variety(cc: str, pool: ProcessPool) -> Optional[List]:
+    """Schedule counting the ranges of a variety, from its token table if present, else from its wlp file."""
+    cc_dir = f"CCbE/{cc}"
+    table_dir, wlp_path, sources_path = f"{cc_dir}/table", f"{cc_dir}/wlp.tsv", f"{cc_dir}/sources.tsv"
+    if os.path.exists(sources_path):
+        IndexedTsv(sources_path).close()  # build a stale index once, before workers open it
+    if os.path.isdir(table_dir):
+        with TokenTable(table_dir) as table:
+            doc_nums = len(table)
+        futures = [pool.schedule(count_table_range, [table_dir, sources_path, start, min(start + RANGE_DOCUMENTS, doc_nums)])
+                   for start in range(0, doc_nums, RANGE_DOCUMENTS)]
+    elif os.path.exists(wlp_path):
+        futures = [pool.schedule(count_wlp_range, [wlp_path, sources_path, start, end]) for start, end in split_wlp_ranges(wlp_path)]
+    else:
+        return None
+    return futures
+
+
+def finish_variety(cc: str, futures: List) -> Dict:
+    """Merge the partial statistics of a variety and write them."""
+    cc_dir = f"CCbE/{cc}"
+    table_dir = f"{cc_dir}/table"
+    stats = CorpusStats()
+    for future in futures:
+        stats += future.result()
+    wordid2word = None
+    if os.path.isdir(table_dir):
+        wordid2word = {word_id: wlpt[0] for word_id, wlpt in load_lexicon(f"{cc_dir}/lexicon.tsv").items()}
+    result = stats.to_dict(stats.type_nums(wordid2word))
+    with open(f"{cc_dir}/stats.json.tmp", "w") as fw:
+        json.dump(result, fw, indent=2)
+    os.replace(f"{cc_dir}/stats.json.tmp", f"{cc_dir}/stats.json")
+
+    return result
+
+
+def corpus_statistics(cc_list: Optional[List[str]] = None, max_workers: int = MAX_WORKERS) -> Dict[str, Dict]:
+    """Statistics of all the varieties, written to `CCbE/{cc}/stats.json` and summarized in `CCbE/statistics.tsv`."""
+    cc2stats = dict()
+    with ProcessPool(max_workers=max_workers) as pool:
+        cc2futures = {cc: schedule_variety(cc, pool) for cc in cc_list or CC_LIST}
+        for cc, futures in cc2futures.items():
+            if futures is not None:
+                result = cc2stats[cc] = finish_variety(cc, futures)
+                print(f"[{cc}] {result['documents']} documents, {result['tokens']} tokens, {result['sentences']} sentences, "
+                      f"{result['types']} types, TTR {result['ttr']:.4f}")
+
+    with open("CCbE/statistics.tsv.tmp", "w") as fw:
+        fw.write(SUMMARY_HEADER)
+        for cc, result in cc2stats.items():
+            fw.write(f"{cc}\t{result['documents']}\t{result['tokens']}\t{result['sentences']}\t{result['types']}\t{result['ttr']:.4f}\n")
+    os.replace("CCbE/statistics.tsv.tmp", "CCbE/statistics.tsv")
+
+    return cc2stats
+
+
+if __name__ == "__main__":
+    # usage: python corpus_stats.py [cc ...]
+    corpus_statistics(sys.argv[1:] or None)
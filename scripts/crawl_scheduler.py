@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+# @author: YangLiu
+# @email: yangliu.real@gmail.com
+
+# Politeness-aware scheduler for the asyncio crawler.
+# 1. Each host owns a token bucket (requests per second & burst) and an in-flight cap,
+#    hosts answering 429 / 503 are backed off exponentially, and their throttled urls are
+#    requeued behind the backoff, up to `MAX_THROTTLED_RETRIES` times. As urls may wait long in
+#    the queue of a backed-off host, the claims of all the urls held are renewed periodically.
+# 2. Ready hosts are kept in a heap ordered by the time they may be requested again, and
+#    fetches are launched continuously as soon as a slot frees up, instead of waiting for
+#    a whole BFS level, so a slow host never blocks the others.
+# 3. Global concurrency follows AIMD on observed latency and error rate.
+# The scheduler only sees URLs and an async `fetch` callable, so it runs the same against
+# real sites or a local mock HTTP server.
+
+import heapq
+import asyncio
+from time import monotonic
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+# requests per second allowed to each host
+HOST_RATE = 1.0
+# requests a host may receive at once after being idle
+HOST_BURST = 2
+# concurrent requests allowed to each host
+HOST_MAX_IN_FLIGHT = 2
+# longest backoff in seconds for a throttling host
+MAX_BACKOFF = 300
+# times a throttled url is requeued before being completed as an error
+MAX_THROTTLED_RETRIES = 5
+# seconds between two renewals of the claims of the urls held, well below the frontier lease
+RENEW_SECONDS = 60
+
+
+class HostThrottled(Exception):
+    """Raised by `fetch` when a host answers 429 / 503, to back the host off."""
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float = HOST_RATE, burst: int = HOST_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds to wait before a token is available."""
+        self._refill(now)
+        return max(self.blocked_until - now, (1 - self.tokens) / self.rate if self.tokens < 1 else 0.0, 0.0)
+
+    def acquire(self, now: float) -> bool:
+        if self.wait_time(now) > 0:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class AdaptiveLimit:
+    """Global concurrency limit, additive increase while healthy and multiplicative decrease
+    when the median latency or error rate of the last `window` fetches exceeds its target."""
+
+    def __init__(self, initial: int = 30, minimum: int = 4, maximum: int = 256,
+                 target_latency: float = 3.0, max_error_rate: float = 0.2, window: int = 50):
+        self.value = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+        self.window = window
+        self.samples: List[Tuple[float, bool]] = list()
+
+    def record(self, latency: float, ok: bool) -> None:
+        self.samples.append((latency, ok))
+        if len(self.samples) < self.window:
+            return
+        latencies = sorted(latency for latency, _ in self.samples)
+        median = latencies[len(latencies) // 2]
+        error_rate = sum(1 for _, ok in self.samples if not ok) / len(self.samples)
+        if median > self.target_latency or error_rate > self.max_error_rate:
+            self.value = max(self.minimum, int(self.value * 0.7))
+        else:
+            self.value = min(self.maximum, self.value + 2)
+        self.samples = list()
+
+
+class HostState:
+
+    def __init__(self, rate: float, burst: int):
+        self.queue: Deque[Tuple[str, Any]] = deque()
+        self.bucket = TokenBucket(rate, burst)
+        self.in_flight = 0
+        self.scheduled = False
+        self.backoff = 0.0
+        self.retries: Dict[str, int] = dict()
+
+
+class HostScheduler:
+    """Per-host politeness scheduler with continuous pipelining.
+
+    Usage
+    -----
+    scheduler = HostScheduler()
+    await scheduler.run(fetch, claim, complete, is_drained)
+    where
+        fetch(url) -> result                  async, raise to report an error, `HostThrottled` to back off and retry
+        claim(n) -> [(url, payload), ...]     refill, e.g. from the frontier, [] when nothing is ready
+        complete(url, payload, result)        called with None as result on error
+        is_drained() -> bool                  whether no more urls will ever be claimable
+        renew([url, ...])                     optional, called every `renew_every` seconds with the urls
+                                              buffered or in flight, e.g. to renew their frontier lease
+    """
+
+    def __init__(self, rate: float = HOST_RATE, burst: int = HOST_BURST, max_in_flight: int = HOST_MAX_IN_FLIGHT,
+                 limit: Optional[AdaptiveLimit] = None, get_host: Optional[Callable[[str], str]] = None):
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.limit = limit or AdaptiveLimit()
+        self.get_host = get_host or (lambda url: url.split("://", 1)[-1].split("/", 1)[0].lower())
+        self.hosts: Dict[str, HostState] = dict()
+        self.heap: List[Tuple[float, int, str]] = list()
+        self.seq = 0
+        self.buffered = 0
+        self.fetching: Set[str] = set()
+        self.stats = {"fetched": 0, "errors": 0, "throttled": 0}
+
+    def _schedule(self, host: str, state: HostState, now: float) -> None:
+        if state.scheduled or not state.queue or state.in_flight >= self.max_in_flight:
+            return
+        state.scheduled = True
+        self.seq += 1
+        heapq.heappush(self.heap, (now + state.bucket.wait_time(now), self.seq, host))
+
+    def push(self, url: str, payload: Any = None) -> None:
+        host = self.get_host(url)
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = HostState(self.rate, self.burst)
+        state.queue.append((url, payload))
+        self.buffered += 1
+        self._schedule(host, state, monotonic())
+
+    def pop_ready(self) -> Tuple[Optional[Tuple[str, str, Any]], Optional[float]]:
+        """Take a url whose host may be requested now.
+
+        Returns
+        -------
+        `(host, url, payload)` or None, and seconds until the next host gets ready if none is
+        """
+        now = monotonic()
+        while self.heap:
+            ready_at, _, host = self.heap[0]
+            if ready_at > now:
+                return None, ready_at - now
+            heapq.heappop(self.heap)
+            state = self.hosts[host]
+            state.scheduled = False
+            if not state.queue or state.in_flight >= self.max_in_flight:
+                continue  # rescheduled when one of its requests completes
+            if not state.bucket.acquire(now):
+                self._schedule(host, state, now)
+                continue
+            url, payload = state.queue.popleft()
+            state.in_flight += 1
+            self.fetching.add(url)
+            self.buffered -= 1
+            self._schedule(host, state, now)
+            return (host, url, payload), None
+        return None, None
+
+    async def _fetch(self, host: str, url: str, payload: Any, fetch: Callable[[str], Awaitable[Any]],
+                     complete: Callable[[str, Any, Any], None]) -> None:
+        state = self.hosts[host]
+        begin = monotonic()
+        result, ok, requeued = None, False, False
+        try:
+            result, ok = await fetch(url), True
+            state.backoff = 0.0
+        except HostThrottled:
+            self.stats["throttled"] += 1
+            state.backoff = min(MAX_BACKOFF, max(1.0, state.backoff * 2))
+            state.bucket.blocked_until = monotonic() + state.backoff
+            retries = state.retries.get(url, 0)
+            if retries < MAX_THROTTLED_RETRIES:
+                state.retries[url] = retries + 1
+                state.queue.appendleft((url, payload))  # fetched again once the backoff is over
+                self.buffered += 1
+                requeued = True
+        except Exception:
+            pass
+        finally:
+            self.limit.record(monotonic() - begin, ok)
+            if not requeued:
+                self.stats["fetched" if ok else "errors"] += 1
+            state.in_flight -= 1
+            self.fetching.discard(url)
+            self._schedule(host, state, monotonic())
+        if not requeued:
+            state.retries.pop(url, None)
+            complete(url, payload, result)
+
+    def held_urls(self) -> List[str]:
+        """Urls buffered in the host queues or being fetched."""
+        return [url for state in self.hosts.values() for url, _ in state.queue] + list(self.fetching)
+
+    async def run(self, fetch: Callable[[str], Awaitable[Any]], claim: Callable[[int], List[Tuple[str, Any]]],
+                  complete: Callable[[str, Any, Any], None], is_drained: Callable[[], bool], idle: float = 1.0,
+                  renew: Optional[Callable[[List[str]], None]] = None, renew_every: float = RENEW_SECONDS) -> Dict[str, int]:
+        tasks = set()
+        renewed_at = monotonic()
+        while True:
+            if renew is not None and monotonic() - renewed_at >= renew_every:
+                renew(self.held_urls())
+                renewed_at = monotonic()
+            if self.buffered < 2 * self.limit.value:
+                for url, payload in claim(4 * self.limit.value):
+                    self.push(url, payload)
+            wait = None
+            while len(tasks) < self.limit.value:
+                item, wait = self.pop_ready()
+                if item is None:
+                    break
+                tasks.add(asyncio.create_task(self._fetch(*item, fetch, complete)))
+            if not tasks and self.buffered == 0:
+                if is_drained():
+                    break
+                await asyncio.sleep(idle)  # others may still produce urls to claim
+                continue
+            timeout = idle if wait is None else min(wait, idle)
+            if tasks:
+                done, tasks = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()  # re-raise errors of `complete`
+            else:
+                await asyncio.sleep(timeout)
+
+        return self.stats
@@ -22,17 +22,43 @@
 #     include TextID, Words, Country, Genre, URL, Title, Content, totally 7 columns.
 
 
+import io
 import os
+import json
+import shutil
+from array import array
 from glob import glob
 from os.path import isdir
-from typing import List
+from time import perf_counter, time
+from concurrent.futures import as_completed
+from typing import Dict, Generator, Iterable, List, TextIO, Tuple
 
-import spacy
+from pebble import ProcessPool
+
+import metrics
+from token_table import TokenTableWriter
 
 # metadata tsv files' directory
 METADATA_DIR = "merge"
 SLIDING_WINDOW_SIZE = 21
-PIPELINE = spacy.load("en_core_web_sm")
+SPACY_MODEL = "en_core_web_sm"
+# pipeline components whose output is never written to wlp
+UNUSED_PIPES = ["ner"]
+# spaCy pipeline of current process, loaded on first use by `get_pipeline`
+PIPELINE = None
+# number of documents buffered per `nlp.pipe` batch
+BATCH_SIZE = 64
+# number of annotation processes, -1 for all the cores
+N_PROCESS = 1
+# number of documents per TextID-range shard
+SHARD_SIZE = 2000
+# number of shards annotated in parallel
+MAX_WORKERS = os.cpu_count()
+# number of tokens buffered in memory before spilling their ids to disk
+SPILL_SIZE = 1 << 20
+# format of the token-level output: `tsv` for db.tsv, `binary` for a token table, or `both`
+OUTPUT_FORMAT = "tsv"
+WLP_HEADER = f"TextID\tSequenceWordID\tWord\tLemma\tPoS\tTag\tIsStopWord\tIsSentenceStart\tIsSentenceEnd\n"
 
 
 def get_split_line(header: str) -> str:
@@ -44,8 +70,68 @@ def get_split_line(header: str) -> str:
     return f"{split_line}\n"
 
 
-def generate_wlp_file(cc: str, file_path: str) -> str:
+def get_pipeline():
+    """spaCy pipeline of current process, spaCy is imported and the model loaded on first call only."""
+    global PIPELINE
+    if PIPELINE is None:
+        begin = time()
+        import spacy
+        PIPELINE = spacy.load(SPACY_MODEL, exclude=UNUSED_PIPES)
+        print(f"[pid:{os.getpid()}] loaded spaCy {SPACY_MODEL} in {time() - begin:.2f}s")
+    return PIPELINE
+
+
+def init_worker() -> None:
+    """Pool initializer, load the pipeline once per worker process before it takes any shard."""
+    get_pipeline()
+
+
+def iter_documents(lines: Iterable[str], skip_header: bool = True) -> Generator[Tuple[str, str], None, None]:
+    """Yield `(full_text, textid)` pairs from metadata tsv lines."""
+    for idx, line in enumerate(lines):
+        if idx == 0 and skip_header:
+            continue
+        textid = line.split('\t')[0]
+        full_text = line.split('\t')[-1]
+        yield full_text, textid
+
+
+def write_wlp_rows(fw: TextIO, docs: Iterable[Tuple[str, str]], batch_size: int = BATCH_SIZE, n_process: int = N_PROCESS) -> Tuple[int, int]:
+    """Annotate `(full_text, textid)` pairs with `nlp.pipe` and write their wlp rows.
+    Documents come out of `nlp.pipe` in input order, so rows keep the TextID order
+    of the input even with multiple processes.
+
+    Returns
+    -------
+    number of documents and number of written tokens
+    """
+    doc_nums, token_nums = 0, 0
+    last = perf_counter()
+    for doc, textid in get_pipeline().pipe(docs, as_tuples=True, batch_size=batch_size, n_process=n_process):
+        # time spent by `nlp.pipe` on this document, amortized over its batch
+        now = perf_counter()
+        metrics.observe("annotate.doc_seconds", now - last)
+        last = now
+        doc_tokens = token_nums
+        for token in doc:
+            # SequenceWordID	Word	Lemma	PoS	Tag	IsStopWord	IsSentenceStart	IsSentenceEnd
+            new_line = f"{textid}\t{str(token.i).zfill(9)}\t{token.text}\t{token.lemma_}\t{token.pos_}\t{token.tag_}\t{token.is_stop}\t{token.is_sent_start}\t{token.is_sent_end}\n"
+            if "SPACE" in new_line and "_SP" in new_line:
+                continue
+            # print(new_line, end="")
+            fw.write(new_line)
+            token_nums += 1
+        doc_nums += 1
+        metrics.incr("annotate.tokens", token_nums - doc_tokens)
+        last = perf_counter()
+
+    return doc_nums, token_nums
+
+
+def generate_wlp_file(cc: str, file_path: str, batch_size: int = BATCH_SIZE, n_process: int = N_PROCESS) -> str:
     """Generate word-lemma-pos file.
+    Metadata lines are streamed into `nlp.pipe` in batches of `batch_size`
+    and annotated by `n_process` processes.
 
     Output Format
     -------------
@@ -54,25 +140,16 @@ def generate_wlp_file(cc: str, file_path: str) -> str:
     wlp_file_path = f"CCbE/{cc}/wlp.tsv"
 
     with open(file_path, "r") as fr, \
-            open(wlp_file_path, "a+") as fw:
-        lines = fr.readlines()
-        header = f"TextID\tSequenceWordID\tWord\tLemma\tPoS\tTag\tIsStopWord\tIsSentenceStart\tIsSentenceEnd\n"
+            open(f"{wlp_file_path}.tmp", "w") as fw:
+        header = WLP_HEADER
         # print(header, end="")
         fw.write(header)
         fw.write(get_split_line(header))
-        for idx, line in enumerate(lines):
-            if idx == 0:
-                continue
-            textid = line.split('\t')[0]
-            full_text = line.split('\t')[-1]
-            doc = PIPELINE(full_text)
-            for token in doc:
-                # SequenceWordID	Word	Lemma	PoS	Tag	IsStopWord	IsSentenceStart	IsSentenceEnd
-                new_line = f"{textid}\t{str(token.i).zfill(9)}\t{token.text}\t{token.lemma_}\t{token.pos_}\t{token.tag_}\t{token.is_stop}\t{token.is_sent_start}\t{token.is_sent_end}\n"
-                if "SPACE" in new_line and "_SP" in new_line:
-                    continue
-                # print(new_line, end="")
-                fw.write(new_line)
+        begin = time()
+        doc_nums, token_nums = write_wlp_rows(fw, iter_documents(fr), batch_size, n_process)
+        elapsed = max(time() - begin, 1e-9)
+        print(f"[{cc}] annotated {doc_nums} docs, {token_nums} tokens in {round(elapsed)}s ({round(token_nums / elapsed)} tokens/sec)")
+    os.replace(f"{wlp_file_path}.tmp", wlp_file_path)
 
     return wlp_file_path
 
@@ -100,7 +177,7 @@ def generate_lexicon_file(cc: str, wlp_file_path: str) -> str:
 
     sorted_pairs = sorted(wlpt2freq.items(), key=lambda item: item[1], reverse=True)
 
-    with open(lexicon_file_path, "a+") as fw:
+    with open(f"{lexicon_file_path}.tmp", "w") as fw:
         header = f"WordID\tFreq\tWord\tLemma\tPoS\tTag\n"
         # print(header, end="")
         fw.write(header)
@@ -112,6 +189,7 @@ def generate_lexicon_file(cc: str, wlp_file_path: str) -> str:
             line = f"{word_id}\t{freq}\t{word}\t{lemma}\t{pos}\t{tag}\n"
             # print(line, end="\n")
             fw.write(line)
+    os.replace(f"{lexicon_file_path}.tmp", lexicon_file_path)
 
     return lexicon_file_path
 
@@ -133,7 +211,7 @@ def generate_db_file(cc: str, wlp_file_path: str, lexicon_file_path: str) -> str
             wlpt2wordid[wlpt] = word_id
 
     with open(wlp_file_path, "r") as fr, \
-            open(db_file_path, "a+") as fw:
+            open(f"{db_file_path}.tmp", "w") as fw:
         header = f"TextID\tSequenceWordID\tWordID\n"
         fw.write(header)
         fw.write(get_split_line(header))
@@ -144,10 +222,113 @@ def generate_db_file(cc: str, wlp_file_path: str, lexicon_file_path: str) -> str
             wlpt = f"{word}\t{lemma}\t{pos}\t{tag}"
             word_id = wlpt2wordid[wlpt] if wlpt in wlpt2wordid else "OOV"
             fw.write(f"{text_id}\t{sequence_word_id}\t{word_id}\n")
+    os.replace(f"{db_file_path}.tmp", db_file_path)
 
     return db_file_path
 
 
+def generate_lexicon_and_db_files(cc: str, wlp_file_path: str, output_format: str = OUTPUT_FORMAT) -> Tuple[str, str]:
+    """Generate lexicon and db files in a single pass over wlp.
+    Each distinct `Word + Lemma + PoS + Tag` is interned to an integer id at its first
+    occurrence, and the `(id, SequenceWordID, flags)` triples of all tokens are spilled
+    to disk in chunks. Once all the frequencies are known, ids are remapped to
+    frequency-ranked WordIDs and db is emitted from the spill file instead of a second
+    scan of wlp, as `db.tsv`, as a binary token table under `table/` (see `token_table`),
+    or both according to `output_format`.
+
+    Output Format
+    -------------
+    lexicon: WordID  Freq    Word    Lemma   PoS Tag
+    db: TextID  SequenceWordID  WordID
+    """
+    if output_format not in ("tsv", "binary", "both"):
+        raise ValueError(f"unknown output format: {output_format}")
+    wlpt2id = dict()
+    freqs = list()
+    doc_runs = list()  # [TextID, number of tokens] for each document, in wlp order
+    tokens = array("I")
+    lexicon_file_path = f"CCbE/{cc}/lexicon.tsv"
+    db_file_path = f"CCbE/{cc}/db.tsv"
+    table_dir = f"CCbE/{cc}/table"
+    spill_file_path = f"CCbE/{cc}/db.spill"
+
+    idx = 0
+    with open(wlp_file_path, "r") as fr, \
+            open(spill_file_path, "wb") as fs:
+        for idx, line in enumerate(fr):
+            if idx == 0 or idx == 1:
+                continue
+            text_id, sequence_word_id, word, lemma, pos, tag, is_stop, is_sent_start, is_sent_end = line.split('\t')
+            wlpt = (word, lemma, pos, tag)
+            wlpt_id = wlpt2id.get(wlpt)
+            if wlpt_id is None:
+                wlpt_id = wlpt2id[wlpt] = len(freqs)
+                freqs.append(0)
+            freqs[wlpt_id] += 1
+            if doc_runs and doc_runs[-1][0] == text_id:
+                doc_runs[-1][1] += 1
+            else:
+                doc_runs.append([text_id, 1])
+            tokens.append(wlpt_id)
+            tokens.append(int(sequence_word_id))
+            tokens.append((is_stop == "True") | (is_sent_start == "True") << 1 | (is_sent_end.rstrip() == "True") << 2)
+            if len(tokens) >= 3 * SPILL_SIZE:
+                tokens.tofile(fs)
+                del tokens[:]
+        tokens.tofile(fs)
+        del tokens[:]
+    metrics.incr("lexicon.lines", max(idx - 1, 0))
+    metrics.incr("lexicon.types", len(freqs))
+
+    # same order as sorting by frequency, ties keep their first occurrence order
+    wlpts = list(wlpt2id)
+    del wlpt2id
+    ranking = sorted(range(len(freqs)), key=freqs.__getitem__, reverse=True)
+    id2wordid = array("I", bytes(4 * len(freqs)))
+
+    with open(f"{lexicon_file_path}.tmp", "w") as fw:
+        header = f"WordID\tFreq\tWord\tLemma\tPoS\tTag\n"
+        fw.write(header)
+        fw.write(get_split_line(header))
+        for word_id, wlpt_id in enumerate(ranking, start=1):
+            id2wordid[wlpt_id] = word_id
+            word, lemma, pos, tag = wlpts[wlpt_id]
+            fw.write(f"{word_id}\t{freqs[wlpt_id]}\t{word}\t{lemma}\t{pos}\t{tag}\n")
+    os.replace(f"{lexicon_file_path}.tmp", lexicon_file_path)
+    del wlpts, ranking
+
+    fw = open(f"{db_file_path}.tmp", "w") if output_format != "binary" else None
+    table_writer = TokenTableWriter(table_dir) if output_format != "tsv" else None
+    with open(spill_file_path, "rb") as fs:
+        if fw is not None:
+            header = f"TextID\tSequenceWordID\tWordID\n"
+            fw.write(header)
+            fw.write(get_split_line(header))
+        pos = 0
+        for text_id, token_nums in doc_runs:
+            if table_writer is not None:
+                table_writer.add_document(text_id)
+            for _ in range(token_nums):
+                if pos == len(tokens):
+                    del tokens[:]
+                    tokens.frombytes(fs.read(12 * SPILL_SIZE))
+                    pos = 0
+                wlpt_id, sequence_word_id, flags = tokens[pos], tokens[pos + 1], tokens[pos + 2]
+                pos += 3
+                if fw is not None:
+                    fw.write(f"{text_id}\t{str(sequence_word_id).zfill(9)}\t{id2wordid[wlpt_id]}\n")
+                if table_writer is not None:
+                    table_writer.add_token(id2wordid[wlpt_id], sequence_word_id, flags)
+    if fw is not None:
+        fw.close()
+        os.replace(f"{db_file_path}.tmp", db_file_path)
+    if table_writer is not None:
+        table_writer.close()
+    os.remove(spill_file_path)
+
+    return lexicon_file_path, db_file_path if output_format != "binary" else table_dir
+
+
 def generate_sources_file(cc: str, db_file_path: str) -> str:
     """Generate sources file.
 
@@ -287,21 +468,16 @@ def preprocess(file_path: str):
     cc = file_path.split('.')[-2]
     cc_dir = f"CCbE/{cc}"
 
-    if not os.path.isdir(cc_dir):
-        os.mkdir(cc_dir)
-    else:
-        os.rmdir(cc_dir)
+    os.makedirs(cc_dir, exist_ok=True)
 
     wlp_file_path = generate_wlp_file(cc, file_path)
     # wlp_file_path = f"CCbE/wlp.mo.tsv"
     print(wlp_file_path, "=> ", end="")
 
-    lexicon_file_path = generate_lexicon_file(cc, wlp_file_path)
+    lexicon_file_path, db_file_path = generate_lexicon_and_db_files(cc, wlp_file_path)
     # lexicon_file_path = f"CCbE/lexicon.mo.tsv"
-    print(lexicon_file_path, "=> ", end="")
-
-    db_file_path = generate_db_file(cc, wlp_file_path, lexicon_file_path)
     # db_file_path = f"CCbE/db.mo.tsv"
+    print(lexicon_file_path, "=> ", end="")
     print(db_file_path, "=> ", end="")
 
     sources_file_path = generate_sources_file(cc, db_file_path)
@@ -310,8 +486,152 @@ def preprocess(file_path: str):
     print(f"{cc} done.")
 
 
+def plan_shards(file_path: str, shard_size: int = SHARD_SIZE) -> List[Dict]:
+    """Split a metadata tsv into TextID-range shards of `shard_size` documents.
+    Each shard records the byte range of its lines, header excluded."""
+    shards = list()
+    with open(file_path, "rb") as fr:
+        fr.readline()  # skip header
+        start = fr.tell()
+        first_textid, last_textid, doc_nums = None, None, 0
+        for line in iter(fr.readline, b""):
+            last_textid = line.split(b'\t', 1)[0].decode("utf-8")
+            first_textid = last_textid if first_textid is None else first_textid
+            doc_nums += 1
+            if doc_nums == shard_size:
+                end = fr.tell()
+                shards.append({"index": len(shards), "first": first_textid, "last": last_textid, "start": start, "end": end})
+                start, first_textid, doc_nums = end, None, 0
+        if doc_nums > 0:
+            shards.append({"index": len(shards), "first": first_textid, "last": last_textid, "start": start, "end": fr.tell()})
+
+    return shards
+
+
+def get_shard_path(shard_dir: str, shard: Dict) -> str:
+    return f"{shard_dir}/wlp.{str(shard['index']).zfill(5)}.tsv"
+
+
+def annotate_shard(file_path: str, shard: Dict, shard_path: str, batch_size: int = BATCH_SIZE) -> Tuple[int, int, int]:
+    """Annotate a single shard into headless wlp rows, written atomically to `shard_path`."""
+    with open(file_path, "rb") as fr:
+        fr.seek(shard["start"])
+        chunk = fr.read(shard["end"] - shard["start"]).decode("utf-8")
+
+    with metrics.timer("annotate.shard_seconds"), open(f"{shard_path}.tmp", "w") as fw:
+        # universal newlines, same line splitting as reading the tsv in text mode
+        lines = io.StringIO(chunk, newline=None)
+        doc_nums, token_nums = write_wlp_rows(fw, iter_documents(lines, skip_header=False), batch_size, 1)
+    os.replace(f"{shard_path}.tmp", shard_path)
+    metrics.incr("annotate.shards")
+    metrics.incr("annotate.documents", doc_nums)
+    metrics.flush()  # pool workers exit without running atexit
+
+    return shard["index"], doc_nums, token_nums
+
+
+def load_manifest(manifest_path: str, file_path: str, shard_size: int = SHARD_SIZE) -> Dict:
+    """Load the checkpoint manifest of a variety, re-planning it if the input has changed."""
+    stat = os.stat(file_path)
+    source = {"path": file_path, "size": stat.st_size, "mtime": stat.st_mtime, "shard_size": shard_size}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+        if manifest["source"] == source:
+            return manifest
+
+    return {"source": source, "shards": plan_shards(file_path, shard_size), "done": [], "stages": []}
+
+
+def save_manifest(manifest_path: str, manifest: Dict) -> None:
+    with open(f"{manifest_path}.tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
+
+def merge_shards(cc: str, shards: List[Dict], shard_dir: str) -> str:
+    """Concatenate shard files in TextID order into the final wlp file."""
+    wlp_file_path = f"CCbE/{cc}/wlp.tsv"
+
+    with open(f"{wlp_file_path}.tmp", "w") as fw:
+        fw.write(WLP_HEADER)
+        fw.write(get_split_line(WLP_HEADER))
+        fw.flush()
+        for shard in shards:
+            with open(get_shard_path(shard_dir, shard), "r") as fr:
+                shutil.copyfileobj(fr, fw)
+    os.replace(f"{wlp_file_path}.tmp", wlp_file_path)
+
+    return wlp_file_path
+
+
+def preprocess_sharded(file_path: str, shard_size: int = SHARD_SIZE, max_workers: int = MAX_WORKERS, batch_size: int = BATCH_SIZE) -> bool:
+    """Resumable version of `preprocess`.
+
+    Procedure
+    ---------
+    1. Split the metadata tsv into TextID-range shards and annotate them on a process pool,
+    every finished shard is recorded in `CCbE/{cc}/manifest.json`.
+    2. Once all the shards are done, merge them in order into wlp, then generate lexicon, db and sources,
+    each finished stage is recorded in the manifest as well.
+    An interrupted run only redoes unfinished shards and stages.
+    """
+    cc = file_path.split('.')[-2]
+    cc_dir = f"CCbE/{cc}"
+    shard_dir = f"{cc_dir}/shards"
+    manifest_path = f"{cc_dir}/manifest.json"
+    os.makedirs(shard_dir, exist_ok=True)
+
+    manifest = load_manifest(manifest_path, file_path, shard_size)
+    save_manifest(manifest_path, manifest)
+    shards = manifest["shards"]
+    pending = [shard for shard in shards if shard["index"] not in manifest["done"]]
+    print(f"[{cc}] {len(shards) - len(pending)}/{len(shards)} shards done, {len(pending)} to annotate.")
+
+    if pending:
+        begin, token_nums = time(), 0
+        with ProcessPool(max_workers=max_workers, initializer=init_worker) as pool:
+            future2shard = {pool.schedule(annotate_shard, [file_path, shard, get_shard_path(shard_dir, shard), batch_size]): shard for shard in pending}
+            for future in as_completed(future2shard):
+                shard = future2shard[future]
+                try:
+                    index, _, shard_token_nums = future.result()
+                except Exception as error:
+                    print(f"[{cc}] shard {shard['index']} ({shard['first']}-{shard['last']}) raised {error}")
+                    metrics.incr("annotate.shard_errors")
+                    continue
+                token_nums += shard_token_nums
+                manifest["done"].append(index)
+                save_manifest(manifest_path, manifest)
+        elapsed = max(time() - begin, 1e-9)
+        print(f"[{cc}] annotated {token_nums} tokens in {round(elapsed)}s ({round(token_nums / elapsed)} tokens/sec)")
+
+    if len(manifest["done"]) < len(shards):
+        print(f"[{cc}] {len(shards) - len(manifest['done'])} shards failed, rerun to resume.")
+        return False
+
+    wlp_file_path = f"{cc_dir}/wlp.tsv"
+    db_file_path = f"{cc_dir}/db.tsv"
+    stages = [
+        ("wlp", lambda: merge_shards(cc, shards, shard_dir)),
+        ("lexicon+db", lambda: generate_lexicon_and_db_files(cc, wlp_file_path)),
+        ("sources", lambda: generate_sources_file(cc, db_file_path)),
+    ]
+    for stage, func in stages:
+        if stage in manifest["stages"]:
+            continue
+        with metrics.timer(f"annotate.{stage.replace('+', '_')}_seconds"):
+            print(func(), "done.")
+        manifest["stages"].append(stage)
+        save_manifest(manifest_path, manifest)
+
+    print(f"{cc} done.")
+    metrics.flush()
+    return True
+
+
 if __name__ == "__main__":
     file_path_list = glob(f"{METADATA_DIR}/*.tsv")
     for file_path in file_path_list:
-        preprocess(file_path)
+        preprocess_sharded(file_path)
     print("All done.")
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+# @author: YangLiu
+# @email: yangliu.real@gmail.com
+
+# Publish date normalization of `page_parse`, a page's time becomes `YYYY-MM-DD`, or `NULL`
+# when it can not be parsed or is out of `[MIN_YEAR, MAX_YEAR]`.
+# Crawled dates repeat a few formats, so before falling back to `dateutil.parser.parse`,
+# precompiled patterns cover:
+#     ISO 8601 dates and datetimes    2021-05-03, 2021-05-03 10:00, 2021-05-03T10:00:00.000+08:00
+#     slashed and compact dates       2021/05/03, 20210503
+#     dates with English month names  May 3, 2021 / 3 May 2021 / Monday, May 3, 2021
+# A fast path only answers when it is sure to agree with dateutil, anything else, e.g. an
+# invalid day, a time out of range or a year below 1000, goes to dateutil. Raw strings are
+# memoized, and batch normalization of a tsv `Time` column only normalizes each distinct value once:
+#     python date_norm.py {input tsv} {output tsv}
+# The agreement of the fast path with dateutil is checked on fuzzed and known tricky strings by:
+#     python date_norm.py --check [number of fuzzed strings]
+
+import os
+import re
+import sys
+import random
+import datetime
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+
+MIN_YEAR = 1985
+MAX_YEAR = 2022
+# number of memoized raw strings
+CACHE_SIZE = 1 << 16
+
+# a zone is only accepted after a time, dateutil fails on a date with a zone alone
+ISO_DATE = re.compile(r"(\d{4})-(\d{2})-(\d{2})(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.\d{1,6})?)?(Z|[+-]\d{2}:?\d{2})?)?")
+SLASHED_DATE = re.compile(r"(\d{4})/(\d{1,2})/(\d{1,2})")
+COMPACT_DATE = re.compile(r"(\d{4})(\d{2})(\d{2})")
+WEEKDAY = r"(?:(?:mon|tue|wed|thu|fri|sat|sun|monday|tuesday|wednesday|thursday|friday|saturday|sunday),?\s+)?"
+MONTH_DAY_YEAR = re.compile(WEEKDAY + r"([a-z]{3,9})\.?\s+(\d{1,2}),?\s+(\d{4})", re.IGNORECASE)
+DAY_MONTH_YEAR = re.compile(WEEKDAY + r"(\d{1,2})\s+([a-z]{3,9})\.?,?\s+(\d{4})", re.IGNORECASE)
+# strings on which a former fast path disagreed with dateutil
+TRICKY_DATES = ["2021-05-03Z", "2021-05-03+08:00", "2021-05-03-0500", "12 May 0099", "May 12, 0099", "0099-05-12",
+                "0099/05/12", "00990512", "0000-01-01", "0150-05-12T10:00:00Z"]
+MONTHS = {name: i for i, names in enumerate([("jan", "january"), ("feb", "february"), ("mar", "march"), ("apr", "april"),
+                                             ("may",), ("jun", "june"), ("jul", "july"), ("aug", "august"),
+                                             ("sep", "sept", "september"), ("oct", "october"), ("nov", "november"),
+                                             ("dec", "december")], start=1) for name in names}
+
+
+def make_date(year: str, month: str, day: str) -> Optional[str]:
+    if int(year) < 1000:
+        return None  # dateutil reads some years below 100 as two-digit years, e.g. `12 May 0099`
+    try:
+        return datetime.date(int(year), int(month), int(day)).strftime("%Y-%m-%d")
+    except ValueError:
+        return None
+
+
+def fast_parse(s: str) -> Optional[str]:
+    """`YYYY-MM-DD` of `s` by the fast path patterns, None if none of them is sure."""
+    s = s.strip()
+    match = ISO_DATE.fullmatch(s)
+    if match is not None:
+        year, month, day, hour, minute, second, zone = match.groups()
+        if hour is not None and (int(hour) > 23 or int(minute) > 59 or (second is not None and int(second) > 59)):
+            return None
+        if zone is not None and zone != "Z" and (int(zone[1:3]) > 23 or int(zone[-2:]) > 59):
+            return None
+        return make_date(year, month, day)
+    match = SLASHED_DATE.fullmatch(s) or COMPACT_DATE.fullmatch(s)
+    if match is not None:
+        return make_date(*match.groups())
+    match = MONTH_DAY_YEAR.fullmatch(s)
+    if match is not None:
+        month, day, year = match.groups()
+        return make_date(year, MONTHS[month.lower()], day) if month.lower() in MONTHS else None
+    match = DAY_MONTH_YEAR.fullmatch(s)
+    if match is not None:
+        day, month, year = match.groups()
+        return make_date(year, MONTHS[month.lower()], day) if month.lower() in MONTHS else None
+    return None
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def parse_date(s: str) -> Optional[str]:
+    """`YYYY-MM-DD` of a raw date string, None if dateutil can not parse it either."""
+    date = fast_parse(s)
+    if date is not None:
+        return date
+    from dateutil.parser import parse
+    try:
+        return parse(s).strftime("%Y-%m-%d")
+    except Exception:
+        return None
+
+
+def validate_date(time: str) -> str:
+    """`time` if it is a valid `YYYY-MM-DD` date in the year range, else `NULL`."""
+    try:
+        year, month, day = time.split('-')
+        datetime.datetime(int(year), int(month), int(day))
+    except ValueError:
+        return "NULL"
+    if int(year) < MIN_YEAR or int(year) > MAX_YEAR:
+        return "NULL"
+    return time
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def normalize_date(time: str) -> str:
+    """Normalized date of a page's raw time, `YYYY-MM-DD` or `NULL`."""
+    if time != "NULL":
+        time = parse_date(time) or time
+    return validate_date(time)
+
+
+def normalize_dates(times: Iterable[str]) -> List[str]:
+    """Normalized dates of raw times, each distinct time normalized once."""
+    time2date: Dict[str, str] = dict()
+    dates = list()
+    for time in times:
+        date = time2date.get(time)
+        if date is None:
+            date = time2date[time] = normalize_date(time)
+        dates.append(date)
+    return dates
+
+
+def normalize_time_column(input_path: str, output_path: str, column: str = "Time") -> int:
+    """Normalize the `Time` column of a tsv with a header line, written atomically to `output_path`.
+
+    Returns
+    -------
+    number of rows whose time changed
+    """
+    changed = 0
+    time2date: Dict[str, str] = dict()
+    with open(input_path, "r") as fr, open(f"{output_path}.tmp", "w") as fw:
+        header = fr.readline()
+        fw.write(header)
+        index = header.rstrip("\r\n").split("\t").index(column)
+        for line in fr:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) > index:
+                time = fields[index]
+                date = time2date.get(time)
+                if date is None:
+                    date = time2date[time] = normalize_date(time)
+                if date != time:
+                    fields[index] = date
+                    line = "\t".join(fields) + "\n"
+                    changed += 1
+            fw.write(line)
+    os.replace(f"{output_path}.tmp", output_path)
+
+    return changed
+
+
+def fuzz_dates(n: int, seed: int = 0) -> List[str]:
+    """Random strings in the fast path formats, with invalid fields, years and zones mixed in."""
+    rng = random.Random(seed)
+    month_names = list(MONTHS) + ["Mai", "Sept.", "Foo"]
+    dates = list()
+    for _ in range(n):
+        year = rng.choice([f"{rng.randint(1980, 2030)}", f"{rng.randint(0, 1200):04d}"])
+        month, day = f"{rng.randint(0, 13):02d}", f"{rng.randint(0, 32):02d}"
+        time = rng.choice(["", f"T{rng.randint(0, 25):02d}:{rng.randint(0, 61):02d}", f" {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 60):02d}.123"])
+        zone = rng.choice(["", "Z", "+08:00", "-0500", "+25:00"])
+        name = rng.choice(month_names)
+        dates.append(rng.choice([
+            f"{year}-{month}-{day}{time}{zone}",
+            f"{year}/{int(month)}/{int(day)}",
+            f"{year}{month}{day}",
+            f"{rng.choice(['', 'Monday, '])}{name} {int(day)}, {year}",
+            f"{int(day)} {name.capitalize()} {year}",
+        ]))
+    return dates
+
+
+def check_fast_path(dates: Iterable[str]) -> List[Tuple[str, Optional[str], Optional[str]]]:
+    """Strings on which the fast path answers but disagrees with dateutil.
+
+    Returns
+    -------
+    `(raw string, fast path date, dateutil date)` of each disagreement
+    """
+    from dateutil.parser import parse
+    mismatches = list()
+    for s in dates:
+        date = fast_parse(s)
+        if date is None:
+            continue
+        try:
+            expected = parse(s).strftime("%Y-%m-%d")
+        except Exception:
+            expected = None
+        if date != expected:
+            mismatches.append((s, date, expected))
+    return mismatches
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == "--check":
+        # usage: python date_norm.py --check [number of fuzzed strings]
+        dates = TRICKY_DATES + fuzz_dates(int(sys.argv[2]) if len(sys.argv) > 2 else 100000)
+        mismatches = check_fast_path(dates)
+        for mismatch in mismatches[:20]:
+            print(mismatch)
+        print(f"{len(mismatches)} disagreements with dateutil on {len(dates)} strings.")
+        sys.exit(1 if mismatches else 0)
+    # usage: python date_norm.py {input tsv} {output tsv}
+    print(f"{normalize_time_column(sys.argv[1], sys.argv[2])} times normalized.")
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# @author: YangLiu
+# @email: yangliu.real@gmail.com
+
+# Persistent cache of page extraction results, backed by SQLite, so that reruns of `page_parse`
+# after downstream-only changes (`preprocess`, tsv schema, ...) skip the extractor on known pages.
+# Results are keyed by the hash of the raw html and the extractor id, i.e. its name and version
+# (package version, options, and `CACHE_VERSION` to bump when our extraction code changes),
+# and stored pickled and compressed.
+# The cache is bounded in bytes, least recently used entries are evicted first. Recency of hits
+# is written in batches, so that reruns, which mostly hit, mostly read the database.
+
+import os
+import zlib
+import pickle
+import sqlite3
+from time import time
+from hashlib import blake2b
+from typing import Any, Callable, List, Tuple
+
+import metrics
+
+# size budget in bytes of cached results
+MAX_CACHE_BYTES = 4 << 30
+# number of stores between two eviction checks
+EVICT_EVERY = 1000
+# number of hits whose recency is written at once
+TOUCH_EVERY = 1000
+# bump to invalidate results of former extraction code
+CACHE_VERSION = 1
+
+
+class ExtractCache:
+    """Size-bounded LRU cache of extraction results on disk, safe to share between worker processes."""
+
+    def __init__(self, db_path: str, max_bytes: int = MAX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS results (key BLOB PRIMARY KEY, size INTEGER, value BLOB, last_access REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)")
+        self.store_nums = 0
+        self.touched: List[Tuple[float, bytes]] = list()
+        self.stats = {"hits": 0, "misses": 0, "evicted": 0}
+
+    def close(self) -> None:
+        self.touch()
+        self.conn.close()
+
+    @staticmethod
+    def make_key(raw_html: str, extractor_id: str) -> bytes:
+        h = blake2b(f"{extractor_id}:{CACHE_VERSION}\0".encode("utf-8"), digest_size=16)
+        h.update(raw_html.encode("utf-8", "surrogatepass"))
+        return h.digest()
+
+    def get_or_extract(self, raw_html: str, extractor_id: str, extract: Callable[[str], Any]) -> Any:
+        """Cached result of `extract(raw_html)` by extractor `extractor_id`, extracted and stored on a miss.
+        Exceptions of `extract` are not cached."""
+        key = self.make_key(raw_html, extractor_id)
+        row = self.conn.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            self.stats["hits"] += 1
+            metrics.incr("extract_cache.hits")
+            self.touched.append((time(), key))
+            if len(self.touched) >= TOUCH_EVERY:
+                self.touch()
+            return pickle.loads(zlib.decompress(row[0]))
+        self.stats["misses"] += 1
+        metrics.incr("extract_cache.misses")
+        result = extract(raw_html)
+        self.store(key, result)
+        return result
+
+    def store(self, key: bytes, result: Any) -> None:
+        value = zlib.compress(pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL), 6)
+        self.conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", (key, len(value), value, time()))
+        self.store_nums += 1
+        if self.store_nums % EVICT_EVERY == 0:
+            self.evict()
+
+    def touch(self) -> None:
+        """Write the recency of pending hits."""
+        if not self.touched:
+            return
+        self.conn.execute("BEGIN IMMEDIATE")
+        self.conn.executemany("UPDATE results SET last_access = ? WHERE key = ?", self.touched)
+        self.conn.execute("COMMIT")
+        self.touched = list()
+
+    def evict(self) -> int:
+        """Drop least recently used results until they fit in 90% of the budget."""
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return 0
+        target = total - int(self.max_bytes * 0.9)
+        freed, keys = 0, list()
+        for key, size in self.conn.execute("SELECT key, size FROM results ORDER BY last_access"):
+            keys.append((key,))
+            freed += size
+            if freed >= target:
+                break
+        self.conn.execute("BEGIN IMMEDIATE")
+        self.conn.executemany("DELETE FROM results WHERE key = ?", keys)
+        self.conn.execute("COMMIT")
+        self.stats["evicted"] += len(keys)
+        metrics.incr("extract_cache.evicted", len(keys))
+        return len(keys)
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+# @author: YangLiu
+# @email: yangliu.real@gmail.com
+
+# Single-parse page extraction: every page is parsed once into an lxml tree, as GNE does it,
+# and the same tree serves title and publish time detection (GNE extractors), links,
+# and content extraction by GNE, with a fallback to justext when GNE finds no content.
+# GNE content extraction prunes and normalizes the tree in place, so with the fallback enabled
+# a copy of the tree is kept aside for justext, copying a tree being much cheaper than parsing it again.
+# Justext paragraphs come from GNE's parse, which drops `<br>` tags, so they can differ slightly
+# from justext on the raw html.
+# `__main__` compares the per-page time with parsing once per consumer, on a page folder
+# or on the synthetic corpus of `benchmark`:
+#     python extraction_engine.py [page folder] [max pages]
+
+import sys
+from copy import deepcopy
+from urllib.parse import urljoin
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from lxml.html import HtmlElement, fromstring
+
+from prefilter import get_stoplist
+from extract_cache import ExtractCache
+
+
+def parse_html(raw_html: str) -> HtmlElement:
+    """Parse a page the way GNE does."""
+    from gne.utils import fix_html, html2element
+    return html2element(fix_html(raw_html))
+
+
+def get_base_url(url: str) -> str:
+    """Scheme and domain of `url`, the base the crawler resolves links against."""
+    protocol, suffix = url.split("://", 1)
+    return f"{protocol}://{suffix.split('/')[0]}"
+
+
+def extract_links(tree: HtmlElement, base_url: str, cc: Optional[str] = None) -> Set[str]:
+    """Absolute http(s) links of a tree, those of variety `cc` only if given.
+    Same links as `make_links_absolute` then `iterlinks`, without modifying the tree."""
+    for href in tree.xpath("//base/@href"):
+        base_url = urljoin(base_url, href.strip())  # as `resolve_base_href`
+        break
+    links = set()
+    for element, _, link, _ in tree.iterlinks():
+        if element.tag == "base":
+            continue
+        try:
+            link = urljoin(base_url, link.strip())
+        except ValueError:
+            continue
+        if link.startswith("http") and (cc is None or f".{cc}" in link or f"/{cc}/" in link):
+            links.add(link)
+    return links
+
+
+class ExtractionEngine(object):
+    """Extract title, publish time, content and links of a page from a single parse.
+    Called like `GNEPageExtractor`, on GNE failure content comes from justext if `fallback`,
+    and the results of calls are looked up in `cache` first if given."""
+
+    def __init__(self, fallback: bool = True, language: str = "English", cache: Optional[ExtractCache] = None):
+        from gne import __version__ as gne_version
+        from gne.extractor import ContentExtractor, TimeExtractor, TitleExtractor
+        from justext import __version__ as justext_version
+        self.content_extractor = ContentExtractor()
+        self.title_extractor = TitleExtractor()
+        self.time_extractor = TimeExtractor()
+        self.fallback = fallback
+        self.language = language
+        self.cache = cache
+        self.extractor_id = f"engine-gne-{gne_version}" + (f"-justext-{justext_version}-{language}" if fallback else "")
+
+    def gne_content(self, tree: HtmlElement) -> str:
+        """GNE content of a tree, which is modified in place. Raise `NoContentException` like GNE."""
+        from gne.exceptions import NoContentException
+        from gne.utils import pre_parse, remove_noise_node
+        remove_noise_node(tree, None)
+        content = self.content_extractor.extract(pre_parse(tree), host="", with_body_html=False, body_xpath="", use_visiable_info=False)
+        if not content:
+            raise NoContentException("no content extracted")
+        return content[0][1]["text"]
+
+    def justext_content(self, tree: HtmlElement) -> str:
+        """Good paragraphs of justext on a tree, joined by newlines."""
+        from justext.core import ParagraphMaker, classify_paragraphs, preprocessor, revise_paragraph_classification
+        paragraphs = ParagraphMaker.make_paragraphs(preprocessor(tree))
+        classify_paragraphs(paragraphs, get_stoplist(self.language))
+        revise_paragraph_classification(paragraphs)
+        return "\n".join(para.text.strip() for para in paragraphs if para.class_type in ("good", "near-good"))
+
+    def extract(self, raw_html: str, url: Optional[str] = None, cc: Optional[str] = None) -> Dict:
+        """Extract a page.
+
+        Returns
+        -------
+        dict of `title`, `publish_time`, `content`, `extractor` (`gne` or `justext`),
+        and `links` if `url` is given. Content may be empty after the fallback, which only
+        covers pages GNE finds no content in, other GNE errors are raised as is.
+        """
+        tree = parse_html(raw_html)
+        result = {
+            "title": self.title_extractor.extract(tree, title_xpath=""),
+            "publish_time": self.time_extractor.extractor(tree, publish_time_xpath=""),
+        }
+        if url is not None:
+            result["links"] = extract_links(tree, get_base_url(url), cc)
+        if not self.fallback:
+            result["content"], result["extractor"] = self.gne_content(tree), "gne"
+            return result
+        from gne.exceptions import NoContentException
+        spare = deepcopy(tree)  # only with the fallback, GNE prunes the tree in place
+        try:
+            content, extractor = self.gne_content(tree), "gne"
+        except NoContentException:
+            content = ""
+        if not content.strip():
+            content, extractor = self.justext_content(spare), "justext"
+        result["content"], result["extractor"] = content, extractor
+        return result
+
+    def __call__(self, raw_html: str, *args, **kwargs) -> Tuple[str, str, str]:
+        if self.cache is None:
+            return self.extract_text(raw_html)
+        return self.cache.get_or_extract(raw_html, self.extractor_id, self.extract_text)
+
+    def extract_text(self, raw_html: str) -> Tuple[str, str, str]:
+        result = self.extract(raw_html)
+        return result["title"], result["publish_time"], result["content"]
+
+
+def multi_parse(raw_html: str, url: str, cc: str, gne, justext: Callable) -> Tuple[str, str, str, Set[str]]:
+    """Former way: GNE parses the page, the crawler parses it again for links, and justext once more on GNE failure."""
+    try:
+        res = gne.extract(raw_html)
+        title, publish_time, content = res["title"], res["publish_time"], res["content"]
+    except Exception:
+        title, publish_time, content = "", "", ""
+    if not content.strip():
+        paragraphs = justext(raw_html, get_stoplist("English"))
+        content = "\n".join(para.text.strip() for para in paragraphs if para.class_type in ("good", "near-good"))
+    parsed_doc = fromstring(raw_html, base_url=get_base_url(url))
+    parsed_doc.make_links_absolute()
+    links = set(tpl[2] for tpl in parsed_doc.iterlinks() if tpl[2].startswith("http") and (f".{cc}" in tpl[2] or f"/{cc}/" in tpl[2]))
+    return title, publish_time, content, links
+
+
+def benchmark(pages: List[str], cc: str = "hk", repeat: int = 3) -> None:
+    """Compare per-page times of `multi_parse` and the engine, after checking GNE pages give the same output."""
+    from gne import GeneralNewsExtractor
+    from justext import justext
+    gne, engine = GeneralNewsExtractor(), ExtractionEngine()
+    urls = [f"http://www.example.{cc}/news/{i}" for i in range(len(pages))]
+    fallbacks = 0
+    for url, page in zip(urls, pages):
+        expected = multi_parse(page, url, cc, gne, justext)
+        result = engine.extract(page, url, cc)
+        if result["extractor"] == "gne":
+            assert (result["title"], result["publish_time"], result["content"], result["links"]) == expected, f"output differs at {url}"
+        else:
+            fallbacks += 1
+
+    def per_page(func: Callable) -> float:
+        best = float("inf")
+        for _ in range(repeat):
+            begin = perf_counter()
+            for url, page in zip(urls, pages):
+                func(url, page)
+            best = min(best, perf_counter() - begin)
+        return best / max(len(pages), 1) * 1e3
+
+    before = per_page(lambda url, page: multi_parse(page, url, cc, gne, justext))
+    after = per_page(lambda url, page: engine.extract(page, url, cc))
+    print(f"{len(pages)} pages, {fallbacks} by justext fallback: {before:.2f}ms -> {after:.2f}ms per page, "
+          f"{before - after:.2f}ms saved (x{before / max(after, 1e-9):.2f})")
+
+
+if __name__ == "__main__":
+    # usage: python extraction_engine.py [page folder] [max pages]
+    max_pages = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    if len(sys.argv) > 1:
+        from page_parse import iter_items
+        texts = list()
+        for _, _, _, raw_html in iter_items(sys.argv[1]):
+            texts.append(raw_html)
+            if len(texts) == max_pages:
+                break
+    else:
+        from benchmark import make_corpus
+        texts = make_corpus(max_pages)
+    benchmark(texts)
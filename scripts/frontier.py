@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# @author: YangLiu
+# @email: yangliu.real@gmail.com
+
+# Persistent URL frontier shared by crawler worker processes, backed by SQLite.
+# Each URL is stored once under its normalized form, together with its host, partition
+# (hash of host), BFS depth and state. Workers claim queued URLs of their own partition,
+# so a URL is fetched only once per run however many pages link to it, and only a batch
+# of URLs per worker is held in memory. A rerun resumes from the states left on disk.
+
+import sqlite3
+import zlib
+from time import time
+from urllib.parse import urlsplit, urlunsplit
+from typing import Dict, Generator, Iterable, List, Optional, Tuple
+
+QUEUED, IN_FLIGHT, DONE, FAILED = 0, 1, 2, 3
+# seconds after which an in-flight URL is considered abandoned by a dead worker and claimable again
+LEASE_SECONDS = 600
+
+
+def normalize_url(url: str) -> str:
+    """Normalize URL for dedup: lowercase scheme & host, drop userinfo, default port and fragment."""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    netloc = host if port is None or (scheme, port) in (("http", 80), ("https", 443)) else f"{host}:{port}"
+    return urlunsplit((scheme, netloc, parts.path or "/", parts.query, ""))
+
+
+def get_host(url: str) -> str:
+    return (urlsplit(url).hostname or "").lower()
+
+
+def get_partition(host: str, partitions: int) -> int:
+    return zlib.crc32(host.encode("utf-8")) % partitions
+
+
+class Frontier:
+    """SQLite-backed BFS frontier, safe to open from several processes at once."""
+
+    def __init__(self, db_path: str, partitions: int = 1, lease_seconds: int = LEASE_SECONDS):
+        self.partitions = partitions
+        self.lease_seconds = lease_seconds
+        self.conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+        self.conn.create_function("partition", 1, lambda host: get_partition(host, self.partitions), deterministic=True)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, host TEXT, part INTEGER, depth INTEGER, state INTEGER, claimed_at REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS urls_part_state ON urls (part, state)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.execute("BEGIN IMMEDIATE")
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'partitions'").fetchone()
+        if row is None or int(row[0]) != partitions:  # re-partition URLs left by a run with another worker number
+            self.conn.execute("UPDATE urls SET part = partition(host)")
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('partitions', ?)", (str(partitions),))
+        self.conn.execute("COMMIT")
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def add(self, urls: Iterable[str], depth: int) -> int:
+        """Enqueue URLs which have never been seen, return number of new URLs."""
+        rows = list()
+        for url in urls:
+            url = normalize_url(url)
+            host = get_host(url)
+            rows.append((url, host, get_partition(host, self.partitions), depth, QUEUED))
+        before = self.conn.total_changes
+        self.conn.execute("BEGIN IMMEDIATE")
+        self.conn.executemany("INSERT OR IGNORE INTO urls (url, host, part, depth, state) VALUES (?, ?, ?, ?, ?)", rows)
+        self.conn.execute("COMMIT")
+        return self.conn.total_changes - before
+
+    def claim(self, part: int, n: int) -> List[Tuple[str, int]]:
+        """Atomically take up to `n` queued (or abandoned in-flight) URLs of a partition."""
+        now = time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        rows = self.conn.execute(
+            "SELECT url, depth FROM urls WHERE part = ? AND (state = ? OR (state = ? AND claimed_at < ?)) LIMIT ?",
+            (part, QUEUED, IN_FLIGHT, now - self.lease_seconds, n)).fetchall()
+        self.conn.executemany("UPDATE urls SET state = ?, claimed_at = ? WHERE url = ?", [(IN_FLIGHT, now, url) for url, _ in rows])
+        self.conn.execute("COMMIT")
+        return rows
+
+    def renew(self, urls: Iterable[str]) -> None:
+        """Renew the lease of in-flight URLs still held by their worker."""
+        now = time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        self.conn.executemany("UPDATE urls SET claimed_at = ? WHERE url = ? AND state = ?", [(now, url, IN_FLIGHT) for url in urls])
+        self.conn.execute("COMMIT")
+
+    def mark(self, urls: Iterable[str], state: int) -> None:
+        self.conn.execute("BEGIN IMMEDIATE")
+        self.conn.executemany("UPDATE urls SET state = ? WHERE url = ?", [(state, url) for url in urls])
+        self.conn.execute("COMMIT")
+
+    def pending(self, part: Optional[int] = None) -> int:
+        """Number of URLs queued or in flight over all the partitions, or in partition `part`."""
+        if part is None:
+            return self.conn.execute("SELECT COUNT(*) FROM urls WHERE state IN (?, ?)", (QUEUED, IN_FLIGHT)).fetchone()[0]
+        return self.conn.execute("SELECT COUNT(*) FROM urls WHERE part = ? AND state IN (?, ?)", (part, QUEUED, IN_FLIGHT)).fetchone()[0]
+
+    def recover(self, part: Optional[int] = None) -> int:
+        """Requeue URLs left in flight by an interrupted run, or by the dead worker of partition `part`.
+        Call before starting the workers concerned."""
+        before = self.conn.total_changes
+        if part is None:
+            self.conn.execute("UPDATE urls SET state = ? WHERE state = ?", (QUEUED, IN_FLIGHT))
+        else:
+            self.conn.execute("UPDATE urls SET state = ? WHERE part = ? AND state = ?", (QUEUED, part, IN_FLIGHT))
+        return self.conn.total_changes - before
+
+    def clear(self) -> None:
+        """Forget all the urls, to crawl again from scratch."""
+        self.conn.execute("DELETE FROM urls")
+
+    def stats(self) -> Dict[str, int]:
+        names = {QUEUED: "queued", IN_FLIGHT: "in_flight", DONE: "done", FAILED: "failed"}
+        counts = {name: 0 for name in names.values()}
+        for state, count in self.conn.execute("SELECT state, COUNT(*) FROM urls GROUP BY state"):
+            counts[names[state]] = count
+        return counts
+
+    def iter_urls(self, state: int = DONE) -> Generator[str, None, None]:
+        for row in self.conn.execute("SELECT url FROM urls WHERE state = ?", (state,)):
+            yield row[0]
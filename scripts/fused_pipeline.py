@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# @author: YangLiu
+# @email: yangliu.real@gmail.com
+
+# Fetch-and-extract pipeline, fusing `bfs_page_crawl` and `page_parse`.
+# Pages fetched by the BFS crawler are handed, still in memory, through a bounded queue
+# to a pool of extraction processes, which append finished rows to the metadata tsv.
+# The raw html is never dumped and re-read in between, unless an archive is asked for.
+# When extraction falls behind, the full queue blocks the fetch tasks, so the crawler
+# slows down instead of buffering pages and memory stays flat.
+# A URL is marked DONE in the frontier only once the row of its page is written, pages still
+# queued or in extraction when the run is killed stay in flight and are fetched again on restart.
+
+import os
+import sys
+import asyncio
+from typing import List, Optional, Tuple
+
+from pebble import ProcessPool
+
+import page_parse
+from frontier import DONE, Frontier
+from page_store import PageStoreWriter
+from tsv_index import IndexedTsv
+from bfs_page_crawl import FRONTIER_PATH, bfs_crawl_concurrent, generate_index_set
+
+# number of fetched pages waiting for extraction before the crawler is blocked
+QUEUE_SIZE = 256
+# number of extraction processes
+EXTRACT_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+METADATA_HEADER = "TextID\tTime\tWords\tVariety\tGenre\tDomain\tURL\tTitle\tContent\n"
+
+
+class ExtractionSink:
+    """Bounded queue between the crawler and the extraction pool, which marks the URLs of
+    extracted pages DONE in `frontier`."""
+
+    def __init__(self, pool: ProcessPool, writer: page_parse.RowWriter, frontier: Frontier, queue_size: int = QUEUE_SIZE,
+                 chunk_size: int = page_parse.CHUNK_SIZE, archive: Optional[PageStoreWriter] = None):
+        self.pool = pool
+        self.writer = writer
+        self.frontier = frontier
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.chunk_size = chunk_size
+        self.archive = archive
+        self.page_nums = 0
+
+    async def put(self, url: str, html: str) -> None:
+        """Called by the crawler for every fetched page, blocks while the queue is full."""
+        await self.queue.put((f"{url}#{self.page_nums}", url, "NULL", html))
+        self.page_nums += 1
+        if self.archive is not None:
+            self.archive.append(url, "NULL", html)
+
+    async def _get_chunk(self) -> List[Tuple[str, str, str, str]]:
+        chunk = [await self.queue.get()]
+        while len(chunk) < self.chunk_size and not self.queue.empty():
+            chunk.append(self.queue.get_nowait())
+        return chunk
+
+    async def consume(self) -> None:
+        """Extract chunks of queued pages on the pool and write their rows, run one per pool worker."""
+        loop = asyncio.get_running_loop()
+        while True:
+            chunk = await self._get_chunk()
+            try:
+                future = self.pool.schedule(page_parse.extract_chunk, [chunk], timeout=page_parse.PAGE_TIMEOUT * len(chunk))
+                # `collect_chunk` blocks on the future and retries page by page, keep it off the event loop
+                results = await loop.run_in_executor(None, page_parse.collect_chunk, self.pool, chunk, future)
+                self.writer.write(results)
+                self.writer.output_file.flush()
+                self.frontier.mark([url for _, url, _, _ in chunk], DONE)  # pages without row too, e.g. too short
+            finally:
+                for _ in chunk:
+                    self.queue.task_done()
+
+
+def get_next_text_id(output_path: str) -> int:
+    """Next TextID to append to an existing metadata tsv."""
+    if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+        return 0
+    with IndexedTsv(output_path) as tsv:
+        return int(tsv.row(len(tsv) - 1)[0]) + 1 if len(tsv) > 0 else 0
+
+
+async def crawl_and_extract(cc: str, index_set: set, max_crawl_depth: int, output_path: str,
+                            extract_workers: int = EXTRACT_WORKERS, archive_dir: Optional[str] = None) -> int:
+    """Crawl `cc` from its index urls in a single crawler process, extracting pages on the fly.
+
+    Returns
+    -------
+    number of pages fetched and handed to extraction
+    """
+    db_path = FRONTIER_PATH.format(cc=cc)
+    frontier = Frontier(db_path, 1)
+    print(f"[{cc}] requeued {frontier.recover()} in-flight urls, added {frontier.add(index_set, 1)} index urls.")
+
+    is_new = not os.path.exists(output_path) or os.path.getsize(output_path) == 0
+    next_text_id = get_next_text_id(output_path)
+    archive = PageStoreWriter(archive_dir) if archive_dir is not None else None
+    with ProcessPool(max_workers=extract_workers, max_tasks=page_parse.MAX_TASKS,
+                     initializer=page_parse.init_worker, initargs=[cc]) as pool, \
+            open(output_path, "a") as output_file:
+        if is_new:
+            output_file.write(METADATA_HEADER)
+        writer = page_parse.RowWriter(output_file)
+        writer.idx = next_text_id
+        sink = ExtractionSink(pool, writer, frontier, archive=archive)
+        consumers = [asyncio.create_task(sink.consume()) for _ in range(extract_workers)]
+        try:
+            await bfs_crawl_concurrent(0, 1, cc, db_path, max_crawl_depth, sink=sink.put)
+            await sink.queue.join()
+        finally:
+            for consumer in consumers:
+                consumer.cancel()
+            frontier.close()
+            if archive is not None:
+                archive.close()
+    print(f"[{cc}] {sink.page_nums} pages fetched, TextIDs {next_text_id}-{writer.idx - 1} assigned.")
+
+    return sink.page_nums
+
+
+if __name__ == "__main__":
+    # usage: python fused_pipeline.py {cc} [archive_dir]
+    cc = sys.argv[1]
+    asyncio.run(crawl_and_extract(cc, generate_index_set(cc), 3, f"data/metadata.raw.{cc}.tsv",
+                                  archive_dir=sys.argv[2] if len(sys.argv) > 2 else None))
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# @author: YangLiu
+# @email: yangliu.real@gmail.com
+
+# Local HTTP cache for recrawls, backed by SQLite.
+# Each normalized URL keeps its ETag / Last-Modified validators, the hash of its body and the
+# compressed body itself. On recrawl, conditional headers are sent so that unchanged pages
+# answer 304 without a body, and the cached body is reused for link extraction. Pages whose
+# body hash did not change are reported as unchanged, so their extraction can be skipped.
+# The cache is bounded in bytes, least recently used entries are evicted first.
+
+import zlib
+import sqlite3
+from time import time
+from hashlib import blake2b
+from typing import Dict, Mapping, Optional
+
+from frontier import normalize_url
+
+# size budget in bytes of cached bodies
+MAX_CACHE_BYTES = 8 << 30
+# number of stores between two eviction checks
+EVICT_EVERY = 1000
+
+
+class HttpCache:
+    """Size-bounded LRU cache of pages on disk, safe to share between crawler processes."""
+
+    def __init__(self, db_path: str, max_bytes: int = MAX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, content_hash TEXT, size INTEGER, body BLOB, last_access REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS pages_last_access ON pages (last_access)")
+        self.store_nums = 0
+        self.stats = {"hits": 0, "not_modified": 0, "unchanged": 0, "changed": 0, "evicted": 0}
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def conditional_headers(self, url: str) -> Dict[str, str]:
+        """`If-None-Match` / `If-Modified-Since` headers for a cached url, empty if not cached."""
+        row = self.conn.execute("SELECT etag, last_modified FROM pages WHERE url = ?", (normalize_url(url),)).fetchone()
+        headers = dict()
+        if row is not None:
+            self.stats["hits"] += 1
+            if row[0]:
+                headers["If-None-Match"] = row[0]
+            if row[1]:
+                headers["If-Modified-Since"] = row[1]
+        return headers
+
+    def get_body(self, url: str) -> Optional[bytes]:
+        """Cached body of a url answering 304, refreshing its recency."""
+        url = normalize_url(url)
+        row = self.conn.execute("SELECT body FROM pages WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+        self.stats["not_modified"] += 1
+        self.conn.execute("UPDATE pages SET last_access = ? WHERE url = ?", (time(), url))
+        return zlib.decompress(row[0])
+
+    def store(self, url: str, headers: Mapping[str, str], body: bytes) -> bool:
+        """Cache a fetched page with its validators.
+
+        Returns
+        -------
+        whether the body is new or differs from the cached one
+        """
+        url = normalize_url(url)
+        content_hash = blake2b(body, digest_size=16).hexdigest()
+        row = self.conn.execute("SELECT content_hash FROM pages WHERE url = ?", (url,)).fetchone()
+        changed = row is None or row[0] != content_hash
+        self.stats["changed" if changed else "unchanged"] += 1
+        compressed = zlib.compress(body, 6)
+        self.conn.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                          (url, headers.get("etag"), headers.get("last-modified"), content_hash, len(compressed), compressed, time()))
+        self.store_nums += 1
+        if self.store_nums % EVICT_EVERY == 0:
+            self.evict()
+        return changed
+
+    def evict(self) -> int:
+        """Drop least recently used pages until cached bodies fit in 90% of the budget."""
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+        if total <= self.max_bytes:
+            return 0
+        target = total - int(self.max_bytes * 0.9)
+        freed, urls = 0, list()
+        for url, size in self.conn.execute("SELECT url, size FROM pages ORDER BY last_access"):
+            urls.append((url,))
+            freed += size
+            if freed >= target:
+                break
+        self.conn.execute("BEGIN IMMEDIATE")
+        self.conn.executemany("DELETE FROM pages WHERE url = ?", urls)
+        self.conn.execute("COMMIT")
+        self.stats["evicted"] += len(urls)
+        return len(urls)
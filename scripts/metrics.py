@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# @author: YangLiu
+# @email: yangliu.real@gmail.com
+
+# Process-wide instrumentation shared by the pipeline stages: counters, and histograms of
+# durations (or any positive value) with log2 buckets. Metric names are prefixed by their stage,
+# e.g. `crawl.fetch_seconds`, `extract.timeouts`, `annotate.doc_seconds`.
+# Toggled by environment variables, so worker processes inherit the setting:
+#     CCAE_METRICS_PATH       JSON-lines file every process appends its snapshots to, metrics are off if unset
+#     CCAE_METRICS_INTERVAL   seconds between two snapshots of a process, 10 by default
+#     CCAE_PROFILE            path prefix of cProfile dumps `{prefix}.{pid}.prof`, profiling is off if unset
+# A snapshot line looks like:
+#     {"time": ..., "pid": ..., "counters": {name: value}, "histograms": {name: {"count", "sum", "max", "p50", "p90", "p99"}}}
+# Counters and histograms are cumulative since the process started.
+# Snapshots are written every interval and at exit, but pool workers leave through `os._exit`,
+# so tasks run in pools flush at their end, see `page_parse.extract_chunk` for instance.
+
+import os
+import json
+import atexit
+import cProfile
+from time import monotonic, perf_counter, time
+from typing import Dict, List, Optional
+
+METRICS_PATH = os.environ.get("CCAE_METRICS_PATH")
+INTERVAL = float(os.environ.get("CCAE_METRICS_INTERVAL", "10"))
+PROFILE_PREFIX = os.environ.get("CCAE_PROFILE")
+ENABLED = METRICS_PATH is not None
+# upper bound of the first histogram bucket, each next bucket doubles it
+MIN_BOUND = 1e-5
+BUCKETS = 32
+
+
+class Histogram:
+
+    def __init__(self):
+        self.buckets: List[int] = [0] * BUCKETS
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        i, bound = 0, MIN_BOUND
+        while value > bound and i < BUCKETS - 1:
+            i += 1
+            bound *= 2
+        self.buckets[i] += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding quantile `q`."""
+        rank, seen = q * self.count, 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n > 0:
+                return min(MIN_BOUND * 2 ** i, self.max)
+        return self.max
+
+    def summary(self) -> Dict[str, float]:
+        return {"count": self.count, "sum": round(self.sum, 6), "max": round(self.max, 6),
+                "p50": self.quantile(0.5), "p90": self.quantile(0.9), "p99": self.quantile(0.99)}
+
+
+class Timer:
+    """Context manager observing its elapsed seconds into a histogram."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.begin = 0.0
+
+    def __enter__(self) -> "Timer":
+        if ENABLED:
+            self.begin = perf_counter()
+        return self
+
+    def __exit__(self, type, value, traceback) -> None:
+        if ENABLED:
+            observe(self.name, perf_counter() - self.begin)
+
+
+COUNTERS: Dict[str, float] = dict()
+HISTOGRAMS: Dict[str, Histogram] = dict()
+PROFILER: Optional[cProfile.Profile] = None
+_last_dump = monotonic()
+
+
+def incr(name: str, n: float = 1) -> None:
+    if not ENABLED:
+        return
+    COUNTERS[name] = COUNTERS.get(name, 0) + n
+    maybe_dump()
+
+
+def observe(name: str, value: float) -> None:
+    if not ENABLED:
+        return
+    histogram = HISTOGRAMS.get(name)
+    if histogram is None:
+        histogram = HISTOGRAMS[name] = Histogram()
+    histogram.observe(value)
+    maybe_dump()
+
+
+def timer(name: str) -> Timer:
+    return Timer(name)
+
+
+def maybe_dump() -> None:
+    if monotonic() - _last_dump >= INTERVAL:
+        flush()
+
+
+def flush() -> None:
+    """Append a snapshot of this process's metrics, and dump its profile if profiling."""
+    global _last_dump
+    _last_dump = monotonic()
+    if ENABLED and (COUNTERS or HISTOGRAMS):
+        snapshot = {"time": round(time(), 3), "pid": os.getpid(), "counters": COUNTERS,
+                    "histograms": {name: histogram.summary() for name, histogram in HISTOGRAMS.items()}}
+        with open(METRICS_PATH, "a") as fw:
+            fw.write(json.dumps(snapshot) + "\n")  # a single write per line, lines of processes do not interleave
+    if PROFILER is not None:
+        PROFILER.disable()
+        PROFILER.dump_stats(f"{PROFILE_PREFIX}.{os.getpid()}.prof")
+        PROFILER.enable()
+
+
+def start_profiler() -> None:
+    global PROFILER
+    if PROFILE_PREFIX is not None and PROFILER is None:
+        PROFILER = cProfile.Profile()
+        PROFILER.enable()
+
+
+def _reset_after_fork() -> None:
+    """Forked workers start with their own metrics and profile, instead of a copy of the parent's."""
+    global PROFILER, _last_dump
+    COUNTERS.clear()
+    HISTOGRAMS.clear()
+    _last_dump = monotonic()
+    if PROFILER is not None:
+        PROFILER.disable()
+        PROFILER = None
+        start_profiler()
+
+
+start_profiler()
+atexit.register(flush)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+# @author: YangLiu
+# @email: yangliu.real@gmail.com
+
+# Near-duplicate document detection over the Content column of metadata tsv files,
+# to drop mirror sites and syndicated news before spaCy annotation.
+# 1. Each document is shingled into hashed word n-grams: words are hashed once, and the
+#    n-gram hashes are combined from them with vectorized multiply-adds.
+# 2. MinHash signatures are computed for batches of documents at once with numpy, with
+#    `NUM_PERM` universal hash functions `(a * x + b) mod p`, reduced per document.
+# 3. Signatures are cut into `BANDS` bands, documents sharing a band are candidates, and
+#    candidates whose estimated Jaccard similarity passes `THRESHOLD` are clustered.
+# Signatures of row ranges of all the varieties are computed in parallel on a process pool.
+# Each cluster keeps its first document, and produces:
+#     data/near_dup.{cc}.tsv           ClusterID, TextID, URL, Similarity to the kept document, Kept
+#     data/metadata.dedup.{cc}.tsv     metadata tsv without the dropped duplicates
+
+import os
+import sys
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from pebble import ProcessPool
+
+from tsv_index import IndexedTsv
+
+CC_LIST = ["cn", "hk", "mo", "tw", "sg", "my"]
+INPUT_PATH = "data/metadata.raw.{cc}.tsv"
+REPORT_PATH = "data/near_dup.{cc}.tsv"
+OUTPUT_PATH = "data/metadata.dedup.{cc}.tsv"
+MAX_WORKERS = os.cpu_count()
+# number of words per shingle
+SHINGLE_SIZE = 5
+# number of hash functions of a signature, BANDS * ROWS
+NUM_PERM = 128
+# LSH bands of ROWS values, candidates are pairs with similarity above ~(1 / BANDS) ** (1 / ROWS) = 0.71
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+# estimated Jaccard similarity from which two documents are near-duplicates
+THRESHOLD = 0.8
+# number of documents whose signatures are computed by a pool task
+ROWS_PER_TASK = 10000
+# max number of shingles hashed at once, bounds the NUM_PERM x shingles matrix to 64 MiB
+BATCH_SHINGLES = 1 << 16
+# Mersenne prime above the 32-bit shingle hashes, and the signature value of documents without words
+PRIME = (1 << 61) - 1
+EMPTY = np.uint64(PRIME)
+SEED = 42
+
+_rng = np.random.default_rng(SEED)
+# multipliers stay below 2^31 so that a * x + b never overflows uint64 for 32-bit x
+PERM_A = _rng.integers(1, 1 << 31, size=NUM_PERM, dtype=np.uint64)[:, None]
+PERM_B = _rng.integers(0, 1 << 32, size=NUM_PERM, dtype=np.uint64)[:, None]
+# multiplier of the rolling combination of word hashes into shingle hashes
+SHINGLE_BASE = np.uint64(1000003)
+
+
+def shingle_hashes(text: str, k: int = SHINGLE_SIZE) -> np.ndarray:
+    """Distinct 32-bit hashes of the word k-grams of a text."""
+    words = text.lower().split()
+    if not words:
+        return np.empty(0, dtype=np.uint64)
+    word_hashes = np.fromiter((zlib.crc32(w.encode("utf-8")) for w in words), dtype=np.uint64, count=len(words))
+    if len(words) <= k:  # short document, a single shingle
+        k = len(words)
+    n = len(words) - k + 1
+    shingles = np.zeros(n, dtype=np.uint64)
+    for j in range(k):
+        shingles = shingles * SHINGLE_BASE + word_hashes[j:j + n]  # wraps modulo 2^64
+    return np.unique(shingles & np.uint64(0xFFFFFFFF))
+
+
+def minhash_batch(shingles: List[np.ndarray]) -> np.ndarray:
+    """MinHash signatures of documents, `EMPTY` rows for documents without shingles.
+
+    Returns
+    -------
+    array of shape (len(shingles), NUM_PERM)
+    """
+    signatures = np.full((len(shingles), NUM_PERM), EMPTY, dtype=np.uint64)
+    begin = 0
+    while begin < len(shingles):
+        end, size = begin, 0
+        while end < len(shingles) and (end == begin or size + len(shingles[end]) <= BATCH_SHINGLES):
+            size += len(shingles[end])
+            end += 1
+        docs = [i for i in range(begin, end) if len(shingles[i]) > 0]
+        if docs:
+            lengths = np.array([len(shingles[i]) for i in docs])
+            values = np.concatenate([shingles[i] for i in docs])
+            hashed = (PERM_A * values + PERM_B) % np.uint64(PRIME)
+            starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+            signatures[docs] = np.minimum.reduceat(hashed, starts, axis=1).T
+        begin = end
+    return signatures
+
+
+def compute_signatures(tsv_path: str, start: int, end: int) -> np.ndarray:
+    """Signatures of the rows `[start, end)` of an indexed tsv, run in a pool worker."""
+    with IndexedTsv(tsv_path) as tsv:
+        col = tsv.header.index("Content")
+        shingles = list()
+        for i in range(start, end):
+            fields = tsv.line(i).split('\t', col + 1)
+            shingles.append(shingle_hashes(fields[col] if col < len(fields) else ""))
+    return minhash_batch(shingles)
+
+
+class UnionFind:
+
+    def __init__(self, n: int):
+        self.parent = list(range(n))
+
+    def find(self, x: int) -> int:
+        while self.parent[x] != x:
+            self.parent[x] = self.parent[self.parent[x]]
+            x = self.parent[x]
+        return x
+
+    def union(self, x: int, y: int) -> None:
+        x, y = self.find(x), self.find(y)
+        if x != y:  # the smaller row becomes the root, i.e. the kept document
+            self.parent[max(x, y)] = min(x, y)
+
+
+def cluster_signatures(signatures: np.ndarray, threshold: float = THRESHOLD) -> Dict[int, List[int]]:
+    """LSH banding over signatures, clusters candidates whose estimated similarity reaches `threshold`.
+
+    Returns
+    -------
+    first row -> all rows of the cluster, for clusters of at least two documents
+    """
+    uf = UnionFind(len(signatures))
+    valid = np.flatnonzero(signatures[:, 0] != EMPTY)
+    for band in range(BANDS):
+        keys = np.ascontiguousarray(signatures[valid, band * ROWS:(band + 1) * ROWS])
+        keys = keys.view(np.dtype((np.void, ROWS * 8))).ravel()
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        is_first = np.ones(len(order), dtype=bool)
+        is_first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+        if is_first.all():
+            continue
+        # pair every member of a bucket with the bucket's first member
+        firsts = valid[order[np.flatnonzero(is_first)[np.cumsum(is_first) - 1]]]
+        members = valid[order]
+        pairs = firsts != members
+        firsts, members = firsts[pairs], members[pairs]
+        similarity = (signatures[firsts] == signatures[members]).mean(axis=1)
+        for x, y in zip(firsts[similarity >= threshold].tolist(), members[similarity >= threshold].tolist()):
+            uf.union(x, y)
+
+    clusters = dict()
+    for i in valid.tolist():  # ascending, so the root comes first in its cluster
+        clusters.setdefault(uf.find(i), list()).append(i)
+    return {root: rows for root, rows in clusters.items() if len(rows) > 1}
+
+
+def write_outputs(tsv: IndexedTsv, signatures: np.ndarray, clusters: Dict[int, List[int]],
+                  report_path: str, output_path: str) -> int:
+    """Write the cluster report and the filtered tsv, atomically.
+
+    Returns
+    -------
+    number of dropped documents
+    """
+    textid_col, url_col = tsv.header.index("TextID"), tsv.header.index("URL")
+    dropped = set()
+    with open(f"{report_path}.tmp", "w") as fw:
+        fw.write("ClusterID\tTextID\tURL\tSimilarity\tKept\n")
+        for cluster_id, (root, rows) in enumerate(sorted(clusters.items())):
+            for i in rows:
+                fields = tsv.row(i)
+                similarity = float((signatures[root] == signatures[i]).mean())
+                fw.write(f"{cluster_id}\t{fields[textid_col]}\t{fields[url_col]}\t{similarity:.3f}\t{int(i == root)}\n")
+                if i != root:
+                    dropped.add(i)
+    os.replace(f"{report_path}.tmp", report_path)
+
+    with open(f"{output_path}.tmp", "wb") as fw:
+        if len(tsv) > 0 and tsv.offsets[0] > 0:  # keep the header line
+            fw.write(tsv.data[:tsv.offsets[0]])
+        for i in range(len(tsv)):
+            if i not in dropped:
+                fw.write(tsv.data[tsv.offsets[i]:tsv.offsets[i + 1]])
+    os.replace(f"{output_path}.tmp", output_path)
+
+    return len(dropped)
+
+
+def near_dedup(cc_list: Optional[List[str]] = None, max_workers: int = MAX_WORKERS,
+               threshold: float = THRESHOLD) -> Dict[str, Tuple[int, int, int]]:
+    """Near-dedup the metadata tsv of each variety, signatures of all varieties computed in parallel.
+
+    Returns
+    -------
+    cc -> (number of documents, number of clusters, number of dropped documents)
+    """
+    cc_list = cc_list or CC_LIST
+    tsv_paths = {cc: INPUT_PATH.format(cc=cc) for cc in cc_list if os.path.exists(INPUT_PATH.format(cc=cc))}
+    futures = dict()
+    with ProcessPool(max_workers=max_workers) as pool:
+        for cc, tsv_path in tsv_paths.items():
+            with IndexedTsv(tsv_path) as tsv:  # build a stale index once, before workers open it
+                rows = len(tsv)
+            futures[cc] = [pool.schedule(compute_signatures, [tsv_path, start, min(start + ROWS_PER_TASK, rows)])
+                           for start in range(0, rows, ROWS_PER_TASK)]
+
+        summary = dict()
+        for cc, tsv_path in tsv_paths.items():
+            parts = [future.result() for future in futures[cc]]
+            signatures = np.concatenate(parts) if parts else np.empty((0, NUM_PERM), dtype=np.uint64)
+            clusters = cluster_signatures(signatures, threshold)
+            with IndexedTsv(tsv_path) as tsv:
+                dropped = write_outputs(tsv, signatures, clusters, REPORT_PATH.format(cc=cc), OUTPUT_PATH.format(cc=cc))
+            summary[cc] = (len(signatures), len(clusters), dropped)
+            print(f"[{cc}] {len(signatures)} documents, {len(clusters)} near-duplicate clusters, {dropped} documents dropped.")
+
+    return summary
+
+
+if __name__ == "__main__":
+    # usage: python near_dedup.py [cc ...]
+    near_dedup(sys.argv[1:] or None)
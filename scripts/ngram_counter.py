@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+# @author: YangLiu
+# @email: yangliu.real@gmail.com
+
+# Memory-bounded n-gram counter, used to generate query sets from reference corpora (e.g. GloWbE).
+# 1. The corpus is split into byte ranges counted in parallel. Each range is streamed by blocks
+#    of lines, the words of a block are hashed once, and the n-gram keys are 64-bit rolling
+#    combinations of word hashes computed with numpy, never joining n-gram strings.
+# 2. Counts of a block are reduced with numpy, and once `SPILL_GRAMS` distinct keys are buffered,
+#    they are spilled to disk into `PARTITIONS` runs by key hash.
+# 3. Runs of each partition are merged in parallel, each by a streaming k-way merge of its
+#    memory-mapped sorted runs, block by block, keeping the top-k keys only. The top-k n-grams
+#    of all the partitions are then selected with a heap.
+# 4. A second pass over the corpus recovers the strings of the top-k keys only.
+# Output Format:
+#     {n}gram\tfrequency
+#     ...       ...         (by descending frequency)
+
+import os
+import re
+import sys
+import zlib
+import heapq
+import shutil
+from typing import Dict, Generator, List, Optional, Tuple
+
+import numpy as np
+from pebble import ProcessPool
+
+MAX_WORKERS = os.cpu_count()
+# byte size of a corpus range counted by a pool task
+RANGE_BYTES = 1 << 26
+# number of lines whose n-grams are counted at once
+BLOCK_LINES = 1 << 14
+# number of distinct keys buffered by a task before spilling them to disk
+SPILL_GRAMS = 1 << 22
+# number of spill runs per task, one per hash partition merged on its own
+PARTITIONS = 16
+# number of rows of each run read at once by the merge of a partition
+MERGE_ROWS = 1 << 18
+TOP_K = 100000
+# odd multiplier of the rolling combination of word hashes into n-gram keys
+GRAM_BASE = np.uint64(0x100000001B3)
+NON_LETTERS = re.compile(r"[^a-zA-Z\s]+", re.IGNORECASE)
+# number of word hashes cached by a worker, most words of a corpus repeat across blocks
+CACHE_WORDS = 1 << 21
+WORD_HASHES: Dict[str, int] = dict()
+
+
+def clean_line(line: str, glowbe: bool = True) -> Optional[str]:
+    """Clean a corpus line into lowercase words. GloWbE lines hold a text after a `#` id, other lines are skipped."""
+    if glowbe:
+        if not line.startswith("#"):
+            return None
+        line = line.split(' ', 1)[1] if ' ' in line else ""
+        line = line.replace("<p>", "").replace("<h>", "")
+    return re.sub(NON_LETTERS, "", line.lower())
+
+
+def hash_word(word: str) -> int:
+    """Stable 64-bit hash of a word, crc32 and adler32 side by side."""
+    data = word.encode("utf-8")
+    return (zlib.crc32(data) << 32) | zlib.adler32(data)
+
+
+def split_ranges(fpath: str, range_bytes: int = RANGE_BYTES) -> List[Tuple[int, int]]:
+    size = os.path.getsize(fpath)
+    return [(start, min(start + range_bytes, size)) for start in range(0, size, range_bytes)]
+
+
+def iter_range_lines(fpath: str, start: int, end: int) -> Generator[str, None, None]:
+    """Lines starting in the byte range `[start, end)`."""
+    with open(fpath, "rb") as f:
+        if start > 0:
+            f.seek(start - 1)
+            f.readline()  # the line across `start` belongs to the previous range
+        pos = f.tell()
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line.decode("utf-8", errors="replace")
+
+
+def iter_blocks(fpath: str, start: int, end: int, glowbe: bool = True) -> Generator[Tuple[List[str], np.ndarray], None, None]:
+    """Words of blocks of `BLOCK_LINES` lines, with the line number of each word within its block."""
+    words, line_ids, line_nums = list(), list(), 0
+    for line in iter_range_lines(fpath, start, end):
+        line = clean_line(line, glowbe)
+        if line is None:
+            continue
+        line_words = line.split()
+        words.extend(line_words)
+        line_ids.extend([line_nums] * len(line_words))
+        line_nums += 1
+        if line_nums == BLOCK_LINES:
+            yield words, np.array(line_ids, dtype=np.int64)
+            words, line_ids, line_nums = list(), list(), 0
+    if words:
+        yield words, np.array(line_ids, dtype=np.int64)
+
+
+def gram_keys(words: List[str], line_ids: np.ndarray, n: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Keys of the n-grams of a block which do not cross lines, and the position of their first word."""
+    if len(words) < n:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64)
+    if len(WORD_HASHES) > CACHE_WORDS:
+        WORD_HASHES.clear()
+    for word in set(words).difference(WORD_HASHES):
+        WORD_HASHES[word] = hash_word(word)
+    word_hashes = np.fromiter(map(WORD_HASHES.__getitem__, words), dtype=np.uint64, count=len(words))
+    size = len(words) - n + 1
+    keys = np.zeros(size, dtype=np.uint64)
+    for j in range(n):
+        keys = keys * GRAM_BASE + word_hashes[j:j + size]  # wraps modulo 2^64
+    positions = np.flatnonzero(line_ids[:size] == line_ids[n - 1:])
+    return keys[positions], positions
+
+
+def reduce_counts(keys: np.ndarray, counts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Sum counts of equal keys, keys come out sorted."""
+    order = np.argsort(keys, kind="stable")
+    keys, counts = keys[order], counts[order]
+    if len(keys) == 0:
+        return keys, counts
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    return keys[starts], np.add.reduceat(counts, starts)
+
+
+def spill(keys: np.ndarray, counts: np.ndarray, spill_dir: str, name: str) -> None:
+    """Write reduced counts into one run per hash partition."""
+    parts = keys % np.uint64(PARTITIONS)
+    for part in range(PARTITIONS):
+        selected = parts == part
+        np.save(os.path.join(spill_dir, f"{part}.{name}.npy"), np.stack([keys[selected], counts[selected]], axis=1))
+
+
+def count_range(fpath: str, start: int, end: int, n: int, spill_dir: str, glowbe: bool = True) -> int:
+    """Count the n-grams of a byte range into spill runs, run in a pool worker.
+
+    Returns
+    -------
+    number of n-grams counted
+    """
+    buffer_keys, buffer_counts, buffered, spills, total = list(), list(), 0, 0, 0
+    for words, line_ids in iter_blocks(fpath, start, end, glowbe):
+        keys, _ = gram_keys(words, line_ids, n)
+        total += len(keys)
+        keys, counts = reduce_counts(keys, np.ones(len(keys), dtype=np.uint64))
+        buffer_keys.append(keys)
+        buffer_counts.append(counts)
+        buffered += len(keys)
+        if buffered >= SPILL_GRAMS:
+            keys, counts = reduce_counts(np.concatenate(buffer_keys), np.concatenate(buffer_counts))
+            buffer_keys, buffer_counts, buffered = [keys], [counts], len(keys)
+            if buffered >= SPILL_GRAMS // 2:  # few repeated keys, reducing does not free enough memory
+                spill(keys, counts, spill_dir, f"{start}.{spills}")
+                buffer_keys, buffer_counts, buffered, spills = list(), list(), 0, spills + 1
+    if buffer_keys:
+        keys, counts = reduce_counts(np.concatenate(buffer_keys), np.concatenate(buffer_counts))
+        spill(keys, counts, spill_dir, f"{start}.{spills}")
+    return total
+
+
+def iter_merged(runs: List[np.ndarray], block_rows: int = MERGE_ROWS) -> Generator[Tuple[np.ndarray, np.ndarray], None, None]:
+    """Streaming k-way merge of runs of unique keys sorted ascending, yields blocks of summed counts by ascending keys."""
+    positions = [0] * len(runs)
+    pending = [run[:0] for run in runs]
+    while True:
+        for i, run in enumerate(runs):
+            if len(pending[i]) == 0 and positions[i] < len(run):
+                pending[i] = np.asarray(run[positions[i]:positions[i] + block_rows])
+                positions[i] += len(pending[i])
+        active = [i for i in range(len(runs)) if len(pending[i]) > 0]
+        if not active:
+            return
+        # unread keys of a run are above its last pending key, so keys up to the lowest of those are complete
+        bounds = [pending[i][-1, 0] for i in active if positions[i] < len(runs[i])]
+        blocks = list()
+        for i in active:
+            cut = np.searchsorted(pending[i][:, 0], min(bounds), side="right") if bounds else len(pending[i])
+            blocks.append(pending[i][:cut])
+            pending[i] = pending[i][cut:]
+        merged = np.concatenate(blocks)
+        yield reduce_counts(merged[:, 0], merged[:, 1])
+
+
+def top_counts(keys: np.ndarray, counts: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+    if len(keys) <= top_k:
+        return keys, counts
+    selected = np.argpartition(counts, len(counts) - top_k)[len(counts) - top_k:]
+    return keys[selected], counts[selected]
+
+
+def merge_partition(spill_dir: str, part: int, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Merge the runs of a partition and keep its `top_k` keys, run in a pool worker.
+    Runs are memory-mapped and merged block by block, so memory does not grow with the partition."""
+    runs = [np.load(os.path.join(spill_dir, name), mmap_mode="r") for name in os.listdir(spill_dir) if name.startswith(f"{part}.")]
+    runs = [run for run in runs if len(run) > 0]
+    keys, counts = np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.uint64)
+    for block_keys, block_counts in iter_merged(runs):
+        keys, counts = np.concatenate([keys, block_keys]), np.concatenate([counts, block_counts])
+        if len(keys) >= 2 * max(top_k, MERGE_ROWS):
+            keys, counts = top_counts(keys, counts, top_k)
+    return top_counts(keys, counts, top_k)
+
+
+def recover_grams(fpath: str, start: int, end: int, n: int, top_keys: np.ndarray, glowbe: bool = True) -> Dict[int, str]:
+    """Strings of the top keys occurring in a byte range, run in a pool worker."""
+    grams = dict()
+    for words, line_ids in iter_blocks(fpath, start, end, glowbe):
+        keys, positions = gram_keys(words, line_ids, n)
+        hits = np.isin(keys, top_keys)
+        for key, i in zip(keys[hits].tolist(), positions[hits].tolist()):
+            if key not in grams:
+                grams[key] = " ".join(words[i:i + n])
+    return grams
+
+
+def count_ngrams(fpath: str, output_path: str, n: int = 3, top_k: int = TOP_K, glowbe: bool = True,
+                 max_workers: int = MAX_WORKERS, range_bytes: int = RANGE_BYTES) -> List[Tuple[str, int]]:
+    """Count the n-grams of a corpus and write its `top_k` most frequent ones.
+
+    Returns
+    -------
+    `(n-gram, frequency)` by descending frequency, ties broken alphabetically
+    """
+    ranges = split_ranges(fpath, range_bytes)
+    spill_dir = f"{output_path}.spill"
+    if os.path.isdir(spill_dir):
+        shutil.rmtree(spill_dir)
+    os.makedirs(spill_dir)
+    with ProcessPool(max_workers=max_workers) as pool:
+        futures = [pool.schedule(count_range, [fpath, start, end, n, spill_dir, glowbe]) for start, end in ranges]
+        total = sum(future.result() for future in futures)
+        futures = [pool.schedule(merge_partition, [spill_dir, part, top_k]) for part in range(PARTITIONS)]
+        candidates = list()
+        for future in futures:
+            keys, counts = future.result()
+            candidates.extend(zip(counts.tolist(), keys.tolist()))
+        top = heapq.nlargest(top_k, candidates)
+        top_keys = np.array(sorted(key for _, key in top), dtype=np.uint64)
+        futures = [pool.schedule(recover_grams, [fpath, start, end, n, top_keys, glowbe]) for start, end in ranges]
+        key2gram = dict()
+        for future in futures:
+            for key, gram in future.result().items():
+                key2gram.setdefault(key, gram)
+    shutil.rmtree(spill_dir)
+
+    grams = sorted(((key2gram[key], count) for count, key in top), key=lambda item: (-item[1], item[0]))
+    with open(f"{output_path}.tmp", "w") as fw:
+        fw.write(f"{n}gram\tfrequency\n")
+        for gram, count in grams:
+            fw.write(f"{gram}\t{count}\n")
+    os.replace(f"{output_path}.tmp", output_path)
+    print(f"{total} {n}-grams counted, top {len(grams)} written to {output_path}.")
+
+    return grams
+
+
+if __name__ == "__main__":
+    # usage: python ngram_counter.py {corpus} {output} [n] [top_k]
+    count_ngrams(sys.argv[1], sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 3,
+                 int(sys.argv[4]) if len(sys.argv) > 4 else TOP_K)
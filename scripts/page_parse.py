@@ -8,43 +8,78 @@
 # with timeout utility and text auto extraction.
 
 import os
-import re
 import sys
 import signal
-import datetime
 from glob import glob
 from pickle import load
-from dateutil.parser import parse
-from typing import Any, Dict, Generator, List, Tuple
+from collections import Counter, deque
+from concurrent.futures import TimeoutError as TaskTimeoutError
+from typing import Any, Dict, Generator, Iterable, List, Optional, TextIO, Tuple, Union
 
-# from pebble import ProcessPool  # no need if sequential parsing only
-from justext import justext, get_stoplist
-from gne import GeneralNewsExtractor as GNE
+from pebble import ProcessPool
+
+import metrics
+from date_norm import parse_date, validate_date
+from extract_cache import ExtractCache
+from extraction_engine import ExtractionEngine
+from page_store import iter_segment, list_segments
+from prefilter import PageRejected, get_stoplist, is_enabled, prefilter
+from text_norm import calc_word_nums, preprocess
+from warc_reader import RANGE_BYTES, iter_warc, list_warcs, split_ranges
 
 # country code
 CC = "cn"
-# data folder which contains pkl files to process
+# data folder which contains pkl files, page store segments or WARC files to process
 INPUT_FOLDER = f"data/{CC}"
 # output tsv file path
 OUPUT_PATH = f"data/metadata.raw.{CC}.tsv"
+# number of extraction processes, sequential parsing if set to 1
+MAX_WORKERS = os.cpu_count()
+# number of pages per scheduled task
+CHUNK_SIZE = 16
+# number of tasks after which a worker process is recycled
+MAX_TASKS = 100
+# timeout in seconds for extracting a single page
+PAGE_TIMEOUT = 15
+# timeout in seconds for reading and extracting a WARC byte range
+RANGE_TIMEOUT = 3600
+# run the cheap checks of `prefilter` before the extractor, and skip rejected pages:
+# None for the varieties enabled in `prefilter.VARIETY_CONFIG`, True / False for all of them,
+# set by `--prefilter` / `--no-prefilter` on the command line
+PREFILTER = None
+# extract the content with justext when GNE finds none, from the same parsed page, off by default
+# as pages GNE fails on would take a TextID, and each page costs a tree copy
+JUSTEXT_FALLBACK = False
+# extraction result cache shared by all the workers and varieties, None to disable
+EXTRACT_CACHE_PATH = "data/extract_cache.db"
+# extractor of each worker process, warmed up by `init_worker`
+WORKER_EXTRACTOR = None
 
 
 class PageExtractor(object):
-    """Page extractor base class"""
+    """Page extractor base class, results are looked up in `cache` first if given."""
 
-    def __init__(self):
+    def __init__(self, cache: Optional[ExtractCache] = None):
         super(PageExtractor).__init__()
         self.extractor = None
+        self.cache = cache
 
 
 class GNEPageExtractor(PageExtractor):
-    """Page extractor depends on GNE package"""
+    """Page extractor depends on GNE package, imported on first instantiation."""
 
-    def __init__(self):
-        super(GNEPageExtractor, self).__init__()
+    def __init__(self, cache: Optional[ExtractCache] = None):
+        super(GNEPageExtractor, self).__init__(cache)
+        from gne import GeneralNewsExtractor as GNE, __version__
         self.extractor = GNE()
+        self.extractor_id = f"gne-{__version__}"
 
     def __call__(self, *args: Any, **kwargs: Any) -> Tuple[str, str]:
+        if self.cache is None:
+            return self.extract(*args)
+        return self.cache.get_or_extract(args[0], f"{self.extractor_id}{args[1:]}", lambda html: self.extract(html, *args[1:]))
+
+    def extract(self, *args: Any) -> Tuple[str, str, str]:
         res = self.extractor.extract(*args)
         return res["title"], res["publish_time"], res["content"]
 
@@ -53,13 +88,20 @@ class GNEPageExtractor(PageExtractor):
 
 
 class JustextPageExtractor(PageExtractor):
-    """Page extractor depends on Justext package"""
+    """Page extractor depends on Justext package, imported on first instantiation."""
 
-    def __init__(self):
-        super(JustextPageExtractor, self).__init__()
+    def __init__(self, cache: Optional[ExtractCache] = None):
+        super(JustextPageExtractor, self).__init__(cache)
+        from justext import justext, __version__
         self.extractor = justext
+        self.extractor_id = f"justext-{__version__}"
 
     def __call__(self, html: str, *args: Any, **kwargs: Any) -> List:
+        if self.cache is None:
+            return self.extract(html)
+        return self.cache.get_or_extract(html, self.extractor_id, self.extract)
+
+    def extract(self, html: str) -> List:
         text_list = list()
         paras = self.extractor(html, get_stoplist("English"))
         for para in paras:
@@ -89,24 +131,6 @@ class Timeout:
         signal.alarm(0)
 
 
-def preprocess(text: str) -> str:
-    """preprocess for input text, e.g., title, content.
-    including: 1) remove none-english text, 2) remove html/css/js code,
-    3) remove control characters. 4) etc.
-    """
-    text = re.sub(r'</?[a-zA-Z][^>]*>', '', text)
-    text = re.sub(r"[\u4e00-\u9fff]+", "", text)
-    return " ".join(text.split())
-
-
-def calc_word_nums(text: str) -> int:
-    """calc words for input text according to space."""
-    for punc in '''!()-[]{};:'"\,<>./?@#$%^&*_~''':
-        text = text.replace(punc, "")
-    word_list = [w for w in text.split() if w and not w.isspace()]
-    return len(word_list)
-
-
 def parse_domain(url: str) -> str:
     """parse domain for input url."""
     return url.split("://", 1)[1].split("/", 1)[0].strip()
@@ -114,7 +138,10 @@ def parse_domain(url: str) -> str:
 
 def parse_datetime(s: str) -> str:
     """parse datatime to target format."""
-    return parse(s).strftime("%Y-%m-%d")
+    date = parse_date(s)
+    if date is None:
+        raise ValueError(f"unknown date format: {s}")
+    return date
 
 
 def pkl_loader(fpath: str = INPUT_FOLDER) -> Generator:
@@ -123,65 +150,303 @@ def pkl_loader(fpath: str = INPUT_FOLDER) -> Generator:
         yield (fpath, load(open(file=fpath, mode="rb")))
 
 
-def item_loader(d: Dict) -> Generator:
-    """item loader for url2pair dictionary"""
-    for i, item in enumerate(d.items()):
+def store_loader(fpath: str = INPUT_FOLDER) -> Generator:
+    """page store segment loader, streaming `(url, (time, raw_html))` pairs of each segment"""
+    for segment_path in list_segments(fpath):
+        yield (segment_path, ((url, (time, raw_html)) for url, time, raw_html in iter_segment(segment_path)))
+
+
+def warc_loader(fpath: str = INPUT_FOLDER) -> Generator:
+    """WARC file loader, streaming `(url, (time, raw_html))` pairs of HTML responses in each file"""
+    for warc_path in list_warcs(fpath):
+        yield (warc_path, ((url, (time, raw_html)) for url, time, raw_html, _ in iter_warc(warc_path)))
+
+
+def page_loader(fpath: str = INPUT_FOLDER) -> Generator:
+    """page loader, prefer streaming page store segments, then WARC files, then pickle files"""
+    if list_segments(fpath):
+        yield from store_loader(fpath)
+    elif list_warcs(fpath):
+        yield from warc_loader(fpath)
+    else:
+        yield from pkl_loader(fpath)
+
+
+def item_loader(d: Union[Dict, Iterable]) -> Generator:
+    """item loader for url2pair dictionary, or stream of `(url, (time, raw_html))` pairs"""
+    for i, item in enumerate(d.items() if isinstance(d, dict) else d):
         url = item[0]
         time = item[1][0]
         raw_html = item[1][1]
         yield i, url, time, raw_html
 
 
+def build_row(url: str, time: str, title: str, publish_time: str, content: str) -> Tuple[int, str]:
+    """Build the metadata tsv row of an extracted page, except its TextID.
+
+    Returns
+    -------
+    word nums of content and the row without TextID
+    """
+    time = time if publish_time == "" else publish_time  # time used time format
+    if time != "NULL":
+        try:
+            time = parse_datetime(time)
+            print(f"updated time from web page: {time}")
+        except:
+            pass
+    time = validate_date(time)  # NULL if not a date between 1985 and 2022
+
+    words = calc_word_nums(content)  # calculate word nums according to `\s` nums
+    variety = CC  # country code
+    genre = "G"  # stand for "general"
+    domain = parse_domain(url)  # parse domain for each url
+    url = url.strip()
+    title, content = preprocess(title), preprocess(content)  # preprocess title and content
+
+    return words, f"{time}\t{words}\t{variety}\t{genre}\t{domain}\t{url}\t{title}\t{content}\n"
+
+
+def init_worker(cc: str = None) -> None:
+    """Pool initializer, warm up one extractor per worker process, optionally for another variety."""
+    global WORKER_EXTRACTOR, CC
+    if WORKER_EXTRACTOR is not None and WORKER_EXTRACTOR.cache is not None:
+        WORKER_EXTRACTOR.cache.close()
+    cache = ExtractCache(EXTRACT_CACHE_PATH) if EXTRACT_CACHE_PATH is not None else None
+    WORKER_EXTRACTOR = ExtractionEngine(fallback=JUSTEXT_FALLBACK, cache=cache)  # use GNE as default page parser, on a single parse
+    CC = cc or CC
+
+
+def flush_worker() -> None:
+    """Write the metrics and cache hit recency buffered by current process, pool workers exit
+    without running atexit nor closing their cache."""
+    metrics.flush()
+    if WORKER_EXTRACTOR is not None and WORKER_EXTRACTOR.cache is not None:
+        WORKER_EXTRACTOR.cache.touch()
+
+
+def extract_page(url: str, time: str, raw_html: str) -> Tuple[int, str]:
+    """Extract a single page with the extractor of current process.
+    Raise `PageRejected` for a page rejected by the pre-filtering cascade of current variety."""
+    if WORKER_EXTRACTOR is None:
+        init_worker()
+    metrics.incr("extract.bytes_read", len(raw_html))
+    if PREFILTER or (PREFILTER is None and is_enabled(CC)):
+        with metrics.timer("extract.prefilter_seconds"):
+            prefilter(raw_html, CC)
+    with metrics.timer("extract.page_seconds"):
+        title, publish_time, content = WORKER_EXTRACTOR(raw_html)
+    with metrics.timer("extract.row_seconds"):
+        return build_row(url, time, title, publish_time, content)
+
+
+def extract_chunk(items: List[Tuple[str, str, str, str]]) -> List[Tuple[str, str, int, str]]:
+    """Extract a chunk of `(location, url, time, raw_html)` items in worker process.
+
+    Returns
+    -------
+    `(status, location, words, row)` for each item, with error message as row if status is not `ok`
+    """
+    results = list()
+    for location, url, time, raw_html in items:
+        try:
+            words, row = extract_page(url, time, raw_html)
+        except PageRejected as e:
+            results.append(("filtered", location, 0, e.reason))
+        except Exception as e:
+            results.append(("error", location, 0, str(e)))
+        else:
+            results.append(("ok", location, words, row))
+    flush_worker()
+    return results
+
+
+class RowWriter:
+    """Write extraction results in the order they are given, assigning sequential TextIDs.
+    Pages rejected by the pre-filter are counted by reason in `rejections`, and like pages
+    the extractor fails on, take no TextID."""
+
+    def __init__(self, output_file: TextIO):
+        self.output_file = output_file
+        self.idx = 0
+        self.rejections = Counter()
+
+    def write(self, results: Iterable[Tuple[str, str, int, str]]) -> None:
+        for status, location, words, row in results:
+            if status == "timeout":
+                print(f"parse error: timeout, at {location}")
+                metrics.incr("extract.timeouts")
+                continue
+            if status == "error":
+                print(f"parse error: {row}, at {location}")
+                metrics.incr("extract.errors")
+                continue
+            if status == "filtered":
+                self.rejections[row] += 1
+                metrics.incr(f"prefilter.{row}")
+                continue
+            text_id = str(self.idx).zfill(8)  # generate text id with left2right padding
+            self.idx += 1
+            # drop when word nums less than 5
+            if words < 5:
+                metrics.incr("extract.rows_short")
+                continue
+            # write new line to output file
+            line = f"{text_id}\t{row}"
+            self.output_file.write(line)
+            metrics.incr("extract.rows_written")
+            metrics.incr("extract.bytes_written", len(line))
+
+
+def iter_items(fpath: str = INPUT_FOLDER) -> Generator[Tuple[str, str, str, str], None, None]:
+    """Yield `(location, url, time, raw_html)` of all the pages to parse."""
+    for page_fpath, url2pair in page_loader(fpath):
+        for i, url, time, raw_html in item_loader(url2pair):
+            yield f"{page_fpath}:{i}", url, time, raw_html
+
+
+def get_chunks(items: Iterable, n: int) -> Generator[List, None, None]:
+    """Yield successive n-sized chunks from an iterable."""
+    chunk = list()
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == n:
+            yield chunk
+            chunk = list()
+    if chunk:
+        yield chunk
+
+
+def parse_sequential(items: Iterable[Tuple[str, str, str, str]], writer: RowWriter) -> None:
+    """Parse pages one by one in current process, with SIGALRM-based timeout."""
+    for location, url, time, raw_html in items:
+        try:
+            with Timeout(PAGE_TIMEOUT):
+                words, row = extract_page(url, time, raw_html)
+        except TimeoutError as e:
+            writer.write([("timeout", location, 0, "")])
+        except PageRejected as e:
+            writer.write([("filtered", location, 0, e.reason)])
+        except Exception as e:
+            writer.write([("error", location, 0, str(e))])
+        else:
+            writer.write([("ok", location, words, row)])
+
+
+def collect_chunk(pool: ProcessPool, chunk: List[Tuple[str, str, str, str]], future: Any, page_timeout: int = PAGE_TIMEOUT) -> List[Tuple[str, str, int, str]]:
+    """Wait for the results of a chunk. If the chunk timed out or its worker died,
+    its pages are rescheduled one per task so that a single bad page only loses itself."""
+    try:
+        return future.result()
+    except Exception:
+        metrics.incr("extract.chunk_retries")
+    futures = [pool.schedule(extract_chunk, [[item]], timeout=page_timeout) for item in chunk]
+    results = list()
+    for item, future in zip(chunk, futures):
+        try:
+            results += future.result()
+        except TaskTimeoutError:
+            results.append(("timeout", item[0], 0, ""))
+        except Exception as e:
+            results.append(("error", item[0], 0, str(e)))
+    return results
+
+
+def parse_parallel(items: Iterable[Tuple[str, str, str, str]], writer: RowWriter, max_workers: int = MAX_WORKERS,
+                   chunk_size: int = CHUNK_SIZE, max_tasks: int = MAX_TASKS, page_timeout: int = PAGE_TIMEOUT) -> None:
+    """Parse pages on a process pool.
+    Chunks of pages are scheduled with a timeout proportional to their size, and consumed
+    in submission order through a bounded window, so TextIDs are the same as sequential parsing."""
+    window = deque()
+    with ProcessPool(max_workers=max_workers, max_tasks=max_tasks, initializer=init_worker) as pool:
+        for chunk in get_chunks(items, chunk_size):
+            future = pool.schedule(extract_chunk, [chunk], timeout=page_timeout * len(chunk))
+            window.append((chunk, future))
+            while len(window) >= 4 * max_workers:
+                writer.write(collect_chunk(pool, *window.popleft(), page_timeout))
+        while window:
+            writer.write(collect_chunk(pool, *window.popleft(), page_timeout))
+
+
+def extract_warc_range(warc_path: str, start: int, end: int, page_timeout: int = PAGE_TIMEOUT) -> List[Tuple[str, str, int, str]]:
+    """Read and extract the records of a WARC byte range in worker process.
+    Each page is timed out by SIGALRM, which works here as a pool worker runs tasks in its main thread."""
+    results = list()
+    for url, time, raw_html, offset in iter_warc(warc_path, start, end):
+        location = f"{warc_path}@{offset}"
+        try:
+            with Timeout(page_timeout):
+                words, row = extract_page(url, time, raw_html)
+        except TimeoutError:
+            results.append(("timeout", location, 0, ""))
+        except PageRejected as e:
+            results.append(("filtered", location, 0, e.reason))
+        except Exception as e:
+            results.append(("error", location, 0, str(e)))
+        else:
+            results.append(("ok", location, words, row))
+    flush_worker()
+    return results
+
+
+def collect_warc_range(pool: ProcessPool, warc_path: str, start: int, end: int, future: Any,
+                       page_timeout: int = PAGE_TIMEOUT) -> List[Tuple[str, str, int, str]]:
+    """Wait for the results of a WARC byte range. If the range timed out or its worker died,
+    its records are rescheduled one per task by their offsets, as `collect_chunk` does with
+    pages, so that a single bad page only loses itself."""
+    try:
+        return future.result()
+    except Exception as e:
+        print(f"parse error: {type(e).__name__} {e}, at range {warc_path}@{start}, retried record by record")
+        metrics.incr("extract.range_retries")
+    # a record belongs to the range its offset falls in, so `[offset, offset + 1)` holds it alone
+    offsets = [offset for _, _, _, offset in iter_warc(warc_path, start, end)]
+    futures = [pool.schedule(extract_warc_range, [warc_path, offset, offset + 1, page_timeout], timeout=2 * page_timeout)
+               for offset in offsets]
+    results = list()
+    for offset, future in zip(offsets, futures):
+        try:
+            results += future.result()
+        except TaskTimeoutError:
+            results.append(("timeout", f"{warc_path}@{offset}", 0, ""))
+        except Exception as e:
+            results.append(("error", f"{warc_path}@{offset}", 0, str(e)))
+    return results
+
+
+def parse_warc_parallel(warc_paths: List[str], writer: RowWriter, max_workers: int = MAX_WORKERS, max_tasks: int = MAX_TASKS,
+                        range_bytes: int = RANGE_BYTES, range_timeout: int = RANGE_TIMEOUT, page_timeout: int = PAGE_TIMEOUT) -> None:
+    """Parse WARC files on a process pool, each task reads and extracts a byte range of a file,
+    ranges are consumed in file & offset order so TextIDs are deterministic."""
+    window = deque()
+    with ProcessPool(max_workers=max_workers, max_tasks=max_tasks, initializer=init_worker) as pool:
+        for warc_path in warc_paths:
+            for start, end in split_ranges(warc_path, range_bytes):
+                future = pool.schedule(extract_warc_range, [warc_path, start, end, page_timeout], timeout=range_timeout)
+                window.append((warc_path, start, end, future))
+                while len(window) >= 2 * max_workers:
+                    writer.write(collect_warc_range(pool, *window.popleft(), page_timeout))
+        while window:
+            writer.write(collect_warc_range(pool, *window.popleft(), page_timeout))
+
+
 if __name__ == "__main__":
+    # usage: python page_parse.py [--prefilter | --no-prefilter]
+    if "--prefilter" in sys.argv[1:]:
+        PREFILTER = True
+    elif "--no-prefilter" in sys.argv[1:]:
+        PREFILTER = False
 
-    idx = 0
     ouput_file = open(OUPUT_PATH, "w")
     ouput_file.write("TextID\tTime\tWords\tVariety\tGenre\tDomain\tURL\tTitle\tContent\n")
-    parser = GNEPageExtractor()  # use GNE as default page parser
-
-    for pkl_fpath, url2pair in pkl_loader():
+    writer = RowWriter(ouput_file)
 
-        for i, url, time, raw_html in item_loader(url2pair):
-            try:
-                with Timeout(15):
-                    title, publish_time, content = parser(raw_html)
-            except TimeoutError as e:
-                print(f"parse error: timeout, at {pkl_fpath}:{i}")
-                continue
-            except Exception as e:
-                print(f"parse error: {e}, at {pkl_fpath}:{i}")
-                continue
-            else:
-                text_id = str(idx).zfill(8)  # generate text id with left2right padding
-                time = time if publish_time == "" else publish_time  # time used time format
-                if time != "NULL":
-                    try:
-                        time = parse_datetime(time)
-                        print(f"updated time from web page: {time}")
-                    except:
-                        pass
-                try:
-                    year, month, day = time.split('-')
-                    datetime.datetime(int(year), int(month), int(day))
-                except ValueError:
-                    time = "NULL"
-                else:
-                    if int(year) < 1985 or int(year) > 2022:
-                        time = "NULL"
-
-                words = calc_word_nums(content)  # calculate word nums according to `\s` nums
-                variety = CC  # country code
-                genre = "G"  # stand for "general"
-                domain = parse_domain(url)  # parse domain for each url
-                url = url.strip()
-                title, content = preprocess(title), preprocess(content)  # preprocess title and content
-                idx += 1
-
-                # drop when word nums less than 5
-                if words < 5:
-                    continue
-
-                # write new line to output file
-                ouput_file.write(f"{text_id}\t{time}\t{words}\t{variety}\t{genre}\t{domain}\t{url}\t{title}\t{content}\n")
+    if MAX_WORKERS > 1 and not list_segments(INPUT_FOLDER) and list_warcs(INPUT_FOLDER):
+        parse_warc_parallel(list_warcs(INPUT_FOLDER), writer)
+    elif MAX_WORKERS > 1:
+        parse_parallel(iter_items(), writer)
+    else:
+        parse_sequential(iter_items(), writer)
 
     ouput_file.close()
+    print(f"{writer.idx} pages, rejected by pre-filter: {dict(writer.rejections)}")
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# @author: YangLiu
+# @email: yangliu.real@gmail.com
+
+# Append-only streaming store for raw crawled pages, replacing whole-dict pickles.
+# A store is a directory of segment files `pages.{n}.pgs`, each of which consists of
+#     header: magic `CCPS` + 1 byte version + 1 byte codec
+#     records: 4 bytes little-endian length + compressed `url \0 time \0 raw_html` (utf-8)
+# Records are compressed one by one, so readers stream a segment with constant memory,
+# and a segment truncated by a crash is readable up to its last complete record.
+
+import os
+import sys
+import gzip
+import struct
+from glob import glob
+from pickle import load
+from typing import Generator, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b"CCPS"
+VERSION = 1
+CODECS = {"none": 0, "gzip": 1, "zstd": 2}
+# segment size in bytes after which the writer rolls over to a new segment
+MAX_SEGMENT_BYTES = 1 << 30
+LENGTH = struct.Struct("<I")
+
+
+def get_compressor(codec: str):
+    if codec == "none":
+        return lambda data: data
+    if codec == "gzip":
+        return lambda data: gzip.compress(data, compresslevel=6, mtime=0)
+    if zstandard is None:
+        raise ImportError("Please check pkg `zstandard`'s installation for zstd codec.")
+    return zstandard.ZstdCompressor(level=3).compress
+
+
+def get_decompressor(codec: str):
+    if codec == "none":
+        return lambda data: data
+    if codec == "gzip":
+        return gzip.decompress
+    if zstandard is None:
+        raise ImportError("Please check pkg `zstandard`'s installation for zstd codec.")
+    return zstandard.ZstdDecompressor().decompress
+
+
+class PageStoreWriter:
+    """Append pages to a store directory, rolling over to a new segment every `max_segment_bytes`.
+    Reopening a store never touches existing segments, new pages go to a new segment."""
+
+    def __init__(self, store_dir: str, codec: str = "gzip", max_segment_bytes: int = MAX_SEGMENT_BYTES):
+        if codec not in CODECS:
+            raise ValueError(f"unknown codec: {codec}")
+        os.makedirs(store_dir, exist_ok=True)
+        self.store_dir = store_dir
+        self.codec = codec
+        self.compress = get_compressor(codec)
+        self.max_segment_bytes = max_segment_bytes
+        self.segment_idx = len(list_segments(store_dir))
+        self.segment = None
+        self.page_nums = 0
+
+    def _roll(self) -> None:
+        if self.segment is not None:
+            self.segment.close()
+        segment_path = os.path.join(self.store_dir, f"pages.{str(self.segment_idx).zfill(5)}.pgs")
+        self.segment = open(segment_path, "xb")
+        self.segment.write(MAGIC + bytes([VERSION, CODECS[self.codec]]))
+        self.segment_idx += 1
+
+    def append(self, url: str, time: str, raw_html: str) -> None:
+        if self.segment is None or self.segment.tell() >= self.max_segment_bytes:
+            self._roll()
+        record = self.compress(f"{url}\0{time}\0{raw_html}".encode("utf-8"))
+        self.segment.write(LENGTH.pack(len(record)))
+        self.segment.write(record)
+        self.page_nums += 1
+
+    def close(self) -> None:
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+
+    def __enter__(self) -> "PageStoreWriter":
+        return self
+
+    def __exit__(self, type, value, traceback) -> None:
+        self.close()
+
+
+def list_segments(store_dir: str):
+    return sorted(glob(os.path.join(store_dir, "pages.*.pgs")))
+
+
+def iter_segment(segment_path: str) -> Generator[Tuple[str, str, str], None, None]:
+    """Stream `(url, time, raw_html)` records of a segment."""
+    with open(segment_path, "rb") as f:
+        header = f.read(len(MAGIC) + 2)
+        if header[:len(MAGIC)] != MAGIC or header[len(MAGIC)] != VERSION:
+            raise ValueError(f"not a page store segment: {segment_path}")
+        decompress = get_decompressor({v: k for k, v in CODECS.items()}[header[len(MAGIC) + 1]])
+        while True:
+            prefix = f.read(LENGTH.size)
+            if not prefix:
+                break
+            record = f.read(LENGTH.unpack(prefix)[0]) if len(prefix) == LENGTH.size else b""
+            if len(prefix) < LENGTH.size or len(record) < LENGTH.unpack(prefix)[0]:
+                print(f"truncated record at the end of {segment_path}, skipped")
+                break
+            url, time, raw_html = decompress(record).decode("utf-8").split("\0", 2)
+            yield url, time, raw_html
+
+
+def iter_store(store_dir: str) -> Generator[Tuple[str, str, str], None, None]:
+    """Stream `(url, time, raw_html)` records of all the segments in a store."""
+    for segment_path in list_segments(store_dir):
+        yield from iter_segment(segment_path)
+
+
+def convert_pickles(pkl_dir: str, store_dir: str, codec: str = "gzip") -> int:
+    """One-shot conversion of `url -> (time, raw_html)` pickles into a page store,
+    one pickle is held in memory at a time."""
+    page_nums = 0
+    with PageStoreWriter(store_dir, codec) as writer:
+        for pkl_fpath in sorted(glob(os.path.join(pkl_dir, "*.pkl"))):
+            with open(pkl_fpath, "rb") as f:
+                url2pair = load(f)
+            for url, (time, raw_html) in url2pair.items():
+                writer.append(url, time, raw_html)
+            page_nums += len(url2pair)
+            print(f"{pkl_fpath} => {len(url2pair)} pages")
+            del url2pair
+
+    return page_nums
+
+
+if __name__ == "__main__":
+    # usage: python page_store.py data/cn data/cn [gzip|zstd|none]
+    page_nums = convert_pickles(sys.argv[1], sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else "gzip")
+    print(f"converted {page_nums} pages.")
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# @author: YangLiu
+# @email: yangliu.real@gmail.com
+
+# Cheap pre-filtering cascade run by `page_parse` before the page extractor,
+# from the cheapest check to the most expensive one, the first failing check rejects the page:
+#     size:       raw html shorter than `min_chars` or longer than `max_chars`
+#     markup:     visible text (html without scripts, styles, comments and tags), spaces and newlines
+#                 excluded, is less than `min_text_ratio` of the raw html, i.e. boilerplate or app-only pages
+#     script:     ASCII/Latin letters are less than `min_latin_ratio` of the letters of the visible text,
+#                 counted on its UTF-8 bytes: ASCII letters vs. lead bytes of multi-byte characters
+#     language:   fewer than `min_words` words in a sample of the visible text, or fewer than
+#                 `min_stopword_ratio` of them in the English stoplist of justext
+# The visible text is computed once and shared by the last three checks, which only look at its
+# first `sample_chars` characters. Any threshold set to None disables its check.
+# Thresholds are loose enough to only drop pages the extractor would not turn into English
+# content anyway, and can be overridden per variety in `VARIETY_CONFIG`.
+# `page_parse` runs the cascade for the varieties whose `enabled` is set, until validated on
+# their crawled pages none is, or for all of them with `python page_parse.py --prefilter`.
+
+import re
+from functools import lru_cache
+from typing import Dict, FrozenSet, Optional
+
+DEFAULT_CONFIG = {
+    "enabled": False,
+    "min_chars": 500,
+    "max_chars": 5 << 20,
+    "min_text_ratio": 0.01,
+    "min_latin_ratio": 0.5,
+    "min_words": 5,
+    "min_stopword_ratio": 0.12,
+    "sample_chars": 20000,
+}
+# per variety overrides of `DEFAULT_CONFIG`, pages of varieties with Chinese-speaking
+# readerships often carry Chinese navigation around English articles
+VARIETY_CONFIG = {
+    "cn": {"min_latin_ratio": 0.3},
+    "hk": {"min_latin_ratio": 0.3},
+    "mo": {"min_latin_ratio": 0.3},
+    "tw": {"min_latin_ratio": 0.3},
+}
+# reasons of rejection, in cascade order
+REASONS = ["too_small", "too_large", "markup", "script", "too_few_words", "language"]
+
+INVISIBLE = re.compile(r"<script\b.*?</script\s*>|<style\b.*?</style\s*>|<!--.*?-->", re.IGNORECASE | re.DOTALL)
+TAG = re.compile(r"<[^>]*>")
+ASCII_LETTERS = bytes(range(ord("A"), ord("Z") + 1)) + bytes(range(ord("a"), ord("z") + 1))
+# lead bytes of characters beyond U+024F, i.e. out of Latin-1 supplement and Latin extended
+NON_LATIN_LEADS = bytes(range(0xCA, 0x100))
+STRIP_CHARS = '''!()-[]{};:'"\\,<>./?@#$%^&*_~'''
+
+
+class PageRejected(Exception):
+    """Raised for a page rejected by the cascade, `reason` is one of `REASONS`."""
+
+    def __init__(self, reason: str):
+        super(PageRejected, self).__init__(reason)
+        self.reason = reason
+
+
+@lru_cache(maxsize=None)
+def get_stoplist(language: str = "English") -> FrozenSet[str]:
+    """Justext stoplist, read once per process."""
+    from justext import get_stoplist as load_stoplist
+    return load_stoplist(language)
+
+
+@lru_cache(maxsize=None)
+def get_config(cc: Optional[str] = None) -> Dict:
+    """Cascade configuration of a variety."""
+    config = dict(DEFAULT_CONFIG)
+    config.update(VARIETY_CONFIG.get(cc, dict()))
+    return config
+
+
+def is_enabled(cc: Optional[str] = None) -> bool:
+    """Whether `page_parse` runs the cascade on the pages of a variety by default."""
+    return bool(get_config(cc)["enabled"])
+
+
+def visible_text(raw_html: str) -> str:
+    return TAG.sub(" ", INVISIBLE.sub(" ", raw_html))
+
+
+def latin_ratio(text: str) -> float:
+    """Ratio of ASCII/Latin letters among the letters of `text`."""
+    data = text.encode("utf-8", "surrogatepass")
+    letters = len(data) - len(data.translate(None, ASCII_LETTERS))
+    non_latin = len(data) - len(data.translate(None, NON_LATIN_LEADS))
+    return letters / (letters + non_latin) if letters + non_latin else 0.0
+
+
+def stopword_ratio(words: list, stoplist: FrozenSet[str]) -> float:
+    return sum(1 for word in words if word.strip(STRIP_CHARS) in stoplist) / len(words)
+
+
+def check_page(raw_html: str, cc: Optional[str] = None) -> Optional[str]:
+    """Run the cascade on a page, return the reason of rejection, or None if the page passed."""
+    config = get_config(cc)
+    size = len(raw_html)
+    if config["min_chars"] is not None and size < config["min_chars"]:
+        return "too_small"
+    if config["max_chars"] is not None and size > config["max_chars"]:
+        return "too_large"
+
+    text = visible_text(raw_html)
+    if config["min_text_ratio"] is not None and len(text) - text.count(" ") - text.count("\n") < config["min_text_ratio"] * size:
+        return "markup"
+    sample = text[:config["sample_chars"]]
+    if config["min_latin_ratio"] is not None and latin_ratio(sample) < config["min_latin_ratio"]:
+        return "script"
+    words = sample.lower().split()
+    if config["min_words"] is not None and len(words) < config["min_words"]:
+        return "too_few_words"
+    if config["min_stopword_ratio"] is not None and words and stopword_ratio(words, get_stoplist("English")) < config["min_stopword_ratio"]:
+        return "language"
+    return None
+
+
+def prefilter(raw_html: str, cc: Optional[str] = None) -> None:
+    """Raise `PageRejected` if the page is rejected by the cascade."""
+    reason = check_page(raw_html, cc)
+    if reason is not None:
+        raise PageRejected(reason)
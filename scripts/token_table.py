@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# @author: YangLiu
+# @email: yangliu.real@gmail.com
+
+# Compact columnar token table, binary alternative to the GloWbE-like wlp/db files.
+# Layout of a table directory:
+#     meta.json           numbers of documents & tokens, byte order and format version
+#     text_ids.txt        one TextID per line, in document order
+#     offsets.u64         token offset of each document, plus the total number of tokens at the end
+#     word_ids.u32        WordID of each token, which refers to lexicon.tsv
+#     seq_ids.u32         SequenceWordID of each token
+#     {flag}.bits         bit-packed IsStopWord, IsSentenceStart, IsSentenceEnd, 8 tokens per byte
+# All the columns are memory-mapped by `TokenTable`, so slicing a document costs no copy.
+
+import os
+import sys
+import json
+import mmap
+import shutil
+from array import array
+from typing import Any, Dict, Generator, List, Tuple
+
+TABLE_VERSION = 1
+FLAG_NAMES = ("is_stop", "is_sent_start", "is_sent_end")
+# number of tokens buffered in memory before flushing the columns to disk
+FLUSH_SIZE = 1 << 20
+
+
+class TokenTableWriter:
+    """Streaming writer of a token table, documents must be added in TextID order.
+    The table is written to `{table_dir}.tmp` and moved into place by `close`."""
+
+    def __init__(self, table_dir: str):
+        self.table_dir = table_dir
+        self.tmp_dir = f"{table_dir}.tmp"
+        if os.path.isdir(self.tmp_dir):
+            shutil.rmtree(self.tmp_dir)
+        os.makedirs(self.tmp_dir)
+        self.text_ids_file = open(os.path.join(self.tmp_dir, "text_ids.txt"), "w")
+        self.offsets_file = open(os.path.join(self.tmp_dir, "offsets.u64"), "wb")
+        self.word_ids_file = open(os.path.join(self.tmp_dir, "word_ids.u32"), "wb")
+        self.seq_ids_file = open(os.path.join(self.tmp_dir, "seq_ids.u32"), "wb")
+        self.flag_files = [open(os.path.join(self.tmp_dir, f"{name}.bits"), "wb") for name in FLAG_NAMES]
+        self.word_ids, self.seq_ids = array("I"), array("I")
+        self.flag_bytes = [bytearray() for _ in FLAG_NAMES]
+        self.flag_byte = [0 for _ in FLAG_NAMES]
+        self.doc_nums, self.token_nums = 0, 0
+
+    def add_document(self, text_id: str) -> None:
+        self.text_ids_file.write(f"{text_id}\n")
+        array("Q", [self.token_nums]).tofile(self.offsets_file)
+        self.doc_nums += 1
+
+    def add_token(self, word_id: int, seq_id: int, flags: int) -> None:
+        """Add a token to the current document, `flags` is a bitmask ordered as `FLAG_NAMES`."""
+        self.word_ids.append(word_id)
+        self.seq_ids.append(seq_id)
+        bit = self.token_nums & 7
+        for i in range(len(FLAG_NAMES)):
+            if flags >> i & 1:
+                self.flag_byte[i] |= 1 << bit
+            if bit == 7:
+                self.flag_bytes[i].append(self.flag_byte[i])
+                self.flag_byte[i] = 0
+        self.token_nums += 1
+        if len(self.word_ids) >= FLUSH_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        self.word_ids.tofile(self.word_ids_file)
+        self.seq_ids.tofile(self.seq_ids_file)
+        del self.word_ids[:], self.seq_ids[:]
+        for f, flag_bytes in zip(self.flag_files, self.flag_bytes):
+            f.write(flag_bytes)
+            del flag_bytes[:]
+
+    def close(self) -> str:
+        self.flush()
+        if self.token_nums & 7:
+            for f, flag_byte in zip(self.flag_files, self.flag_byte):
+                f.write(bytes([flag_byte]))
+        array("Q", [self.token_nums]).tofile(self.offsets_file)
+        for f in [self.text_ids_file, self.offsets_file, self.word_ids_file, self.seq_ids_file, *self.flag_files]:
+            f.close()
+        meta = {"version": TABLE_VERSION, "byteorder": sys.byteorder, "docs": self.doc_nums, "tokens": self.token_nums}
+        with open(os.path.join(self.tmp_dir, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+        if os.path.isdir(self.table_dir):
+            shutil.rmtree(self.table_dir)
+        os.replace(self.tmp_dir, self.table_dir)
+        return self.table_dir
+
+
+class TokenTable:
+    """Memory-mapped reader of a token table.
+
+    Usage
+    -----
+    with TokenTable("CCbE/hk/table") as table:
+        word_ids = table.word_ids_of("00000042")  # zero-copy memoryview of uint32
+        array = TokenTable.as_numpy(word_ids)  # zero-copy numpy view, if numpy is installed
+    Views and arrays returned by the table are slices of the mapped files: a file they still
+    refer to stays mapped after `close`, until the last of them is garbage collected.
+    """
+
+    def __init__(self, table_dir: str):
+        with open(os.path.join(table_dir, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        if self.meta["version"] != TABLE_VERSION:
+            raise ValueError(f"unsupported token table version: {self.meta['version']}")
+        if self.meta["byteorder"] != sys.byteorder:
+            raise ValueError(f"token table is {self.meta['byteorder']}-endian, but this machine is {sys.byteorder}-endian")
+        with open(os.path.join(table_dir, "text_ids.txt"), "r") as f:
+            self.text_ids = [line.rstrip("\n") for line in f]
+        self.textid2index = {text_id: i for i, text_id in enumerate(self.text_ids)}
+        self.mmaps = list()
+        self.offsets = self._map(os.path.join(table_dir, "offsets.u64"), "Q")
+        self.word_ids = self._map(os.path.join(table_dir, "word_ids.u32"), "I")
+        self.seq_ids = self._map(os.path.join(table_dir, "seq_ids.u32"), "I")
+        self.flags = {name: self._map(os.path.join(table_dir, f"{name}.bits"), "B") for name in FLAG_NAMES}
+
+    def _map(self, fpath: str, fmt: str) -> memoryview:
+        with open(fpath, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return memoryview(b"").cast(fmt)
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.mmaps.append(mm)
+        return memoryview(mm).cast(fmt)
+
+    def __len__(self) -> int:
+        return len(self.text_ids)
+
+    def __enter__(self) -> "TokenTable":
+        return self
+
+    def __exit__(self, type, value, traceback) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Unmap the columns, except those still exported by views or arrays of the caller,
+        which are unmapped by garbage collection once these are gone."""
+        for view in [self.offsets, self.word_ids, self.seq_ids, *self.flags.values()]:
+            try:
+                view.release()
+            except BufferError:
+                pass
+        for mm in self.mmaps:
+            try:
+                mm.close()
+            except BufferError:
+                pass
+        self.mmaps = list()
+
+    def doc_range(self, text_id: str) -> Tuple[int, int]:
+        """Token offsets `[start, end)` of a document."""
+        index = self.textid2index[text_id]
+        return self.offsets[index], self.offsets[index + 1]
+
+    def word_ids_of(self, text_id: str) -> memoryview:
+        start, end = self.doc_range(text_id)
+        return self.word_ids[start:end]
+
+    def seq_ids_of(self, text_id: str) -> memoryview:
+        start, end = self.doc_range(text_id)
+        return self.seq_ids[start:end]
+
+    def flag(self, name: str, position: int) -> bool:
+        return bool(self.flags[name][position >> 3] >> (position & 7) & 1)
+
+    def flags_of(self, text_id: str, name: str) -> List[bool]:
+        start, end = self.doc_range(text_id)
+        return [self.flag(name, position) for position in range(start, end)]
+
+    def iter_documents(self) -> Generator[Tuple[str, memoryview], None, None]:
+        for index, text_id in enumerate(self.text_ids):
+            yield text_id, self.word_ids[self.offsets[index]:self.offsets[index + 1]]
+
+    @staticmethod
+    def as_numpy(view: memoryview) -> Any:
+        """Wrap a column view as numpy array without copy."""
+        import numpy as np
+        return np.frombuffer(view, dtype=np.uint64 if view.format == "Q" else np.uint32 if view.format == "I" else np.uint8)
+
+
+def load_lexicon(lexicon_file_path: str) -> Dict[int, Tuple[str, str, str, str]]:
+    """Load lexicon file as `WordID -> (Word, Lemma, PoS, Tag)` to decode token tables."""
+    wordid2wlpt = dict()
+    with open(lexicon_file_path, "r") as f:
+        for idx, line in enumerate(f):
+            if idx == 0 or idx == 1:
+                continue
+            word_id, _, word, lemma, pos, tag = line.rstrip("\n").split('\t')
+            wordid2wlpt[int(word_id)] = (word, lemma, pos, tag)
+
+    return wordid2wlpt
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+# @author: YangLiu
+# @email: yangliu.real@gmail.com
+
+# Byte-offset index and random-access reader for metadata / sources / merge tsv files.
+# The index of `{tsv}` lives in directory `{tsv}.idx`:
+#     meta.json       size & mtime of the indexed tsv, its header and number of rows
+#     offsets.u64     byte offset of each row, plus the file size at the end
+#     text_ids.u64    64-bit hash of each row's TextID
+#     url_hashes.u64  64-bit hash of each row's URL
+#     domain_ids.u32  position of each row's Domain in domains.txt
+#     dates.u32       Time of each row as YYYYMMDD, 0 for NULL or malformed dates
+#     domains.txt     distinct domains, one per line
+# so that looking up a document or filtering by domain / date never parses the whole file.
+
+import os
+import sys
+import json
+import mmap
+import shutil
+from array import array
+from hashlib import blake2b
+from typing import Dict, Generator, List, Optional, Union
+
+# columns of metadata tsv files, used when the file comes without header
+METADATA_COLUMNS = ["TextID", "Time", "Words", "Variety", "Genre", "Domain", "URL", "Title", "Content"]
+# number of rows buffered in memory before flushing the index columns to disk
+FLUSH_SIZE = 1 << 16
+
+
+def hash_key(s: str) -> int:
+    """Stable 64-bit hash of a string, unlike `hash` which is salted per process."""
+    return int.from_bytes(blake2b(s.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def parse_date(s: str) -> int:
+    """Parse `YYYY-MM-DD` to integer YYYYMMDD, 0 for `NULL` or malformed dates."""
+    try:
+        year, month, day = s.split('-')
+        return int(year) * 10000 + int(month) * 100 + int(day)
+    except ValueError:
+        return 0
+
+
+def get_index_dir(tsv_path: str) -> str:
+    return f"{tsv_path}.idx"
+
+
+def is_index_fresh(tsv_path: str) -> bool:
+    meta_path = os.path.join(get_index_dir(tsv_path), "meta.json")
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path, "r") as f:
+        meta = json.load(f)
+    stat = os.stat(tsv_path)
+    return meta["size"] == stat.st_size and meta["mtime"] == stat.st_mtime and meta["byteorder"] == sys.byteorder
+
+
+def build_index(tsv_path: str) -> str:
+    """Scan a tsv once and write its index directory."""
+    index_dir = get_index_dir(tsv_path)
+    tmp_dir = f"{index_dir}.tmp"
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    stat = os.stat(tsv_path)
+
+    columns = {"offsets.u64": array("Q"), "text_ids.u64": array("Q"), "url_hashes.u64": array("Q"), "domain_ids.u32": array("I"), "dates.u32": array("I")}
+    files = {name: open(os.path.join(tmp_dir, name), "wb") for name in columns}
+    domain2id = dict()
+
+    def flush() -> None:
+        for name, column in columns.items():
+            column.tofile(files[name])
+            del column[:]
+
+    with open(tsv_path, "rb") as f:
+        first_line = f.readline()
+        fields = first_line.decode("utf-8").rstrip("\r\n").split('\t')
+        if fields[0] == "TextID":
+            header, offset = fields, len(first_line)
+        else:
+            header, offset = METADATA_COLUMNS, 0
+            f.seek(0)
+        textid_col, time_col, domain_col, url_col = [header.index(name) for name in ("TextID", "Time", "Domain", "URL")]
+        maxsplit = max(textid_col, time_col, domain_col, url_col) + 1
+
+        rows = 0
+        for line in f:
+            fields = line.decode("utf-8").split('\t', maxsplit)
+            if len(fields) < maxsplit:  # malformed row, pad the missing fields
+                fields = fields + [""] * maxsplit
+            domain = fields[domain_col]
+            if domain not in domain2id:
+                domain2id[domain] = len(domain2id)
+            columns["offsets.u64"].append(offset)
+            columns["text_ids.u64"].append(hash_key(fields[textid_col]))
+            columns["url_hashes.u64"].append(hash_key(fields[url_col].strip()))
+            columns["domain_ids.u32"].append(domain2id[domain])
+            columns["dates.u32"].append(parse_date(fields[time_col]))
+            offset += len(line)
+            rows += 1
+            if rows % FLUSH_SIZE == 0:
+                flush()
+        columns["offsets.u64"].append(offset)
+        flush()
+
+    for fw in files.values():
+        fw.close()
+    with open(os.path.join(tmp_dir, "domains.txt"), "w") as fw:
+        for domain in domain2id:
+            fw.write(f"{domain}\n")
+    meta = {"size": stat.st_size, "mtime": stat.st_mtime, "byteorder": sys.byteorder, "header": header, "rows": rows}
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as fw:
+        json.dump(meta, fw, indent=2)
+
+    if os.path.isdir(index_dir):
+        shutil.rmtree(index_dir)
+    os.replace(tmp_dir, index_dir)
+
+    return index_dir
+
+
+class IndexedTsv:
+    """mmap-backed random-access reader of an indexed tsv, (re)building the index when stale.
+
+    Usage
+    -----
+    with IndexedTsv("data/metadata.raw.hk.tsv") as tsv:
+        fields = tsv.get("00000042")  # O(1) lookup by TextID
+        for url in tsv.column("URL"):  # lazy iteration over a single column
+            ...
+        for fields in tsv.filter(domain="www.scmp.com", start="2020-01-01", end="2020-12-31"):
+            ...
+    """
+
+    def __init__(self, tsv_path: str, rebuild: bool = False):
+        self.tsv_path = tsv_path
+        index_dir = get_index_dir(tsv_path)
+        if rebuild or not is_index_fresh(tsv_path):
+            build_index(tsv_path)
+        with open(os.path.join(index_dir, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        with open(os.path.join(index_dir, "domains.txt"), "r") as f:
+            self.domains = [line.rstrip("\n") for line in f]
+        self.header = self.meta["header"]
+        self.mmaps = list()
+        self.data = self._map(tsv_path, "B")
+        self.offsets = self._map(os.path.join(index_dir, "offsets.u64"), "Q")
+        self.text_ids = self._map(os.path.join(index_dir, "text_ids.u64"), "Q")
+        self.url_hashes = self._map(os.path.join(index_dir, "url_hashes.u64"), "Q")
+        self.domain_ids = self._map(os.path.join(index_dir, "domain_ids.u32"), "I")
+        self.dates = self._map(os.path.join(index_dir, "dates.u32"), "I")
+        self.textid2row = None
+        self.url2row = None
+
+    def _map(self, fpath: str, fmt: str) -> memoryview:
+        with open(fpath, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return memoryview(b"").cast(fmt)
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.mmaps.append(mm)
+        return memoryview(mm).cast(fmt)
+
+    def __len__(self) -> int:
+        return self.meta["rows"]
+
+    def __iter__(self) -> Generator[List[str], None, None]:
+        for i in range(len(self)):
+            yield self.row(i)
+
+    def __enter__(self) -> "IndexedTsv":
+        return self
+
+    def __exit__(self, type, value, traceback) -> None:
+        self.close()
+
+    def close(self) -> None:
+        for view in [self.data, self.offsets, self.text_ids, self.url_hashes, self.domain_ids, self.dates]:
+            view.release()
+        for mm in self.mmaps:
+            mm.close()
+        self.mmaps = list()
+
+    def line(self, i: int) -> str:
+        """Raw line of row `i`, with its trailing newline."""
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8")
+
+    def row(self, i: int) -> List[str]:
+        return self.line(i).rstrip("\r\n").split('\t')
+
+    def locate(self, text_id: str) -> Optional[int]:
+        """Row number of a document by TextID, None if absent."""
+        if self.textid2row is None:
+            self.textid2row = self._build_lookup(self.text_ids)
+        i = self.textid2row.get(hash_key(text_id))
+        if i is None:
+            return None
+        col = self.header.index("TextID")
+        return i if self.line(i).split('\t', col + 1)[col] == text_id else None
+
+    def get(self, text_id: str) -> Optional[List[str]]:
+        """Fetch a document by TextID, None if absent."""
+        i = self.locate(text_id)
+        return self.row(i) if i is not None else None
+
+    def domain_of(self, i: int) -> str:
+        return self.domains[self.domain_ids[i]]
+
+    def year_of(self, i: int) -> int:
+        """Year of row `i`, 0 for NULL or malformed dates."""
+        return self.dates[i] // 10000
+
+    def get_by_url(self, url: str) -> Optional[List[str]]:
+        """Fetch a document by URL, None if absent."""
+        if self.url2row is None:
+            self.url2row = self._build_lookup(self.url_hashes)
+        i = self.url2row.get(hash_key(url.strip()))
+        if i is None:
+            return None
+        fields = self.row(i)
+        return fields if fields[self.header.index("URL")].strip() == url.strip() else None
+
+    @staticmethod
+    def _build_lookup(keys: memoryview) -> Dict[int, int]:
+        """Hash -> first row with that hash, built once from the mmapped column."""
+        lookup = dict()
+        for i, key in enumerate(keys):
+            lookup.setdefault(key, i)
+        return lookup
+
+    def column(self, name: str) -> Generator[str, None, None]:
+        """Lazily iterate over a single column, only splitting each line up to that column."""
+        col = self.header.index(name)
+        for i in range(len(self)):
+            fields = self.line(i).split('\t', col + 1)
+            yield fields[col].rstrip("\r\n") if col < len(fields) else ""
+
+    def filter(self, domain: Optional[str] = None, start: Union[str, int, None] = None, end: Union[str, int, None] = None) -> Generator[List[str], None, None]:
+        """Iterate over rows of a domain and/or within a date range `[start, end]` (`YYYY-MM-DD`).
+        Rows are selected from the index columns, only the matched ones get parsed."""
+        domain_id = None
+        if domain is not None:
+            if domain not in self.domains:
+                return
+            domain_id = self.domains.index(domain)
+        start = parse_date(start) if isinstance(start, str) else start
+        end = parse_date(end) if isinstance(end, str) else end
+        for i in range(len(self)):
+            if domain_id is not None and self.domain_ids[i] != domain_id:
+                continue
+            if start is not None and self.dates[i] < start:
+                continue
+            if end is not None and (self.dates[i] > end or self.dates[i] == 0):
+                continue
+            yield self.row(i)
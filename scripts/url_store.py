@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# @author: YangLiu
+# @email: yangliu.real@gmail.com
+
+# Persistent per-variety store of the search result URLs, backed by SQLite, shared by the
+# search worker processes of `run.py`.
+# URLs are normalized by `frontier.normalize_url` and kept as a set of 64-bit hashes, so only
+# never-seen URLs are written to `url.{cc}.csv`, across batches, workers and runs.
+# The yield of each query is recorded: result pages, URLs found, new URLs, for all runs and for
+# its last run. Only result pages with URLs and without captcha are recorded, and a query whose
+# last run read at least `MIN_PAGES` of them without any new URL is exhausted and skipped by
+# `auto_google_search.read_query_file`.
+
+import os
+import sqlite3
+from time import time
+from hashlib import blake2b
+from typing import Iterable, List, Optional, Set
+
+from frontier import normalize_url
+
+# number of result pages without new URL in a run after which a query is exhausted
+MIN_PAGES = 3
+
+
+def hash_url(url: str) -> int:
+    """Signed 64-bit hash of a normalized URL, stored as SQLite integer key."""
+    return int.from_bytes(blake2b(url.encode("utf-8"), digest_size=8).digest(), "little", signed=True)
+
+
+class UrlStore:
+    """On-disk URL hash set and query yields, safe to open from several processes at once."""
+
+    def __init__(self, db_path: str):
+        self.conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS urls (hash INTEGER PRIMARY KEY)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS queries (query TEXT PRIMARY KEY, runs INTEGER, pages INTEGER, found INTEGER, new INTEGER, "
+                          "last_pages INTEGER, last_found INTEGER, last_new INTEGER, last_time REAL)")
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM urls").fetchone()[0]
+
+    def add(self, urls: Iterable[str]) -> List[str]:
+        """Add URLs to the set, in a single transaction.
+
+        Returns
+        -------
+        normalized URLs which were not in the set yet, in input order
+        """
+        new_urls, seen = list(), set()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            for url in urls:
+                if not url or not url.strip():
+                    continue
+                url = normalize_url(url)
+                if url in seen:
+                    continue
+                seen.add(url)
+                if self.conn.execute("INSERT OR IGNORE INTO urls VALUES (?)", (hash_url(url),)).rowcount:
+                    new_urls.append(url)
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+        return new_urls
+
+    def seed(self, csv_path: str) -> int:
+        """Add the URLs of a former csv once, while the set is empty, return the number of URLs added."""
+        if not os.path.exists(csv_path) or len(self) > 0:
+            return 0
+        with open(csv_path, "r") as f:
+            return len(self.add(line for line in f if line.strip()))
+
+    def start_query(self, query: str) -> None:
+        """Record a new run of a query, resetting the yield of its last run."""
+        self.conn.execute("INSERT INTO queries VALUES (?, 1, 0, 0, 0, 0, 0, 0, ?) "
+                          "ON CONFLICT(query) DO UPDATE SET runs = runs + 1, last_pages = 0, last_found = 0, last_new = 0, last_time = excluded.last_time",
+                          (query, time()))
+
+    def record(self, query: str, found: int, new: int) -> None:
+        """Record the yield of a result page of a query, which should hold results."""
+        self.conn.execute("UPDATE queries SET pages = pages + 1, found = found + ?, new = new + ?, "
+                          "last_pages = last_pages + 1, last_found = last_found + ?, last_new = last_new + ?, last_time = ? WHERE query = ?",
+                          (found, new, found, new, time(), query))
+
+    def exhausted(self) -> Set[str]:
+        """Queries whose last run read `MIN_PAGES` result pages or more, without any new URL."""
+        rows = self.conn.execute("SELECT query FROM queries WHERE last_pages >= ? AND last_new = 0", (MIN_PAGES,))
+        return {row[0] for row in rows}
+
+    def query_yield(self, query: str) -> Optional[dict]:
+        row = self.conn.execute("SELECT runs, pages, found, new, last_pages, last_found, last_new FROM queries WHERE query = ?", (query,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("runs", "pages", "found", "new", "last_pages", "last_found", "last_new"), row))
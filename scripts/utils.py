@@ -4,11 +4,19 @@
 
 # utility tool box
 
-import re
+import os
+import shutil
 import signal
+from glob import glob
 from time import sleep
+from collections import Counter
+from typing import Dict, List, Tuple
 
-from httpx import get, post
+from pebble import ProcessPool
+
+CC_LIST = ["cn", "hk", "mo", "tw", "sg", "my"]
+# write buffer in bytes of each routed output
+ROUTE_BUFFER_SIZE = 1 << 20
 
 
 class Timeout:
@@ -30,48 +38,9 @@ class Timeout:
 
 
 def generate_trigram(fpath: str = "data/glowbe.raw.txt"):
-    """silly func for generate trigram set."""
-    gram_rec = dict()
-    pattern = re.compile(r"[^a-zA-Z\s]+", re.IGNORECASE)
-    output_lines = list()
-    output_file = open("data/3gram.tsv", "w")
-    with open(fpath, mode="r", encoding="utf-8") as f:
-        lines = f.readlines()
-        for i, line in enumerate(lines, start=1):
-            if not line.startswith("#"):
-                continue
-            line = line.split(' ', 1)[1].replace("<p>", "").replace("<h>", "").lower()
-            res = re.sub(pattern, "", line)
-            res = " ".join([w.strip() for w in res.split() if w.strip() != ""])
-            # output_file.write(res + "\n")
-            output_lines.append(res)
-            # if i > 1000:
-            # break
-
-    del lines
-    # core in trigram generation
-    for line in output_lines:
-        l, r = 0, 3
-        word_list = line.split()
-        if len(word_list) < 3:
-            continue
-        for i, word in enumerate(word_list):
-            if r > len(word_list):
-                break
-            gram = " ".join(word_list[l:r])
-            if gram not in gram_rec:
-                gram_rec[gram] = 0
-            gram_rec[gram] += 1
-            l += 1
-            r += 1
-    gram_rec = {k: v for k, v in sorted(gram_rec.items(), key=lambda item: item[1])}
-    output_file.write("3gram\tfrequency\n")
-    size = 100000 if len(gram_rec) > 100000 else len(gram_rec)
-    for _ in range(size):
-        item = gram_rec.popitem()
-        output_file.write(item[0] + "\t" + str(item[1]) + "\n")
-
-    output_file.close()
+    """Generate the 100k most frequent trigrams of GloWbE into `data/3gram.tsv`, see `ngram_counter`."""
+    from ngram_counter import count_ngrams
+    count_ngrams(fpath, "data/3gram.tsv", n=3, top_k=100000)
 
 
 def req_2captcha(
@@ -81,6 +50,7 @@ def req_2captcha(
     cookies=None,
     proxy=None
 ):
+    from httpx import get, post
     status_code = 0
     url_req = "http://2captcha.com/in.php"
     form = {"method": "userrecaptcha",
@@ -110,37 +80,80 @@ def get_chunks(lst, n):
         yield lst[i:i + n]
 
 
-def cluster_documents() -> None:
-    """Input a documents from all 6 varieties, cluster them by their specific top domain."""
-    fpath_list = glob("../../data/*.tsv")
-    cc2list = {"cn": [], "hk": [], "mo": [], "tw": [], "sg": [], "my": []}
-    for fpath in fpath_list:
-        cc = fpath.replace(".tsv", "").rsplit('.')[-1]
-        cc_list_exclude = ["cn", "hk", "mo", "tw", "sg", "my"]
-        _ = cc_list_exclude.pop(cc_list_exclude.index(cc))
+def route_file(fpath: str, part_dir: str) -> Counter:
+    """Stream a tsv of variety `cc` and route each line to the part file of the variety of its
+    top-level domain, or of `cc` if that is not another variety.
+
+    Returns
+    -------
+    counter of lines routed from `cc` to each variety
+    """
+    cc = fpath.replace(".tsv", "").rsplit('.')[-1]
+    base = os.path.basename(fpath)
+    counts = Counter()
+    writers = dict()
+    try:
         with open(fpath, "r") as f:
-            lines = [line.strip() for line in f.readlines()]
-            for line in lines:
-                _, _, _, _, _, domain, _, _, _ = line.split('\t')
-                top_domain = domain.rsplit('.')[-1].strip()
-                if top_domain in cc_list_exclude:
-                    print(f"{cc} | true: {top_domain}")
-                    cc2list[top_domain].append(line)
-                else:
-                    cc2list[cc].append(line)
-    for cc, lines in cc2list.items():
-        with open(f"merge.{cc}.tsv", "w") as f:
-            for line in lines:
-                f.write(line + "\n")
-
-
-def get_corpus_statistics():
+            for line in f:
+                line = line.strip()
+                fields = line.split('\t', 6)
+                top_domain = fields[5].rsplit('.')[-1].strip() if len(fields) > 6 else cc
+                target = top_domain if top_domain in CC_LIST else cc
+                if target not in writers:
+                    writers[target] = open(os.path.join(part_dir, f"{base}.{target}.part"), "w", buffering=ROUTE_BUFFER_SIZE)
+                writers[target].write(line + "\n")
+                counts[target] += 1
+    finally:
+        for fw in writers.values():
+            fw.close()
+    return counts
+
+
+def cluster_documents(fpath_pattern: str = "../../data/*.tsv", output_dir: str = ".", max_workers: int = os.cpu_count()) -> Dict[Tuple[str, str], int]:
+    """Input a documents from all 6 varieties, cluster them by their specific top domain.
+    Input files are routed in parallel into part files, which are then concatenated in input
+    order into `merge.{cc}.tsv`, so memory stays constant whatever the corpus size.
+
+    Returns
+    -------
+    (source variety, target variety) -> number of routed lines
+    """
+    fpath_list = sorted(glob(fpath_pattern))
+    part_dir = os.path.join(output_dir, "merge.parts")
+    os.makedirs(part_dir, exist_ok=True)
+    with ProcessPool(max_workers=max_workers) as pool:
+        futures = [pool.schedule(route_file, [fpath, part_dir]) for fpath in fpath_list]
+        routes = Counter()
+        for fpath, future in zip(fpath_list, futures):
+            cc = fpath.replace(".tsv", "").rsplit('.')[-1]
+            for target, count in future.result().items():
+                routes[(cc, target)] += count  # several input files may share a variety
+
+    for cc in CC_LIST:
+        output_path = os.path.join(output_dir, f"merge.{cc}.tsv")
+        with open(f"{output_path}.tmp", "w") as fw:
+            for fpath in fpath_list:
+                part_path = os.path.join(part_dir, f"{os.path.basename(fpath)}.{cc}.part")
+                if os.path.exists(part_path):
+                    with open(part_path, "r") as f:
+                        shutil.copyfileobj(f, fw, ROUTE_BUFFER_SIZE)
+        os.replace(f"{output_path}.tmp", output_path)
+    shutil.rmtree(part_dir)
+
+    for (cc, target), count in sorted(routes.items()):
+        print(f"{cc} -> {target}: {count}")
+    return routes
+
+
+def get_corpus_statistics(cc_list: List[str] = None) -> Dict[str, Dict]:
     """
     1. number of word(token) for each variety
-    2. number of paragraphs for each variety
+    2. number of paragraphs for each variety (n/a, paragraph boundaries are lost in `page_parse.preprocess`)
     3. number of sentences for each variety
+    plus types, type/token ratio and per-domain / per-year breakdowns, see `corpus_stats`.
     """
-    pass
+    from corpus_stats import corpus_statistics
+    return corpus_statistics(cc_list)
 
 
 if __name__ == "__main__":
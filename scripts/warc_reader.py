@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+# @author: YangLiu
+# @email: yangliu.real@gmail.com
+
+# Streaming WARC reader for re-extracting pages from the crawled archives.
+# Only HTML responses with status 200 are yielded as `(url, time, raw_html)`, others are
+# skipped according to their WARC / HTTP headers:
+#     *.warc.gz: one gzip member per record (as WARC spec recommends), only the head of a
+#                skipped member is inflated, the next member is found on the raw bytes.
+#     *.warc:    the payload of a skipped record is seeked over by its Content-Length.
+# Files can be split into byte ranges, each record belongs to the range its offset falls in,
+# so that ranges of the same file are processed in parallel.
+
+import os
+import zlib
+from glob import glob
+from typing import Dict, Generator, List, Optional, Tuple
+
+GZIP_MAGIC = b"\x1f\x8b\x08"
+# compressed bytes read at a time
+READ_SIZE = 1 << 16
+# compressed bytes read at a time while looking for the headers of a member
+HEAD_READ_SIZE = 1 << 12
+# byte size of a range when splitting files for parallel processing
+RANGE_BYTES = 1 << 26
+
+
+def list_warcs(fpath: str) -> List[str]:
+    return sorted(glob(os.path.join(fpath, "*.warc.gz")) + glob(os.path.join(fpath, "*.warc")))
+
+
+def split_ranges(warc_path: str, range_bytes: int = RANGE_BYTES) -> List[Tuple[int, int]]:
+    """Split a WARC file into byte ranges `[start, end)`."""
+    size = os.path.getsize(warc_path)
+    return [(start, min(start + range_bytes, size)) for start in range(0, size, range_bytes)] or [(0, 0)]
+
+
+def parse_header_block(block: bytes) -> Tuple[str, Dict[str, str]]:
+    """Parse the first line and `Key: Value` lines of a header block, keys are lowercased."""
+    lines = block.decode("latin-1").split("\r\n")
+    headers = dict()
+    for line in lines[1:]:
+        if ':' in line:
+            key, value = line.split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+    return lines[0], headers
+
+
+def parse_heads(data: bytes) -> Optional[Dict]:
+    """Parse WARC & HTTP headers at the beginning of a record.
+
+    Returns
+    -------
+    None if `data` is too short to hold both header blocks, `{"skip": True}` if the record is
+    not a successful HTML response, else the record's url, time, HTTP headers and body span.
+    """
+    warc_end = data.find(b"\r\n\r\n")
+    if warc_end == -1:
+        return None
+    version, warc_headers = parse_header_block(data[:warc_end])
+    if not version.startswith("WARC/") or warc_headers.get("warc-type") != "response" \
+            or not warc_headers.get("content-type", "").startswith("application/http"):
+        return {"skip": True}
+    http_start = warc_end + 4
+    http_end = data.find(b"\r\n\r\n", http_start)
+    if http_end == -1:
+        return None
+    status_line, http_headers = parse_header_block(data[http_start:http_end])
+    status = status_line.split(' ')
+    if len(status) < 2 or status[1] != "200" or "text/html" not in http_headers.get("content-type", ""):
+        return {"skip": True}
+    body_start = http_end + 4
+    body_end = http_start + int(warc_headers.get("content-length", "0"))
+    return {
+        "skip": False,
+        "url": warc_headers.get("warc-target-uri", "").strip("<>"),
+        "time": warc_headers.get("warc-date", "NULL").split('T')[0] or "NULL",
+        "http_headers": http_headers,
+        "body_start": body_start,
+        "body_end": max(body_end, body_start),
+    }
+
+
+def dechunk(body: bytes) -> bytes:
+    """Decode HTTP chunked transfer encoding."""
+    output, pos = bytearray(), 0
+    while pos < len(body):
+        line_end = body.find(b"\r\n", pos)
+        if line_end == -1:
+            break
+        size = int(body[pos:line_end].split(b';')[0] or b"0", 16)
+        if size == 0:
+            break
+        output += body[line_end + 2:line_end + 2 + size]
+        pos = line_end + 2 + size + 2
+    return bytes(output)
+
+
+def decode_body(body: bytes, http_headers: Dict[str, str]) -> str:
+    """Decode an HTTP body as stored in WARC into text."""
+    if "chunked" in http_headers.get("transfer-encoding", "").lower():
+        body = dechunk(body)
+    encoding = http_headers.get("content-encoding", "").lower()
+    if encoding in ("gzip", "deflate"):
+        try:
+            body = zlib.decompress(body, 47 if encoding == "gzip" else 15)
+        except zlib.error:
+            pass
+    charset = "utf-8"
+    for param in http_headers.get("content-type", "").split(';')[1:]:
+        if param.strip().lower().startswith("charset="):
+            charset = param.split('=', 1)[1].strip().strip('"\'') or charset
+    try:
+        return body.decode(charset, errors="replace")
+    except LookupError:
+        return body.decode("utf-8", errors="replace")
+
+
+def is_warc_member(f, offset: int) -> bool:
+    """Whether a gzip member of a WARC record starts at `offset`."""
+    f.seek(offset)
+    try:
+        return zlib.decompressobj(31).decompress(f.read(512), 5) == b"WARC/"
+    except zlib.error:
+        return False
+
+
+def find_member(f, pos: int, end: Optional[int] = None) -> Optional[int]:
+    """Offset of the first WARC record member starting in `[pos, end)`, scanning raw compressed bytes."""
+    while end is None or pos < end:
+        f.seek(pos)
+        buf = f.read(READ_SIZE)
+        if len(buf) < len(GZIP_MAGIC):
+            return None
+        i = buf.find(GZIP_MAGIC)
+        while i != -1:
+            if end is not None and pos + i >= end:
+                return None
+            if is_warc_member(f, pos + i):
+                return pos + i
+            i = buf.find(GZIP_MAGIC, i + 1)
+        pos += len(buf) - len(GZIP_MAGIC) + 1
+    return None
+
+
+def read_gzip_record(f, offset: int) -> Tuple[Optional[Tuple[str, str, str]], Optional[int]]:
+    """Read the record member at `offset`.
+
+    Returns
+    -------
+    `(url, time, raw_html)` or None if skipped, and the offset of the next member or None at the end of file
+    """
+    f.seek(offset)
+    inflater = zlib.decompressobj(31)
+    data = bytearray()
+    heads = None
+    while not inflater.eof:
+        chunk = f.read(HEAD_READ_SIZE if heads is None else READ_SIZE)
+        if not chunk:
+            if f.tell() > offset:
+                print(f"truncated WARC member at {f.name}@{offset}, skipped")
+            return None, None
+        data += inflater.decompress(chunk)
+        if heads is None:
+            heads = parse_heads(data)
+            if heads is not None and heads["skip"] and not inflater.eof:
+                return None, find_member(f, offset + 1)
+    next_offset = f.tell() - len(inflater.unused_data)
+    if heads is None or heads["skip"]:
+        return None, next_offset
+    body = bytes(data[heads["body_start"]:heads["body_end"]])
+    return (heads["url"], heads["time"], decode_body(body, heads["http_headers"])), next_offset
+
+
+def iter_gzip_warc(warc_path: str, start: int = 0, end: Optional[int] = None) -> Generator[Tuple[str, str, str, int], None, None]:
+    with open(warc_path, "rb") as f:
+        offset = find_member(f, start, end)
+        while offset is not None and (end is None or offset < end):
+            record, next_offset = read_gzip_record(f, offset)
+            if record is not None:
+                yield (*record, offset)
+            offset = next_offset
+
+
+def find_plain_record(f, pos: int, end: Optional[int] = None) -> Optional[int]:
+    """Offset of the first line starting with `WARC/` in `[pos, end)`."""
+    f.seek(max(pos - 1, 0))
+    if pos > 0 and f.read(1) != b"\n":
+        pos += len(f.readline())  # a record starts at the beginning of a line
+    while end is None or pos < end:
+        line = f.readline()
+        if not line:
+            return None
+        if line.startswith(b"WARC/"):
+            return pos
+        pos += len(line)
+    return None
+
+
+def iter_plain_warc(warc_path: str, start: int = 0, end: Optional[int] = None) -> Generator[Tuple[str, str, str, int], None, None]:
+    with open(warc_path, "rb") as f:
+        offset = find_plain_record(f, start, end) if start > 0 else 0
+        while offset is not None and (end is None or offset < end):
+            f.seek(offset)
+            head = bytearray()
+            for line in iter(f.readline, b""):
+                head += line
+                if line == b"\r\n":
+                    break
+            if not head:
+                return
+            _, warc_headers = parse_header_block(bytes(head[:-4]))
+            payload_start = f.tell()
+            content_length = int(warc_headers.get("content-length", "0"))
+            if warc_headers.get("warc-type") == "response" and warc_headers.get("content-type", "").startswith("application/http"):
+                record = bytes(head) + f.read(content_length)
+                heads = parse_heads(record)
+                if heads is not None and not heads["skip"]:
+                    body = record[heads["body_start"]:heads["body_end"]]
+                    yield heads["url"], heads["time"], decode_body(body, heads["http_headers"]), offset
+            # skip over the payload and the two CRLFs after it
+            offset = find_plain_record(f, payload_start + content_length)
+
+
+def iter_warc(warc_path: str, start: int = 0, end: Optional[int] = None) -> Generator[Tuple[str, str, str, int], None, None]:
+    """Stream `(url, time, raw_html, offset)` of HTML responses whose record starts in `[start, end)`."""
+    if warc_path.endswith(".gz"):
+        yield from iter_gzip_warc(warc_path, start, end)
+    else:
+        yield from iter_plain_warc(warc_path, start, end)